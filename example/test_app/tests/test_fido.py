@@ -1,16 +1,34 @@
 import json
+import re
 from base64 import urlsafe_b64encode
 from importlib import import_module
+from io import StringIO
+from unittest import mock, skipIf
 
+import django
+from django.contrib.auth.models import AnonymousUser
 from django.test import RequestFactory, TransactionTestCase, Client
-from django.urls import reverse
+from django.urls import resolve, reverse
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from fido2.utils import websafe_decode, websafe_encode
 from test_app.soft_webauthn import SoftWebauthnDevice
 from django.contrib.auth import get_user_model
 
+from passkeys.cache import get_credential, get_credential_with_user
+from passkeys.challenge import CacheChallengeStore, SignedChallengeStore
+from passkeys.executor import VerificationExecutor, VerificationQueueFull
+from passkeys import FIDO2
+from passkeys.FIDO2 import clear_server_cache, get_credential_descriptors, get_rp, get_server
 from passkeys.models import UserPasskey
 
+try:
+    from asgiref.sync import async_to_sync
+except ImportError:  # Django 2.x doesn't install asgiref
+    async_to_sync = None
+
 
 def get_server_id(request):
     return request.META["SERVER_NAME"] + "1"
@@ -151,6 +169,90 @@ class test_fido(TransactionTestCase):
     def test_passkey_login_no_session(self):
         pass
 
+    def _discoverable_assertion(self, authenticator, request):
+        with self.assertNumQueries(0):
+            r = FIDO2.auth_begin(request)
+        j = json.loads(r.content)
+        self.assertFalse(j["publicKey"].get("allowCredentials"))
+        j["publicKey"]["challenge"] = j["publicKey"]["challenge"].encode("ascii")
+        return authenticator.get(j, "https://" + j["publicKey"]["rpId"])
+
+    def test_discoverable_login(self):
+        authenticator = self.test_key_reg()
+        key = UserPasskey.objects.latest("id")
+        self.assertEquals(key.user_handle, FIDO2.get_user_handle(self.user))
+        self.assertEquals(key.user_handle, authenticator.user_handle)
+
+        client = Client()
+        with self.assertNumQueries(0):
+            r = client.get(reverse("passkeys:auth_begin"), {"mode": "discoverable"})
+        j = json.loads(r.content)
+        self.assertFalse(j["publicKey"].get("allowCredentials"))
+        j["publicKey"]["challenge"] = j["publicKey"]["challenge"].encode("ascii")
+        res = authenticator.get(j, "https://" + j["publicKey"]["rpId"])
+        client.post(
+            reverse("passkeys:login.passkey"), {"passkeys": json.dumps(res)}, HTTP_USER_AGENT=""
+        )
+        self.assertEquals(client.session["_auth_user_id"], str(self.user.pk))
+
+    def _inline_options(self, response):
+        match = re.search(
+            r'<script id="passkey-options" type="application/json">(.*?)</script>',
+            response.content.decode(),
+        )
+        j = json.loads(match.group(1))
+        j["publicKey"]["challenge"] = j["publicKey"]["challenge"].encode("ascii")
+        return j
+
+    def test_inline_options(self):
+        authenticator = self.test_key_reg()
+        client = Client()
+        r = client.post(reverse("passkeys:login"), {"email": "test@test.com"})
+        j = self._inline_options(r)
+        self.assertEquals(len(j["publicKey"]["allowCredentials"]), 1)
+        res = authenticator.get(j, "https://" + j["publicKey"]["rpId"])
+        client.post(
+            reverse("passkeys:login.passkey"), {"passkeys": json.dumps(res)}, HTTP_USER_AGENT=""
+        )
+        self.assertEquals(client.session["_auth_user_id"], str(self.user.pk))
+
+    def test_conditional_ui_options(self):
+        authenticator = self.test_key_reg()
+        client = Client()
+        r = client.get(reverse("passkeys:login"))
+        self.assertNotContains(r, "passkey-options")
+        with self.settings(PASSKEYS_CONDITIONAL_UI=True):
+            r = client.get(reverse("passkeys:login"))
+        self.assertContains(r, "djangoPasskey.conditionalLogin()")
+        j = self._inline_options(r)
+        self.assertFalse(j["publicKey"].get("allowCredentials"))
+        res = authenticator.get(j, "https://" + j["publicKey"]["rpId"])
+        client.post(
+            reverse("passkeys:login.passkey"), {"passkeys": json.dumps(res)}, HTTP_USER_AGENT=""
+        )
+        self.assertEquals(client.session["_auth_user_id"], str(self.user.pk))
+
+    def test_user_handle_mismatch(self):
+        authenticator = self.test_key_reg()
+        with self.settings(PASSKEYS_CREDENTIAL_CACHE_SIZE=10):
+            request = self._async_request(
+                self.factory.get("/", {"mode": "discoverable"}), AnonymousUser()
+            )
+            res = self._discoverable_assertion(authenticator, request)
+            # older versions of script.js posted the handle's bytes as text
+            res["response"]["userHandle"] = websafe_decode(authenticator.user_handle).decode()
+            request = self.factory.post("/", {"passkeys": json.dumps(res)}, HTTP_USER_AGENT="")
+            user = FIDO2.auth_complete(self._async_request(request, AnonymousUser()))
+            self.assertEquals(user.pk, self.user.pk)
+
+            request = self._async_request(
+                self.factory.get("/", {"mode": "discoverable"}), AnonymousUser()
+            )
+            res = self._discoverable_assertion(authenticator, request)
+            res["response"]["userHandle"] = websafe_encode(b"someone else")
+            request = self.factory.post("/", {"passkeys": json.dumps(res)}, HTTP_USER_AGENT="")
+            self.assertIsNone(FIDO2.auth_complete(self._async_request(request, AnonymousUser())))
+
     def test_server_id_callable(self):
         from test_app.tests.test_fido import get_server_id
 
@@ -168,3 +270,411 @@ class test_fido(TransactionTestCase):
         self.assertEquals(r.status_code, 200)
         j = json.loads(r.content)
         self.assertEquals(j["publicKey"]["rp"]["name"], "MySite")
+
+    def test_server_is_reused(self):
+        clear_server_cache()
+        request = self.factory.get("/")
+        server = get_server(request)
+        self.assertIs(get_server(request), server)
+        clear_server_cache()
+        self.assertIsNot(get_server(request), server)
+
+    def test_verification_servers(self):
+        from passkeys.executor import _WorkerServers, _worker_args, _worker_server
+
+        request = self.factory.get("/")
+        self.assertIs(_worker_server(get_rp(request)), get_server(request))
+        with self.settings(FIDO_SERVER_CACHE_SIZE=1, PASSKEYS_ALGORITHMS=["EdDSA"]):
+            servers = _WorkerServers(*_worker_args())
+        first = servers.get(("a", "A"))
+        self.assertEquals([p.alg for p in first.allowed_algorithms], [-8])
+        self.assertIs(servers.get(("a", "A")), first)
+        servers.get(("b", "B"))
+        self.assertEquals(list(servers.servers), [("b", "B")])
+
+    def test_server_per_relying_party(self):
+        with self.settings(FIDO_SERVER_ID=get_server_id):
+            request = self.factory.get("/", SERVER_NAME="tenant")
+            self.assertEquals(get_server(request).rp.id, "tenant1")
+            request = self.factory.get("/", SERVER_NAME="other")
+            self.assertEquals(get_server(request).rp.id, "other1")
+
+    def test_credential_cache(self):
+        with self.settings(
+            PASSKEYS_CREDENTIAL_CACHE_SIZE=10, PASSKEYS_CREDENTIAL_CACHE="default"
+        ):
+            self.test_key_reg()
+            key = UserPasskey.objects.latest("id")
+            entry = get_credential(key.credential_id)
+            self.assertEquals(entry.user_id, self.user.pk)
+            with self.assertNumQueries(0):
+                self.assertIs(get_credential(key.credential_id), entry)
+            key.enabled = False
+            key.save()
+            self.assertFalse(get_credential(key.credential_id).enabled)
+            key.delete()
+            self.assertIsNone(get_credential(key.credential_id))
+
+    def test_passkey_login_with_credential_cache(self):
+        with self.settings(PASSKEYS_CREDENTIAL_CACHE_SIZE=10):
+            self.test_passkey_login()
+
+    def test_cached_credential_revoked_elsewhere(self):
+        with self.settings(PASSKEYS_CREDENTIAL_CACHE_SIZE=10):
+            self.test_passkey_login()
+            key = UserPasskey.objects.latest("id")
+            self.assertTrue(get_credential(key.credential_id).enabled)
+            # another process disabling the key doesn't reach this one's signals
+            UserPasskey.objects.filter(pk=key.pk).update(enabled=False)
+            self.assertEquals(get_credential_with_user(key.credential_id), (None, None))
+            self.assertFalse(get_credential(key.credential_id).enabled)
+
+    def test_descriptors_skip_tokens(self):
+        authenticator = self.test_key_reg()
+        UserPasskey.objects.filter(user=self.user).update(token="")
+        with self.assertNumQueries(1):
+            descriptors = get_credential_descriptors(user_id=self.user.pk)
+        self.assertEquals([d.id for d in descriptors], [authenticator.credential_id])
+
+    def test_transports(self):
+        r = self.client.get(reverse("passkeys:reg_begin"))
+        j = json.loads(r.content)
+        j["publicKey"]["challenge"] = j["publicKey"]["challenge"].encode("ascii")
+        authenticator = SoftWebauthnDevice()
+        res = authenticator.create(j, "https://" + j["publicKey"]["rp"]["id"])
+        res["response"]["transports"] = ["internal", "hybrid", "smoke-signal"]
+        r = self.client.post(
+            reverse("passkeys:reg_complete"),
+            data=json.dumps(res),
+            HTTP_USER_AGENT="",
+            content_type="application/json",
+        )
+        self.assertEquals(json.loads(r.content)["status"], "OK")
+        key = UserPasskey.objects.latest("id")
+        self.assertEquals(key.transports, "internal,hybrid")
+        self.assertIs(key.backup_eligible, False)
+        self.assertIs(key.backup_state, False)
+
+        r = self.client.get(reverse("passkeys:reg_begin"))
+        j = json.loads(r.content)
+        self.assertEquals(
+            j["publicKey"]["excludeCredentials"][0]["transports"], ["internal", "hybrid"]
+        )
+        UserPasskey.objects.filter(pk=key.pk).update(transports=None, backup_state=None)
+        r = self.client.get(reverse("passkeys:auth_begin"))
+        j = json.loads(r.content)
+        self.assertNotIn("transports", j["publicKey"]["allowCredentials"][0])
+
+        j["publicKey"]["challenge"] = j["publicKey"]["challenge"].encode("ascii")
+        res = authenticator.get(j, "https://" + j["publicKey"]["rpId"])
+        self.client.post(
+            reverse("passkeys:login.passkey"), {"passkeys": json.dumps(res)}, HTTP_USER_AGENT=""
+        )
+        self.assertIs(UserPasskey.objects.get(pk=key.pk).backup_state, False)
+
+    def test_binary_credentials(self):
+        authenticator = self.test_key_reg()
+        key = UserPasskey.objects.latest("id")
+        self.assertEquals(bytes(key.raw_credential_id), authenticator.credential_id)
+        self.assertEquals(key.attested_credential_data, websafe_decode(key.token))
+        with self.assertNumQueries(1):
+            self.assertEquals(get_credential(key.credential_id).id, key.id)
+
+        # RSA public keys don't fit in the legacy token column.
+        self.client.force_login(self.user)
+        r = self.client.get(reverse("passkeys:reg_begin"))
+        j = json.loads(r.content)
+        j["publicKey"]["challenge"] = j["publicKey"]["challenge"].encode("ascii")
+        res = SoftWebauthnDevice("RS256").create(j, "https://" + j["publicKey"]["rp"]["id"])
+        r = self.client.post(
+            reverse("passkeys:reg_complete"),
+            data=json.dumps(res),
+            HTTP_USER_AGENT="",
+            content_type="application/json",
+        )
+        self.assertEquals(json.loads(r.content)["status"], "OK")
+        key = UserPasskey.objects.latest("id")
+        self.assertEquals(key.token, "")
+        self.assertEquals(get_credential(key.credential_id).credential.public_key[3], -257)
+
+    def test_backfill_credentials(self):
+        authenticator = self.test_key_reg()
+        key = UserPasskey.objects.latest("id")
+        UserPasskey.objects.update(
+            credential_id_hash=None, raw_credential_id=None, credential_data=None
+        )
+        # Rows that weren't converted yet are still found by their string columns.
+        self.assertEquals(get_credential(key.credential_id).id, key.id)
+        descriptors = get_credential_descriptors(user_id=self.user.pk)
+        self.assertEquals([d.id for d in descriptors], [authenticator.credential_id])
+
+        out = StringIO()
+        call_command("passkeys_backfill_credentials", batch_size=1, stdout=out)
+        self.assertIn("Converted 1 passkey(s)", out.getvalue())
+        key.refresh_from_db()
+        self.assertEquals(bytes(key.raw_credential_id), authenticator.credential_id)
+        self.assertEquals(bytes(key.credential_data), websafe_decode(key.token))
+        self.assertIsNotNone(key.credential_id_hash)
+        call_command("passkeys_backfill_credentials", stdout=out)
+        self.assertIn("Converted 0 passkey(s)", out.getvalue())
+
+    def test_base_user_id(self):
+        authenticator = self.test_key_reg()
+        self.client.get("/auth/logout")
+        session = self.session
+        session["base_user_id"] = str(self.user.pk)
+        session.save(must_create=True)
+        self.client.cookies["sessionid"] = session.session_key
+        r = self.client.get(reverse("passkeys:auth_begin"))
+        j = json.loads(r.content)
+        self.assertEquals(
+            j["publicKey"]["allowCredentials"][0]["id"],
+            urlsafe_b64encode(authenticator.credential_id).decode("utf8").strip("="),
+        )
+
+    def _ceremonies_with_handle(self):
+        r = self.client.get(reverse("passkeys:reg_begin"))
+        j = json.loads(r.content)
+        self.assertIn("fido2_state", j)
+        j["publicKey"]["challenge"] = j["publicKey"]["challenge"].encode("ascii")
+        authenticator = SoftWebauthnDevice()
+        res = authenticator.create(j, "https://" + j["publicKey"]["rp"]["id"])
+        res["fido2_state"] = j["fido2_state"]
+        r = self.client.post(
+            reverse("passkeys:reg_complete"),
+            data=json.dumps(res),
+            HTTP_USER_AGENT="",
+            content_type="application/json",
+        )
+        self.assertEquals(json.loads(r.content)["status"], "OK")
+
+        self.client.logout()
+        r = self.client.get(reverse("passkeys:auth_begin"))
+        j = json.loads(r.content)
+        j["publicKey"]["challenge"] = j["publicKey"]["challenge"].encode("ascii")
+        res = authenticator.get(j, "https://" + j["publicKey"]["rpId"])
+        res["fido2_state"] = j["fido2_state"]
+        self.client.post(
+            reverse("passkeys:login.passkey"),
+            {"passkeys": json.dumps(res), "username": "", "password": ""},
+            HTTP_USER_AGENT="",
+        )
+        self.assertTrue(self.client.session.get("_auth_user_id", False))
+        self.assertNotIn("fido2_state", self.client.session)
+
+    def test_cache_challenge_store(self):
+        with self.settings(
+            PASSKEYS_CHALLENGE_STORE="passkeys.challenge.CacheChallengeStore"
+        ):
+            self._ceremonies_with_handle()
+
+    def test_signed_challenge_store(self):
+        with self.settings(
+            PASSKEYS_CHALLENGE_STORE={
+                "BACKEND": "passkeys.challenge.SignedChallengeStore",
+                "OPTIONS": {"timeout": 60},
+            }
+        ):
+            self._ceremonies_with_handle()
+
+    def test_challenge_state_is_single_use(self):
+        request = self.factory.get("/")
+        store = CacheChallengeStore()
+        handle = store.save(request, {"challenge": "abc"})
+        self.assertEquals(store.pop(request, handle), {"challenge": "abc"})
+        self.assertIsNone(store.pop(request, handle))
+
+        # two completions that both read the state before either deleted it
+        handle = store.save(request, {"challenge": "abc"})
+        with mock.patch.object(store.cache, "get", return_value={"challenge": "abc"}):
+            self.assertEquals(store.pop(request, handle), {"challenge": "abc"})
+            self.assertIsNone(store.pop(request, handle))
+            # Django < 3.1, delete() returns None
+            handle = store.save(request, {"challenge": "abc"})
+            with mock.patch.object(store.cache, "delete", return_value=None):
+                self.assertEquals(store.pop(request, handle), {"challenge": "abc"})
+                self.assertIsNone(store.pop(request, handle))
+
+        store = SignedChallengeStore()
+        handle = store.save(request, {"challenge": "abc"})
+        self.assertIsNone(store.pop(request, handle[:-2]))
+        self.assertEquals(store.pop(request, handle), {"challenge": "abc"})
+        self.assertIsNone(store.pop(request, handle))
+
+        store = SignedChallengeStore(replay_cache=None)
+        handle = store.save(request, {"challenge": "abc"})
+        self.assertEquals(store.pop(request, handle), {"challenge": "abc"})
+        self.assertEquals(store.pop(request, handle), {"challenge": "abc"})
+
+    def _async_request(self, request, user):
+        request.session = self.session
+        request.user = user
+        return request
+
+    @skipIf(django.VERSION < (4, 1), "async views need Django 4.1+")
+    def test_async_ceremonies(self):
+        request = self._async_request(self.factory.get("/"), self.user)
+        j = json.loads(async_to_sync(FIDO2.areg_begin)(request).content)
+        j["publicKey"]["challenge"] = j["publicKey"]["challenge"].encode("ascii")
+        authenticator = SoftWebauthnDevice()
+        res = authenticator.create(j, "https://" + j["publicKey"]["rp"]["id"])
+        request = self.factory.post(
+            "/", data=json.dumps(res), content_type="application/json", HTTP_USER_AGENT=""
+        )
+        r = async_to_sync(FIDO2.areg_complete)(self._async_request(request, self.user))
+        self.assertEquals(json.loads(r.content)["status"], "OK")
+
+        self.session["base_user_id"] = str(self.user.pk)
+        request = self._async_request(self.factory.get("/"), AnonymousUser())
+        j = json.loads(async_to_sync(FIDO2.aauth_begin)(request).content)
+        self.assertEquals(len(j["publicKey"]["allowCredentials"]), 1)
+        j["publicKey"]["challenge"] = j["publicKey"]["challenge"].encode("ascii")
+        res = authenticator.get(j, "https://" + j["publicKey"]["rpId"])
+        request = self.factory.post("/", {"passkeys": json.dumps(res)}, HTTP_USER_AGENT="")
+        request = self._async_request(request, AnonymousUser())
+        user = async_to_sync(FIDO2.aauth_complete)(request)
+        self.assertEquals(user.pk, self.user.pk)
+        self.assertTrue(self.session["passkey"]["passkey"])
+
+    @skipIf(django.VERSION < (4, 1), "async views need Django 4.1+")
+    def test_async_passkey_login(self):
+        from passkeys.views import apasskey_login
+
+        authenticator = self.test_key_reg()
+        self.session["base_user_id"] = str(self.user.pk)
+        request = self._async_request(self.factory.get("/"), AnonymousUser())
+        j = json.loads(async_to_sync(FIDO2.aauth_begin)(request).content)
+        j["publicKey"]["challenge"] = j["publicKey"]["challenge"].encode("ascii")
+        res = authenticator.get(j, "https://" + j["publicKey"]["rpId"])
+        request = self.factory.post(
+            "/", {"passkeys": json.dumps(res), "next": "/home"}, HTTP_USER_AGENT=""
+        )
+        r = async_to_sync(apasskey_login)(self._async_request(request, AnonymousUser()))
+        self.assertEquals(r.status_code, 302)
+        self.assertEquals(r.url, "/home")
+        self.assertEquals(self.session["_auth_user_id"], str(self.user.pk))
+
+    def test_auth_login_url(self):
+        authenticator = self.test_key_reg()
+        self.client.get("/logout")
+        r = self.client.get(reverse("passkeys:auth_begin"))
+        j = json.loads(r.content)
+        j["publicKey"]["challenge"] = j["publicKey"]["challenge"].encode("ascii")
+        res = authenticator.get(j, "https://" + j["publicKey"]["rpId"])
+        r = self.client.post(
+            reverse("passkeys:auth_login"), {"passkeys": json.dumps(res)}, HTTP_USER_AGENT=""
+        )
+        self.assertEquals(r.status_code, 302)
+        self.assertTrue(self.client.session.get("_auth_user_id", False))
+        self.assertEquals(resolve(reverse("passkeys:auth_complete")).func, FIDO2.auth_complete)
+
+    @skipIf(django.VERSION < (4, 1), "async views need Django 4.1+")
+    def test_async_ceremonies_in_process_pool(self):
+        with self.settings(
+            PASSKEYS_VERIFY_EXECUTOR={"KIND": "process", "MAX_WORKERS": 1}
+        ):
+            self.test_async_ceremonies()
+
+    @skipIf(async_to_sync is None, "needs asgiref")
+    def test_verification_queue_is_bounded(self):
+        executor = VerificationExecutor(max_pending=1)
+        self.assertEquals(async_to_sync(executor.run)(len, "ab"), 2)
+        self.assertEquals(executor.depth, 0)
+        executor.max_pending = 0
+        with self.assertRaises(VerificationQueueFull):
+            async_to_sync(executor.run)(len, "ab")
+        executor.shutdown()
+
+    def test_use_async_views(self):
+        with self.settings(PASSKEYS_ASYNC_VIEWS=False, ASGI_APPLICATION="x.application"):
+            self.assertFalse(FIDO2.use_async_views())
+        if django.VERSION >= (4, 1):
+            with self.settings(ASGI_APPLICATION="x.application"):
+                self.assertTrue(FIDO2.use_async_views())
+
+    def test_soft_authenticator_algorithms(self):
+        for algorithm in ("EdDSA", "RS256"):
+            self.client.logout()
+            self.client.force_login(self.user)
+            r = self.client.get(reverse("passkeys:reg_begin"))
+            j = json.loads(r.content)
+            j["publicKey"]["challenge"] = j["publicKey"]["challenge"].encode("ascii")
+            authenticator = SoftWebauthnDevice(algorithm)
+            res = authenticator.create(j, "https://" + j["publicKey"]["rp"]["id"])
+            r = self.client.post(
+                reverse("passkeys:reg_complete"),
+                data=json.dumps(res),
+                HTTP_USER_AGENT="",
+                content_type="application/json",
+            )
+            self.assertEquals(json.loads(r.content)["status"], "OK")
+
+            self.client.logout()
+            r = self.client.get(reverse("passkeys:auth_begin"))
+            j = json.loads(r.content)
+            j["publicKey"]["challenge"] = j["publicKey"]["challenge"].encode("ascii")
+            res = authenticator.get(j, "https://" + j["publicKey"]["rpId"])
+            self.client.post(
+                reverse("passkeys:login.passkey"),
+                {"passkeys": json.dumps(res), "username": "", "password": ""},
+                HTTP_USER_AGENT="",
+            )
+            self.assertTrue(self.client.session.get("_auth_user_id", False))
+
+    def test_algorithms_setting(self):
+        with self.settings(PASSKEYS_ALGORITHMS=["EdDSA", -7]):
+            r = self.client.get(reverse("passkeys:reg_begin"))
+            j = json.loads(r.content)
+            self.assertEquals(
+                j["publicKey"]["pubKeyCredParams"],
+                [{"type": "public-key", "alg": -8}, {"type": "public-key", "alg": -7}],
+            )
+            j["publicKey"]["challenge"] = j["publicKey"]["challenge"].encode("ascii")
+            with self.assertRaises(ValueError):
+                SoftWebauthnDevice("RS256").create(j, "https://" + j["publicKey"]["rp"]["id"])
+        with self.settings(PASSKEYS_ALGORITHMS=["ES256", "nope"]):
+            with self.assertRaises(ImproperlyConfigured):
+                get_server(self.factory.get("/"))
+        r = self.client.get(reverse("passkeys:reg_begin"))
+        self.assertGreater(len(json.loads(r.content)["publicKey"]["pubKeyCredParams"]), 2)
+
+    def test_verification_bench(self):
+        from passkeys.bench import run_verification_benchmark
+
+        report = run_verification_benchmark(rounds=2)
+        self.assertEquals(sorted(report["verification"]), ["ES256", "EdDSA", "RS256"])
+        rs256 = report["verification"]["RS256"]
+        self.assertEquals(rs256["count"], 2)
+        self.assertGreater(rs256["credential_bytes"], report["verification"]["ES256"]["credential_bytes"])
+        json.dumps(report)
+
+    def test_verification_bench_without_settings(self):
+        import os
+        import subprocess
+        import sys
+
+        import passkeys
+
+        env = dict(os.environ)
+        env.pop("DJANGO_SETTINGS_MODULE", None)
+        env["PYTHONPATH"] = os.path.dirname(os.path.dirname(passkeys.__file__))
+        out = subprocess.run(
+            [sys.executable, "-m", "passkeys.bench", "--verify", "2"],
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True,
+        ).stdout
+        self.assertEquals(json.loads(out)["verification"]["ES256"]["count"], 2)
+
+    def test_bench(self):
+        from passkeys.bench import percentile, run_benchmark
+
+        self.assertEquals(percentile([4, 1, 3, 2], 50), 2)
+        self.assertEquals(percentile([4, 1, 3, 2], 99), 4)
+        report = run_benchmark(users=2, keys=2, algorithm="EdDSA", rounds=2, seed=1)
+        self.assertEquals(report["registration"]["count"], 4)
+        self.assertEquals(report["authentication"]["count"], 4)
+        self.assertGreater(report["authentication"]["queries"]["mean"], 0)
+        self.assertEquals(UserPasskey.objects.count(), 6)  # and the warmup user's
+        json.dumps(report)
@@ -0,0 +1,309 @@
+import datetime
+import json
+import re
+from io import StringIO
+from unittest import skipUnless
+
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, RequestFactory, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.urls import reverse
+
+from passkeys import FIDO2, views
+from passkeys.budget import QueryBudgetExceeded, QueryBudgetTestMixin, query_budget
+from passkeys.mail import get_otp_dispatcher
+from passkeys.models import OTP, UserPasskey
+from test_app.soft_webauthn import SoftWebauthnDevice
+
+
+class QueryBudgetTest(QueryBudgetTestMixin, TransactionTestCase):
+    """Runs every passkeys endpoint with PASSKEYS_QUERY_BUDGETS = "raise" """
+
+    def setUp(self):
+        super().setUp()
+        self.user = get_user_model().objects.create_user(
+            username="test", password="test", email="test@test.com"
+        )
+        self.client = Client()
+        self.factory = RequestFactory()
+
+    def _register(self):
+        self.client.force_login(self.user)
+        r = self.client.get(reverse("passkeys:reg_begin"))
+        j = json.loads(r.content)
+        j["publicKey"]["challenge"] = j["publicKey"]["challenge"].encode("ascii")
+        authenticator = SoftWebauthnDevice()
+        res = authenticator.create(j, "https://" + j["publicKey"]["rp"]["id"])
+        r = self.client.post(
+            reverse("passkeys:reg_complete"),
+            data=json.dumps(res),
+            HTTP_USER_AGENT="",
+            content_type="application/json",
+        )
+        self.assertEquals(json.loads(r.content)["status"], "OK")
+        return authenticator
+
+    def test_ceremonies(self):
+        authenticator = self._register()
+        self.client.logout()
+        r = self.client.post(reverse("passkeys:login"), {"email": "test@test.com"})
+        self.assertEquals(r.status_code, 200)
+        r = self.client.get(reverse("passkeys:auth_begin"))
+        j = json.loads(r.content)
+        j["publicKey"]["challenge"] = j["publicKey"]["challenge"].encode("ascii")
+        res = authenticator.get(j, "https://" + j["publicKey"]["rpId"])
+        r = self.client.post(
+            reverse("passkeys:login.passkey"),
+            {"passkeys": json.dumps(res), "username": "", "password": ""},
+            HTTP_USER_AGENT="",
+        )
+        self.assertEquals(r.status_code, 302)
+        r = self.client.get(reverse("passkeys:auth_begin"))
+        self.assertEquals(r.status_code, 200)
+
+    def test_password_login(self):
+        r = self.client.post(
+            reverse("passkeys:login"), {"email": "test@test.com", "password": "test"}
+        )
+        self.assertEquals(r.status_code, 302)
+
+    @override_settings(USE_OTP_LOGIN=True)
+    def test_otp_login(self):
+        r = self.client.post(reverse("passkeys:login.otp"), {"email": "test@test.com"})
+        self.assertEquals(r.status_code, 200)
+        self.assertTrue(get_otp_dispatcher().join(5))
+        code = re.search(r"\d{6}", mail.outbox[0].body).group()
+        r = self.client.post(
+            reverse("passkeys:login.otp"), {"email": "test@test.com", "otp": code}
+        )
+        self.assertEquals(r.status_code, 302)
+
+    def test_manage_keys(self):
+        self._register()
+        key = UserPasskey.objects.get()
+        for name in ("passkeys:home", "passkeys:add"):
+            self.assertEquals(self.client.get(reverse(name)).status_code, 200)
+        for _ in range(2):
+            r = self.client.post(
+                reverse("passkeys:toggle"),
+                json.dumps({"id": key.id}),
+                content_type="application/json",
+            )
+            self.assertEquals(r.status_code, 200)
+        r = self.client.post(
+            reverse("passkeys:delKey"),
+            json.dumps({"id": key.id}),
+            content_type="application/json",
+        )
+        self.assertEquals(r.status_code, 200)
+
+    def test_toggle_key_budget(self):
+        key = UserPasskey.objects.create(user=self.user, credential_id="x", name="x")
+        request = self.factory.post(
+            "/", json.dumps({"id": key.id}), content_type="application/json"
+        )
+        request.user = self.user
+        with self.assertQueryBudget(views.toggle_key) as captured:
+            views.toggle_key(request)
+        self.assertEquals(len(captured), 2)
+        self.assertFalse(UserPasskey.objects.get().enabled)
+
+    def test_every_view_has_a_budget(self):
+        for view in (
+            FIDO2.reg_begin,
+            FIDO2.reg_complete,
+            FIDO2.auth_begin,
+            FIDO2.auth_complete,
+            FIDO2.areg_begin,
+            FIDO2.areg_complete,
+            FIDO2.aauth_begin,
+            FIDO2.aauth_complete,
+            views.login_options,
+            views.passkey_login,
+            views.apasskey_login,
+            views.otp_login,
+            views.index,
+            views.add,
+            views.del_key,
+            views.toggle_key,
+        ):
+            self.assertIsInstance(view.query_budget, int, view.__name__)
+
+    def test_budget_exceeded(self):
+        @query_budget(0)
+        def view(request):
+            return get_user_model().objects.count()
+
+        with self.assertRaises(QueryBudgetExceeded):
+            view(None)
+        with self.settings(PASSKEYS_QUERY_BUDGETS="warn"):
+            with self.assertLogs("passkeys.budget", "WARNING"):
+                self.assertEquals(view(None), 1)
+        with self.settings(PASSKEYS_QUERY_BUDGETS=None):
+            self.assertEquals(view(None), 1)
+
+    def test_async_budget_exceeded(self):
+        from asgiref.sync import async_to_sync
+        from passkeys.utils import sync_to_async
+
+        @query_budget(0)
+        async def view(request):
+            return await sync_to_async(get_user_model().objects.count)()
+
+        with self.assertRaises(QueryBudgetExceeded):
+            async_to_sync(view)(None)
+        with self.settings(PASSKEYS_QUERY_BUDGETS="warn"):
+            with self.assertLogs("passkeys.budget", "WARNING"):
+                self.assertEquals(async_to_sync(view)(None), 1)
+
+
+@override_settings(PASSKEYS_NEGATIVE_LOOKUP={"REBUILD_INTERVAL": 0})
+class NegativeLookupTest(TransactionTestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        from passkeys.bloom import _filters
+
+        cache.clear()
+        _filters.clear()
+        self.user = get_user_model().objects.create_user(
+            username="test", password="test", email="test@test.com"
+        )
+        UserPasskey.objects.create(user=self.user, credential_id="known", name="x")
+
+    def test_bloom_filter(self):
+        from passkeys.bloom import BloomFilter
+
+        bloom = BloomFilter(1000, 0.01)
+        for n in range(1000):
+            bloom.add("user%d" % n)
+        self.assertTrue(all("user%d" % n in bloom for n in range(1000)))
+        false_positives = sum("other%d" % n in bloom for n in range(10000))
+        self.assertLess(false_positives, 300)
+        copy = BloomFilter.loads(bloom.dumps())
+        self.assertTrue(all("user%d" % n in copy for n in range(1000)))
+
+    def test_unknown_values_skip_the_database(self):
+        from passkeys.bloom import might_exist
+        from passkeys.cache import get_credential, get_credential_with_user
+
+        self.assertTrue(might_exist("usernames", "TEST@test.com"))
+        self.assertTrue(might_exist("credentials", "known"))
+        with self.assertNumQueries(0):
+            self.assertFalse(might_exist("usernames", "nobody@test.com"))
+            self.assertIsNone(get_credential("forged"))
+            self.assertEquals(get_credential_with_user("forged"), (None, None))
+        with self.assertNumQueries(0):
+            r = Client().post(reverse("passkeys:login"), {"email": "nobody@test.com"})
+        self.assertEquals(r.status_code, 200)
+
+    def test_new_values_are_found(self):
+        from passkeys.bloom import get_filter, might_exist
+
+        self.assertFalse(might_exist("usernames", "new@test.com"))
+        get_user_model().objects.create_user(
+            username="new", password="new", email="new@test.com"
+        )
+        self.assertTrue(might_exist("usernames", "new@test.com"))
+
+        # Values saved without signals are only found once the filter is invalidated.
+        lookup = get_filter("credentials")
+        self.assertFalse(lookup.might_contain("other"))
+        UserPasskey.objects.bulk_create(
+            [UserPasskey(user=self.user, credential_id="other", name="y")]
+        )
+        self.assertFalse(lookup.might_contain("other"))
+        lookup.invalidate()
+        with self.assertNumQueries(1):
+            self.assertTrue(lookup.might_contain("other"))
+
+    def test_saved_values_update_the_snapshot(self):
+        from passkeys.bloom import NegativeLookupFilter, _usernames, get_filter
+
+        worker = NegativeLookupFilter("usernames", _usernames, rebuild_interval=0)
+        worker.load()
+        stamp = worker.read_stamp()
+        get_user_model().objects.create_user(
+            username="new", password="new", email="new@test.com"
+        )
+        token, version = worker.read_stamp()
+        self.assertEquals((token, version), (stamp[0], stamp[1] + 1))
+        # the other process reloads the snapshot instead of scanning the table
+        with self.assertNumQueries(0):
+            self.assertTrue(worker.might_contain("new@test.com"))
+            self.assertFalse(worker.might_contain("nobody@test.com"))
+        get_filter("usernames").invalidate()
+        self.assertNotEqual(worker.read_stamp()[0], token)
+
+    def test_contended_save_invalidates(self):
+        from passkeys.bloom import get_filter
+
+        lookup = get_filter("usernames")
+        lookup.load()
+        token = lookup.read_stamp()[0]
+        lookup.cache.add(lookup.lock_key, True, 5)
+        with self.assertNumQueries(0):
+            lookup.added("new@test.com")
+        self.assertNotEqual(lookup.read_stamp()[0], token)
+        self.assertTrue(lookup.might_contain("new@test.com"))
+
+    def test_snapshot_is_shared(self):
+        from passkeys.bloom import NegativeLookupFilter, _usernames
+
+        NegativeLookupFilter("usernames", _usernames).load()
+        worker = NegativeLookupFilter("usernames", _usernames)
+        with self.assertNumQueries(0):
+            self.assertTrue(worker.might_contain("test@test.com"))
+            self.assertFalse(worker.might_contain("nobody@test.com"))
+
+    def test_warm_filters(self):
+        from passkeys.bloom import _filters, get_filter, warm_filters
+
+        self.assertEquals(warm_filters(rebuild=False), [])
+        out = StringIO()
+        call_command("passkeys_warm_filters", stdout=out)
+        self.assertEquals(out.getvalue().strip(), "Loaded 2 filter(s)")
+        _filters.clear()
+        with self.assertNumQueries(0):
+            self.assertEquals(warm_filters(rebuild=False), ["usernames", "credentials"])
+            self.assertFalse(get_filter("credentials").might_contain("forged"))
+
+
+@skipUnless(connection.vendor == "sqlite", "checks SQLite query plans")
+class IndexTest(TransactionTestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username="test", password="test", email="test@test.com"
+        )
+
+    def assertUsesIndex(self, queryset, index):
+        plan = queryset.explain()
+        self.assertIn("USING INDEX %s " % index, plan)
+        self.assertNotIn("SCAN", plan)
+
+    def test_index(self):
+        keys = UserPasskey.objects.filter(user=self.user).order_by("-last_used")
+        self.assertUsesIndex(keys, "passkeys_user_last_used_idx")
+        self.assertNotIn("TEMP B-TREE", keys.explain())
+
+    def test_auth_complete(self):
+        from passkeys.cache import _passkeys, get_credential_with_user
+
+        self.assertUsesIndex(
+            _passkeys("known", enabled=True).select_related("user"),
+            "passkeys_enabled_cred_idx",
+        )
+        UserPasskey.objects.create(
+            user=self.user, credential_id="known", name="x", enabled=False
+        )
+        self.assertEquals(get_credential_with_user("known"), (None, None))
+
+    def test_otp_login(self):
+        otp = OTP.objects.filter(
+            key="123456",
+            email="test@test.com",
+            created_at__gte=timezone.now() - datetime.timedelta(seconds=60),
+        )
+        self.assertUsesIndex(otp, "passkeys_otp_email_created_idx")
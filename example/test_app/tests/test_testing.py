@@ -0,0 +1,73 @@
+import json
+import os
+import tempfile
+
+from cryptography.hazmat.primitives import serialization
+from django.contrib.auth import get_user_model
+from django.test import Client, TransactionTestCase
+from django.urls import reverse
+
+from passkeys.models import UserPasskey
+from passkeys.testing import KeyPool, PasskeyTestMixin, SoftAuthenticator
+
+
+def _public_bytes(key):
+    return key.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+
+
+class TestingHelpersTest(PasskeyTestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        User = get_user_model()
+        self.alice = User.objects.create_user(
+            username="alice", password="test", email="alice@test.com"
+        )
+        self.bob = User.objects.create_user(username="bob", password="test", email="bob@test.com")
+
+    def test_key_pool_is_persisted(self):
+        with tempfile.TemporaryDirectory() as path:
+            pool = KeyPool(path, size=2)
+            first, second = pool.keys("EdDSA")
+            self.assertEqual(sorted(os.listdir(path)), ["EdDSA-0.pem", "EdDSA-1.pem"])
+            self.assertIs(pool.take("EdDSA"), first)
+            self.assertIs(pool.take("EdDSA"), second)
+            self.assertIs(pool.take("EdDSA"), first)
+            reloaded = KeyPool(path, size=2).keys("EdDSA")
+            self.assertEqual(
+                [_public_bytes(key) for key in reloaded], [_public_bytes(first), _public_bytes(second)]
+            )
+            with self.assertRaises(ValueError):
+                pool.keys("DSA")
+
+    def test_many_credentials(self):
+        self.register_passkey(self.alice, algorithm="RS256")
+        self.register_passkey(self.bob, client=Client(), algorithm="EdDSA")
+        self.assertEqual(
+            [c.algorithm for c in self.authenticator.credentials], ["RS256", "EdDSA"]
+        )
+        self.assertEqual(
+            self.authenticator.credentials[0].user_handle,
+            UserPasskey.objects.get(user=self.alice).user_handle,
+        )
+
+        client = Client()
+        response = self.login_with_passkey(client=client, discoverable=True)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(client.session["_auth_user_id"], str(self.bob.pk))
+
+        client = Client()
+        response = self.login_with_passkey(self.alice, client=client)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(client.session["_auth_user_id"], str(self.alice.pk))
+        self.assertEqual(self.authenticator.credentials[0].sign_count, 1)
+
+    def test_excluded_credentials(self):
+        self.register_passkey(self.alice)
+        options = json.loads(self.client.get(reverse("passkeys:reg_begin")).content)
+        origin = "https://" + options["publicKey"]["rp"]["id"]
+        with self.assertRaises(ValueError):
+            self.authenticator.create(options, origin)
+        data = SoftAuthenticator("ES256").create(options, origin)
+        self.assertEqual(data["response"]["transports"], ["internal"])
@@ -1,10 +1,28 @@
+import datetime
 import json
+import re
+import socketserver
+import threading
+from io import StringIO
+from unittest.mock import patch
+
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
 from django.test import TransactionTestCase, Client, override_settings, tag
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.template.loader import render_to_string
+from passkeys.mail import ThreadedOTPDispatcher, build_otp_message, get_otp_dispatcher
 from passkeys.models import UserPasskey, OTP
+from passkeys.otp import get_otp_backend
 from .test_fido import test_fido
 from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import check_password
 from passkeys.forms import LoginOptionsForm, PasswordLoginForm
+from passkeys.usage import record_usage
+from django.utils import timezone
 
 class TestViews(TransactionTestCase):
 
@@ -92,6 +110,22 @@ class LoginOptionsViewTest(TransactionTestCase):
             response, expected_url="/passkeys/", status_code=302, target_status_code=200
         )
 
+    def test_password_is_hashed_once(self):
+        from unittest import mock
+
+        with mock.patch(
+            "django.contrib.auth.base_user.check_password", wraps=check_password
+        ) as hashed:
+            response = self.client.post(
+                self.login_options_url, {"email": self.user.email, "password": "testpassword"}
+            )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(hashed.call_count, 1)
+        self.assertEqual(
+            self.client.session["_auth_user_backend"],
+            "django.contrib.auth.backends.ModelBackend",
+        )
+
     def test_post_login_options_with_invalid_password(self):
         response = self.client.post(
             self.login_options_url,
@@ -143,7 +177,7 @@ class OTPLoginViewTest(TransactionTestCase):
         response = self.client.get(self.otp_login_url)
         self.assertEqual(response.status_code, 405)
     def test_post_otp_login_with_valid_otp(self):
-        OTP.objects.create(key="123456", email=self.user.email)
+        get_otp_backend().create(self.user.email, "123456")
         response = self.client.post(
             self.otp_login_url,
             {
@@ -157,7 +191,7 @@ class OTPLoginViewTest(TransactionTestCase):
             response, expected_url="/passkeys/", status_code=302, target_status_code=200
         )
     def test_post_otp_login_with_invalid_otp(self):
-        OTP.objects.create(key="123456", email=self.user.email)
+        get_otp_backend().create(self.user.email, "123456")
 
         response = self.client.post(
             self.otp_login_url,
@@ -167,13 +201,77 @@ class OTPLoginViewTest(TransactionTestCase):
             },
         )
 
-        self.assertFormError(
-            response,
-            "form",
-            "otp",
-            "Your OTP code is either expired or invalid. Ask a new one.",
+        # The view drops the otp field after adding the error.
+        self.assertEqual(
+            response.context["form"].errors["otp"],
+            ["Your OTP code is either expired or invalid. Ask a new one."],
         )
-        
+
+    def test_otp_is_single_use(self):
+        get_otp_backend().create(self.user.email, "123456")
+        self.assertTrue(OTP.objects.get().key != "123456")
+        data = {"otp": "123456", "email": self.user.email, "next": "/passkeys/"}
+        self.assertEqual(self.client.post(self.otp_login_url, data).status_code, 302)
+        self.client.logout()
+        self.assertEqual(self.client.post(self.otp_login_url, data).status_code, 200)
+        self.assertFalse(OTP.objects.exists())
+
+    def test_otp_from_email(self):
+        self.client.post(self.otp_login_url, {"email": self.user.email})
+        self.assertTrue(get_otp_dispatcher().join(5))
+        code = re.search(r"\d{6}", mail.outbox[0].body).group()
+        response = self.client.post(
+            self.otp_login_url, {"otp": code, "email": self.user.email, "next": "/passkeys/"}
+        )
+        self.assertEqual(response.status_code, 302)
+
+    def test_outstanding_otps_are_capped(self):
+        backend = get_otp_backend()
+        codes = [backend.create(self.user.email, "%06d" % n) for n in range(8)]
+        self.assertEqual(OTP.objects.filter(email=self.user.email).count(), 5)
+        self.assertFalse(backend.consume(self.user.email, codes[0]))
+        self.assertTrue(backend.consume(self.user.email, codes[-1]))
+        expired = {"BACKEND": "passkeys.otp.DatabaseOTPBackend", "OPTIONS": {"timeout": 0}}
+        with self.settings(PASSKEYS_OTP_BACKEND=expired):
+            code = get_otp_backend().create(self.user.email)
+            self.assertFalse(get_otp_backend().consume(self.user.email, code))
+            # creating a code deletes the expired ones
+            self.assertEqual(OTP.objects.filter(email=self.user.email).count(), 1)
+
+    @override_settings(
+        PASSKEYS_OTP_BACKEND={
+            "BACKEND": "passkeys.otp.CacheOTPBackend",
+            "OPTIONS": {"max_outstanding": 2},
+        }
+    )
+    def test_cache_otp_backend(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        backend = get_otp_backend()
+        codes = [backend.create(self.user.email, code) for code in ("111111", "222222", "333333")]
+        self.assertFalse(OTP.objects.exists())
+        self.assertFalse(backend.consume(self.user.email, codes[0]))
+        self.assertFalse(backend.consume("other@example.com", codes[2]))
+        self.assertTrue(backend.consume(self.user.email, codes[2]))
+        self.assertFalse(backend.consume(self.user.email, codes[2]))
+        response = self.client.post(
+            self.otp_login_url, {"otp": codes[1], "email": self.user.email, "next": "/passkeys/"}
+        )
+        self.assertEqual(response.status_code, 302)
+
+        # each code has its own key, storing one never rewrites the others
+        with patch.object(cache, "set", wraps=cache.set) as stored:
+            backend.create(self.user.email, "444444")
+            backend.create(self.user.email, "555555")
+        self.assertEqual(len({call.args[0] for call in stored.call_args_list}), 2)
+        self.assertTrue(backend.consume(self.user.email, "444444"))
+        self.assertTrue(backend.consume(self.user.email, "555555"))
+        cache.delete(backend._email_key(self.user.email) + ":seq")
+        code = backend.create(self.user.email, "666666")
+        cache.delete(backend._email_key(self.user.email) + ":seq")
+        self.assertFalse(backend.consume(self.user.email, code))
+
     def test_post_otp_login_without_otp(self):
         self.assertFalse(OTP.objects.filter(email=self.user.email).exists())
         self.client.post(
@@ -317,3 +415,337 @@ class AddViewTest(TransactionTestCase):
         response = self.client.get(self.add_url)
 
         self.assertEqual(response.status_code, 302)  # Redirects to login page
+
+
+class UsageBufferTest(TransactionTestCase):
+
+    def setUp(self):
+        user = get_user_model().objects.create_user(
+            username="testuser", password="testpassword", email="test@test.com"
+        )
+        self.key = UserPasskey.objects.create(user=user, credential_id="key1", name="test")
+
+    def assertBuffered(self):
+        now = timezone.now()
+        record_usage(self.key.id, last_used=now)
+        record_usage(self.key.id, last_used=now)
+        self.assertIsNone(UserPasskey.objects.get(id=self.key.id).last_used)
+        out = StringIO()
+        call_command("passkeys_flush_usage", stdout=out)
+        self.assertEqual(out.getvalue().strip(), "Flushed usage of 1 passkey(s)")
+        self.assertEqual(UserPasskey.objects.get(id=self.key.id).last_used, now)
+
+    def test_immediate_write(self):
+        now = timezone.now()
+        with self.assertNumQueries(1):
+            record_usage(self.key.id, last_used=now)
+        self.assertEqual(UserPasskey.objects.get(id=self.key.id).last_used, now)
+
+    def test_process_buffer(self):
+        with self.settings(
+            PASSKEYS_USAGE_BUFFER={
+                "BACKEND": "passkeys.usage.ProcessUsageBuffer",
+                "OPTIONS": {"flush_interval": 3600},
+            }
+        ):
+            self.assertBuffered()
+
+    def test_process_buffer_timer(self):
+        from passkeys.usage import ProcessUsageBuffer
+
+        buffer = ProcessUsageBuffer(flush_interval=0.1)
+        now = timezone.now()
+        buffer.record(self.key.id, last_used=now)
+        timer = buffer._timer
+        timer.join(5)
+        self.assertFalse(timer.is_alive())
+        self.assertIsNone(buffer._timer)
+        self.assertEqual(UserPasskey.objects.get(id=self.key.id).last_used, now)
+
+    def test_cache_buffer(self):
+        with self.settings(
+            PASSKEYS_USAGE_BUFFER={
+                "BACKEND": "passkeys.usage.CacheUsageBuffer",
+                "OPTIONS": {"flush_interval": 3600},
+            }
+        ):
+            call_command("passkeys_flush_usage", stdout=StringIO())
+            self.assertBuffered()
+
+    def test_cache_buffer_waits_for_late_items(self):
+        from django.core.cache import cache
+        from passkeys.usage import CacheUsageBuffer
+
+        cache.clear()
+        buffer = CacheUsageBuffer(flush_interval=3600)
+        now = timezone.now()
+        buffer.record(self.key.id, last_used=now)  # the first record flushes
+        # a record() between incr() and set() while the flush runs
+        late = cache.incr(buffer.prefix + "seq")
+        buffer.record(self.key.id, last_used=now)
+        self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(cache.get(buffer.prefix + "flushed"), late - 1)
+        self.assertIsNotNone(cache.get(buffer.prefix + "item:%d" % (late + 1)))
+
+        later = now + datetime.timedelta(seconds=1)
+        cache.set(buffer.prefix + "item:%d" % late, (self.key.id, {"last_used": later}), 60)
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(cache.get(buffer.prefix + "flushed"), late + 1)
+        self.assertEqual(UserPasskey.objects.get(id=self.key.id).last_used, now)
+
+        # an item still missing from the second flush is lost
+        late = cache.incr(buffer.prefix + "seq")
+        buffer.flush()
+        self.assertEqual(cache.get(buffer.prefix + "flushed"), late - 1)
+        buffer.flush()
+        self.assertEqual(cache.get(buffer.prefix + "flushed"), late)
+
+
+class PurgeTest(TransactionTestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username="testuser", password="testpassword", email="test@test.com"
+        )
+        old = timezone.now() - datetime.timedelta(days=100)
+        for n in range(5):
+            UserPasskey.objects.create(user=self.user, credential_id="old%d" % n, name="old")
+        UserPasskey.objects.filter(credential_id__in=["old0", "old1"]).update(enabled=False)
+        UserPasskey.objects.update(added_on=old)
+        UserPasskey.objects.filter(credential_id="old4").update(last_used=timezone.now())
+        UserPasskey.objects.create(user=self.user, credential_id="new", name="new")
+        for n in range(3):
+            get_otp_backend().create("test%d@test.com" % n)
+        OTP.objects.filter(email="test0@test.com").update(created_at=old)
+
+    def test_purge(self):
+        from passkeys.purge import purge
+
+        counts = purge(
+            otps=datetime.timedelta(seconds=60),
+            disabled=datetime.timedelta(days=30),
+            dry_run=True,
+        )
+        self.assertEqual(counts, {"otps": 1, "disabled": 2})
+        self.assertEqual(UserPasskey.objects.count(), 6)
+
+        with CaptureQueriesContext(connection) as captured:
+            counts = purge(
+                otps=datetime.timedelta(seconds=60),
+                unused_since=timezone.now() - datetime.timedelta(days=30),
+                batch_size=2,
+            )
+        self.assertEqual(counts, {"otps": 1, "unused": 4})
+        self.assertEqual(
+            sorted(UserPasskey.objects.values_list("credential_id", flat=True)), ["new", "old4"]
+        )
+        self.assertEqual(OTP.objects.count(), 2)
+        deletes = [q["sql"] for q in captured.captured_queries if q["sql"].startswith("DELETE")]
+        self.assertEqual(len(deletes), 3)  # one for the OTP, one per chunk of two passkeys
+
+    def test_purge_command(self):
+        out = StringIO()
+        call_command("passkeys_purge", "--disabled", "30", "--dry-run", stdout=out)
+        self.assertEqual(
+            out.getvalue().splitlines(), ["Would delete 1 otps", "Would delete 2 disabled"]
+        )
+        out = StringIO()
+        since = (timezone.now() - datetime.timedelta(days=30)).date().isoformat()
+        call_command("passkeys_purge", "--unused-since", since, "--batch-size", "3", stdout=out)
+        self.assertEqual(out.getvalue().splitlines(), ["Deleted 1 otps", "Deleted 4 unused"])
+        self.assertEqual(UserPasskey.objects.count(), 2)
+
+
+sent_by_task = []
+
+
+def send_task(email, code):
+    sent_by_task.append((email, code))
+
+
+class SMTPStub(socketserver.StreamRequestHandler):
+    """Just enough of SMTP for Django's smtp backend, fails the DATA of `fail` messages"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self.reply("220 stub")
+        for line in self.rfile:
+            command = line.decode("ascii").strip().upper()
+            if command == "DATA":
+                self.reply("354 go ahead")
+                data = b"".join(iter(self.rfile.readline, b".\r\n"))
+                if server.fail:
+                    server.fail -= 1
+                    self.reply("451 try again")
+                    return
+                server.messages.append(data)
+                self.reply("250 queued")
+            elif command == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 ok")
+
+
+class OTPDispatcherTest(TransactionTestCase):
+
+    def test_threaded_dispatcher(self):
+        dispatcher = ThreadedOTPDispatcher()
+        with patch("passkeys.mail.render_to_string", wraps=render_to_string) as render:
+            for n in range(3):
+                dispatcher.dispatch("test%d@test.com" % n, "12345%d" % n)
+        self.assertEqual(render.call_count, 3)
+        self.assertTrue(dispatcher.join(5))
+        dispatcher.shutdown()
+        sent = {m.to[0]: m for m in mail.outbox}
+        self.assertEqual(sorted(sent), ["test0@test.com", "test1@test.com", "test2@test.com"])
+        self.assertIn("123450", sent["test0@test.com"].body)
+        self.assertIn("123450", sent["test0@test.com"].alternatives[0][0])
+
+    def test_full_queue_drops_codes(self):
+        dispatcher = ThreadedOTPDispatcher(max_workers=0, max_pending=1)
+        dispatcher.dispatch("test@test.com", "123456")
+        with self.assertLogs("passkeys.mail", "ERROR"):
+            dispatcher.dispatch("test@test.com", "654321")
+        self.assertFalse(dispatcher.join(0))
+
+    def test_exit_drains_the_current_dispatcher(self):
+        from passkeys.mail import _drain_at_exit
+
+        with patch("atexit.register") as register:
+            ThreadedOTPDispatcher()
+        register.assert_not_called()
+        with patch.object(get_otp_dispatcher(), "join") as join:
+            _drain_at_exit()
+        join.assert_called_once_with(10)
+
+    @override_settings(
+        PASSKEYS_OTP_DISPATCHER={
+            "BACKEND": "passkeys.mail.TaskOTPDispatcher",
+            # wherever the test runner imported this module from
+            "OPTIONS": {"task": __name__ + ".send_task"},
+        }
+    )
+    def test_task_dispatcher(self):
+        get_user_model().objects.create_user(
+            username="test", password="test", email="test@test.com"
+        )
+        self.client.post(reverse("passkeys:login.otp"), {"email": "test@test.com"})
+        email, code = sent_by_task.pop()
+        self.assertEqual(email, "test@test.com")
+        self.assertTrue(get_otp_backend().consume(email, code))
+        self.assertEqual(mail.outbox, [])
+
+    def test_smtp_connection_is_reused(self):
+        server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), SMTPStub)
+        server.daemon_threads = True
+        server.connections, server.messages, server.fail = 0, [], 1
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        with self.settings(
+            EMAIL_BACKEND="django.core.mail.backends.smtp.EmailBackend",
+            EMAIL_HOST="127.0.0.1",
+            EMAIL_PORT=server.server_address[1],
+        ):
+            dispatcher = ThreadedOTPDispatcher(backoff=0)
+            dispatcher.send_batch(
+                [build_otp_message("test%d@test.com" % n, "12345%d" % n) for n in range(3)]
+            )
+        # the first message failed once and was sent again on a new connection
+        self.assertEqual(len(server.messages), 3)
+        self.assertEqual(server.connections, 2)
+
+
+class RateLimitTest(TransactionTestCase):
+
+    def setUp(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        # a fresh limiter for every test
+        limiter = override_settings(PASSKEYS_RATE_LIMITER="passkeys.ratelimit.TokenBucketLimiter")
+        limiter.enable()
+        self.addCleanup(limiter.disable)
+        get_user_model().objects.create_user(
+            username="test", password="test", email="test@test.com"
+        )
+
+    def test_parse_rate(self):
+        from passkeys.ratelimit import parse_rate
+
+        self.assertEqual(parse_rate("10/m"), (10, 60))
+        self.assertEqual(parse_rate("100 / 5m"), (100, 300))
+        with self.assertRaises(ImproperlyConfigured):
+            parse_rate("10 per minute")
+
+    @override_settings(PASSKEYS_RATE_LIMITS={"auth_begin": "2/m"})
+    def test_auth_begin(self):
+        client = Client(REMOTE_ADDR="10.0.0.1")
+        for _ in range(2):
+            self.assertEqual(client.get(reverse("passkeys:auth_begin")).status_code, 200)
+        with self.assertNumQueries(0):
+            response = client.get(reverse("passkeys:auth_begin"))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(json.loads(response.content)["status"], "ERR")
+        self.assertTrue(1 <= int(response["Retry-After"]) <= 30)
+        other = Client(REMOTE_ADDR="10.0.0.2")
+        self.assertEqual(other.get(reverse("passkeys:auth_begin")).status_code, 200)
+
+    def assertLimitedByUser(self):
+        url = reverse("passkeys:login")
+        for n in range(3):
+            response = Client(REMOTE_ADDR="10.0.0.%d" % n).post(url, {"email": "TEST@test.com"})
+            self.assertEqual(response.status_code, 200)
+        response = Client(REMOTE_ADDR="10.0.0.9").post(url, {"email": "test@test.com"})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response)
+        response = Client(REMOTE_ADDR="10.0.0.9").post(url, {"email": "other@test.com"})
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(
+        PASSKEYS_RATE_LIMITS={"login_options": {"RATE": "3/h", "KEYS": ["ip", "user"]}}
+    )
+    def test_token_bucket_by_user(self):
+        self.assertLimitedByUser()
+
+    @override_settings(
+        PASSKEYS_RATE_LIMITS={"login_options": {"RATE": "3/h", "KEYS": "user"}},
+        PASSKEYS_RATE_LIMITER={
+            "BACKEND": "passkeys.ratelimit.CacheRateLimiter",
+            "OPTIONS": {"alias": "default"},
+        },
+    )
+    def test_cache_sliding_window(self):
+        self.assertLimitedByUser()
+
+    def test_sliding_window_retry_after(self):
+        from passkeys.ratelimit import CacheRateLimiter
+
+        # 10 hits in the previous minute still weigh 5 halfway through this one
+        self.assertEqual(CacheRateLimiter._retry_after(5, 10, 30, 10, 60), 0)
+        self.assertEqual(CacheRateLimiter._retry_after(6, 10, 30, 10, 60), 6)
+        self.assertEqual(CacheRateLimiter._retry_after(11, 0, 30, 10, 60), 30)
+
+    @override_settings(PASSKEYS_RATE_LIMITS={"otp_login": "1/m"}, USE_OTP_LOGIN=True)
+    def test_otp_login(self):
+        url = reverse("passkeys:login.otp")
+        self.assertEqual(self.client.post(url, {"email": "test@test.com"}).status_code, 200)
+        self.assertEqual(self.client.post(url, {"email": "test@test.com"}).status_code, 429)
+        self.assertEqual(OTP.objects.count(), 1)
+
+    @override_settings(PASSKEYS_RATE_LIMITS={"auth_begin": "1/m"})
+    def test_async_view(self):
+        from asgiref.sync import async_to_sync
+        from django.test import RequestFactory
+        from passkeys.FIDO2 import aauth_begin
+        from passkeys.ratelimit import get_rate_limiter
+
+        get_rate_limiter().hit("auth_begin:ip:10.0.0.1", 1, 60)
+        request = RequestFactory().get("/", REMOTE_ADDR="10.0.0.1")
+        response = async_to_sync(aauth_begin)(request)
+        self.assertEqual(response.status_code, 429)
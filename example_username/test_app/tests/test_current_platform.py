@@ -1,6 +1,9 @@
-from django.test import TestCase, RequestFactory
+from unittest import mock
+
+from django.test import TestCase, RequestFactory, override_settings
 
 from passkeys.FIDO2 import get_current_platform
+from passkeys.platform import UserAgentPlatformDetector, get_platform_detector
 
 
 class TestCurrentPlatform(TestCase):
@@ -9,8 +12,8 @@ class TestCurrentPlatform(TestCase):
         if not getattr(self, "assertEquals", None):
             self.assertEquals = self.assertEqual
 
-    def check_platform(self,user_agent, platform):
-        request = self.request_factory.get('/', HTTP_USER_AGENT=user_agent)
+    def check_platform(self,user_agent, platform, **headers):
+        request = self.request_factory.get('/', HTTP_USER_AGENT=user_agent, **headers)
         self.assertEquals(get_current_platform(request), platform)
 
     def test_mac(self):
@@ -30,3 +33,57 @@ class TestCurrentPlatform(TestCase):
         self.check_platform("Mozilla/5.0 (Linux; Android 10) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.5735.130 Mobile Safari/537.36","Google")
         self.check_platform("Mozilla/5.0 (Linux; Android 10; SM-A205U) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.5735.130 Mobile Safari/537.36","Google")
         self.check_platform("Mozilla/5.0 (Linux; Android 10; LM-Q720) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.5735.130 Mobile Safari/537.36","Google")
+
+    def test_missing_user_agent(self):
+        self.assertEquals(get_current_platform(self.request_factory.get('/')), "Key")
+        self.check_platform("", "Key")
+
+    def test_client_hints(self):
+        chrome = '"Chromium";v="124", "Google Chrome";v="124", "Not-A.Brand";v="99"'
+        edge = '"Chromium";v="124", "Microsoft Edge";v="124", "Not-A.Brand";v="99"'
+        with mock.patch.object(UserAgentPlatformDetector, "from_user_agent") as parse:
+            self.check_platform("", "Chrome on Apple", HTTP_SEC_CH_UA_PLATFORM='"macOS"', HTTP_SEC_CH_UA=chrome)
+            self.check_platform("", "Chrome on Apple", HTTP_SEC_CH_UA_PLATFORM='"macOS"', HTTP_SEC_CH_UA=edge)
+            self.check_platform("", "Key", HTTP_SEC_CH_UA_PLATFORM='"macOS"', HTTP_SEC_CH_UA='"Not-A.Brand";v="99"')
+            self.check_platform("", "Microsoft", HTTP_SEC_CH_UA_PLATFORM='"Windows"', HTTP_SEC_CH_UA=edge)
+            self.check_platform("", "Google", HTTP_SEC_CH_UA_PLATFORM='"Android"', HTTP_SEC_CH_UA=chrome)
+            self.check_platform("", "Key", HTTP_SEC_CH_UA_PLATFORM='"Linux"', HTTP_SEC_CH_UA=chrome)
+        parse.assert_not_called()
+
+    def test_client_hints_match_user_agent(self):
+        hints = {
+            "Edge": '"Chromium";v="120", "Microsoft Edge";v="120", "Not-A.Brand";v="99"',
+            "Opera": '"Chromium";v="120", "Opera";v="106", "Not-A.Brand";v="99"',
+            "Chrome": '"Chromium";v="120", "Google Chrome";v="120", "Not-A.Brand";v="99"',
+        }
+        user_agents = {
+            "Edge": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36 Edg/120.0.0.0",
+            "Opera": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36 OPR/106.0.0.0",
+            "Chrome": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+        }
+        for browser, brands in hints.items():
+            with self.subTest(browser):
+                self.check_platform("", "Chrome on Apple", HTTP_SEC_CH_UA_PLATFORM='"macOS"', HTTP_SEC_CH_UA=brands)
+                self.check_platform(user_agents[browser], "Chrome on Apple")
+
+    @override_settings(PASSKEYS_PLATFORM_DETECTOR={"BACKEND": "passkeys.platform.UserAgentPlatformDetector", "OPTIONS": {"cache_size": 1}})
+    def test_parsed_user_agents_are_cached(self):
+        windows = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36"
+        android = "Mozilla/5.0 (Linux; Android 10) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.5735.130 Mobile Safari/537.36"
+        detector = get_platform_detector()
+        with mock.patch.object(detector, "from_user_agent", wraps=detector.from_user_agent) as parse:
+            self.check_platform(windows, "Microsoft")
+            self.check_platform(windows, "Microsoft")
+            self.assertEquals(parse.call_count, 1)
+            self.check_platform(android, "Google")
+            self.check_platform(windows, "Microsoft")
+            self.assertEquals(parse.call_count, 3)
+
+    @override_settings(PASSKEYS_PLATFORM_DETECTOR="test_app.tests.test_current_platform.FixedPlatformDetector")
+    def test_custom_detector(self):
+        self.check_platform("", "Fixed")
+
+
+class FixedPlatformDetector:
+    def detect(self, request):
+        return "Fixed"
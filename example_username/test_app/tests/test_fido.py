@@ -151,6 +151,22 @@ class test_fido(TransactionTestCase):
     def test_passkey_login_no_session(self):
         pass
 
+    def test_discoverable_login(self):
+        authenticator = self.test_key_reg()
+        key = UserPasskey.objects.latest("id")
+        self.assertEquals(key.user_handle, authenticator.user_handle)
+
+        client = Client()
+        r = client.get(reverse("passkeys:auth_begin"), {"mode": "discoverable"})
+        j = json.loads(r.content)
+        self.assertFalse(j["publicKey"].get("allowCredentials"))
+        j["publicKey"]["challenge"] = j["publicKey"]["challenge"].encode("ascii")
+        res = authenticator.get(j, "https://" + j["publicKey"]["rpId"])
+        client.post(
+            reverse("passkeys:login.passkey"), {"passkeys": json.dumps(res)}, HTTP_USER_AGENT=""
+        )
+        self.assertEquals(client.session["_auth_user_id"], str(self.user.pk))
+
     def test_server_id_callable(self):
         from test_app.tests.test_fido import get_server_id
 
@@ -56,3 +56,64 @@ class test_passkeys(TransactionTestCase):
             reverse("passkeys:login"), {"username": "", "password": "", "passkeys": ""}
         )
         self.assertFalse(self.client.session.get("_auth_user_id", False))
+
+    def test_backend_path(self):
+        from django.test import override_settings
+        from passkeys.utils import get_backend_path
+
+        self.assertEquals(
+            get_backend_path("PasskeyModelBackend"), "passkeys.backend.PasskeyModelBackend"
+        )
+        with override_settings(AUTHENTICATION_BACKENDS=["test_app.PasskeyModelBackend"]):
+            self.assertEquals(
+                get_backend_path("PasskeyModelBackend"), "test_app.PasskeyModelBackend"
+            )
+
+    def test_ready(self):
+        from unittest import mock
+        from django.apps import apps
+        from django.core.exceptions import ImproperlyConfigured
+        from django.test import override_settings
+        from passkeys.platform import UserAgentPlatformDetector
+
+        config = apps.get_app_config("passkeys")
+        with mock.patch.object(UserAgentPlatformDetector, "preload") as preload:
+            config.ready()
+            preload.assert_not_called()
+            with override_settings(PASSKEYS_PRELOAD=True):
+                config.ready()
+            preload.assert_called_once_with()
+        with override_settings(), self.assertRaises(ImproperlyConfigured):
+            from django.conf import settings
+
+            del settings.FIDO_SERVER_ID
+            config.ready()
+
+    def test_cached_user(self):
+        from django.contrib.auth import get_user
+        from django.core.cache import cache
+        from django.test import override_settings
+
+        cache.clear()
+        self.client.force_login(self.user, backend="passkeys.backend.PasskeyModelBackend")
+        request = self.factory.get("/")
+        request.session = self.client.session
+        with override_settings(PASSKEYS_USER_CACHE={"TIMEOUT": 60, "FIELDS": ["email"]}):
+            self.assertEquals(get_user(request), self.user)
+            with self.assertNumQueries(0):
+                user = get_user(request)
+                self.assertEquals((user.pk, user.email, user.is_active), (self.user.pk, "", True))
+            with self.assertNumQueries(1):  # not in the snapshot
+                self.assertEquals(user.first_name, "")
+
+            # a new password invalidates the snapshot and the session
+            self.user.set_password("new")
+            self.user.save()
+            self.assertFalse(get_user(request).is_authenticated)
+
+            self.client.force_login(self.user, backend="passkeys.backend.PasskeyModelBackend")
+            request.session = self.client.session
+            self.assertEquals(get_user(request), self.user)
+            self.user_model.objects.filter(pk=self.user.pk).update(is_active=False)
+            cache.clear()
+            self.assertFalse(get_user(request).is_authenticated)
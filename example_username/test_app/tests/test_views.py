@@ -4,6 +4,7 @@ from django.urls import reverse
 from passkeys.models import UserPasskey, OTP
 from .test_fido import test_fido
 from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import check_password
 from passkeys.forms import LoginOptionsForm, PasswordLoginForm
 
 class TestViews(TransactionTestCase):
@@ -92,6 +93,22 @@ class LoginOptionsViewTest(TransactionTestCase):
             response, expected_url="/passkeys/", status_code=302, target_status_code=200
         )
 
+    def test_password_is_hashed_once(self):
+        from unittest import mock
+
+        with mock.patch(
+            "django.contrib.auth.base_user.check_password", wraps=check_password
+        ) as hashed:
+            response = self.client.post(
+                self.login_options_url, {"username": self.user.username, "password": "testpassword"}
+            )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(hashed.call_count, 1)
+        self.assertEqual(
+            self.client.session["_auth_user_backend"],
+            "django.contrib.auth.backends.ModelBackend",
+        )
+
     def test_post_login_options_with_invalid_password(self):
         response = self.client.post(
             self.login_options_url,
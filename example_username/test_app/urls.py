@@ -18,6 +18,6 @@ from django.contrib import admin
 from django.urls import path, include
 
 urlpatterns = [
-    path("", admin.site.urls),
     path("passkeys/", include("passkeys.urls")),
+    path("", admin.site.urls),
 ]
@@ -1,25 +1,50 @@
+import binascii
 import json
 import uuid
 from base64 import urlsafe_b64encode
 import traceback
 
+import django
 import fido2.features
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.http import JsonResponse
 from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
+from fido2.cose import CoseKey, UnsupportedKey
 from fido2.server import Fido2Server
 from fido2.utils import websafe_decode, websafe_encode
 from fido2.webauthn import (
     PublicKeyCredentialRpEntity,
+    PublicKeyCredentialDescriptor,
+    PublicKeyCredentialParameters,
+    PublicKeyCredentialType,
+    PublicKeyCredentialUserEntity,
     AttestedCredentialData,
+    AuthenticatorData,
+    AuthenticatorTransport,
+)
+from .cache import LRUCache, aget_credential_with_user, get_credential_with_user
+from .challenge import get_challenge_store
+from .executor import (
+    VerificationQueueFull,
+    get_verification_executor,
+    verify_authentication,
+    verify_registration,
 )
 from .models import UserPasskey
-from user_agents.parsers import parse as ua_parse
+from .budget import query_budget
+from .ratelimit import rate_limit
+from .platform import get_platform_detector
+from .usage import arecord_usage, record_usage
+from .utils import aget_user, asession_get, asession_set
 
 
 def enable_json_mapping():
+    """Opts in to fido2's JSON mapping, done once by PasskeysConfig.ready()"""
     try:
         fido2.features.webauthn_json_mapping.enabled = True
     except:
@@ -31,13 +56,75 @@ def get_user_credentials(user):
     username_field = User.USERNAME_FIELD
     filter_args = {"user__" + username_field: user}
     return [
-        AttestedCredentialData(websafe_decode(uk.token))
+        AttestedCredentialData(uk.attested_credential_data)
         for uk in UserPasskey.objects.filter(**filter_args)
     ]
 
 
-def get_server(request=None):
-    """Get Server Info from settings and returns a Fido2Server"""
+_servers = LRUCache(getattr(settings, "FIDO_SERVER_CACHE_SIZE", 128))
+
+
+def clear_server_cache():
+    """Drop every cached Fido2Server, e.g. after the FIDO settings changed"""
+    _servers.clear()
+    _servers.max_size = getattr(settings, "FIDO_SERVER_CACHE_SIZE", 128)
+
+
+@receiver(setting_changed)
+def _reset_servers(setting, **kwargs):
+    if setting in (
+        "FIDO_SERVER_ID",
+        "FIDO_SERVER_NAME",
+        "FIDO_SERVER_CACHE_SIZE",
+        "PASSKEYS_ALGORITHMS",
+    ):
+        clear_server_cache()
+
+
+_TRANSPORTS = {transport.value for transport in AuthenticatorTransport}
+
+
+def _parse_transports(data):
+    """The known transports of a registration response, as stored in UserPasskey.transports"""
+    transports = data.get("response", {}).get("transports")
+    if not isinstance(transports, (list, tuple)):
+        return None
+    return ",".join(t for t in transports if t in _TRANSPORTS) or None
+
+
+def _descriptor(raw, credential_id, transports):
+    return PublicKeyCredentialDescriptor(
+        type=PublicKeyCredentialType.PUBLIC_KEY,
+        id=bytes(raw) if raw is not None else websafe_decode(credential_id),
+        transports=(
+            [AuthenticatorTransport(t) for t in transports.split(",")] if transports else None
+        ),
+    )
+
+
+_DESCRIPTOR_FIELDS = ("raw_credential_id", "credential_id", "transports")
+
+
+def _user_passkeys(user_id=None, username=None):
+    if user_id is not None:
+        return UserPasskey.objects.filter(user_id=user_id)
+    username_field = get_user_model().USERNAME_FIELD
+    return UserPasskey.objects.filter(**{"user__" + username_field: username})
+
+
+def get_credential_descriptors(user_id=None, username=None):
+    """Returns the PublicKeyCredentialDescriptors of a user's passkeys.
+
+    Only the raw credential ids and the transports are read, the credential data is
+    not parsed. Pass the user's pk as user_id, username (the USERNAME_FIELD value)
+    costs a join.
+    """
+    keys = _user_passkeys(user_id, username).values_list(*_DESCRIPTOR_FIELDS)
+    return [_descriptor(*key) for key in keys]
+
+
+def get_rp(request=None):
+    """Returns the (rp_id, rp_name) pair from FIDO_SERVER_ID and FIDO_SERVER_NAME"""
     if callable(settings.FIDO_SERVER_ID):
         fido_server_id = settings.FIDO_SERVER_ID(request)
     else:
@@ -47,142 +134,389 @@ def get_server(request=None):
         fido_server_name = settings.FIDO_SERVER_NAME(request)
     else:
         fido_server_name = settings.FIDO_SERVER_NAME
+    return fido_server_id, fido_server_name
+
+
+def get_algorithms():
+    """The PublicKeyCredentialParameters of PASSKEYS_ALGORITHMS, None if it isn't set.
+
+    The setting lists COSE algorithm names (e.g. "EdDSA", "ES256") or identifiers
+    (e.g. -8, -7) in order of preference. Registrations offer them in that order and
+    authenticators pick the first one they support.
+    """
+    algorithms = getattr(settings, "PASSKEYS_ALGORITHMS", None)
+    if algorithms is None:
+        return None
+    parameters = []
+    for algorithm in algorithms:
+        if isinstance(algorithm, str):
+            cose = CoseKey.for_name(algorithm)
+        else:
+            cose = CoseKey.for_alg(algorithm)
+        if cose is UnsupportedKey:
+            raise ImproperlyConfigured("Unsupported PASSKEYS_ALGORITHMS entry %r" % algorithm)
+        parameters.append(
+            PublicKeyCredentialParameters(
+                type=PublicKeyCredentialType.PUBLIC_KEY, alg=cose.ALGORITHM
+            )
+        )
+    if not parameters:
+        raise ImproperlyConfigured("PASSKEYS_ALGORITHMS is empty")
+    return parameters
+
+
+def get_server(request=None):
+    """Get Server Info from settings and returns a Fido2Server
+
+    Servers are built once per (rp_id, rp_name) pair and reused, the registry
+    is bounded by FIDO_SERVER_CACHE_SIZE so multi-tenant callables still work.
+    PASSKEYS_ALGORITHMS replaces fido2's default algorithms.
+    """
+    return get_rp_server(get_rp(request))
+
 
-    rp = PublicKeyCredentialRpEntity(id=fido_server_id, name=fido_server_name)
-    return Fido2Server(rp)
+def get_rp_server(key):
+    """Returns the cached Fido2Server of an (rp_id, rp_name) pair, see get_server"""
+    server = _servers.get(key)
+    if server is None:
+        rp = PublicKeyCredentialRpEntity(id=key[0], name=key[1])
+        server = Fido2Server(rp)
+        algorithms = get_algorithms()
+        if algorithms is not None:
+            server.allowed_algorithms = algorithms
+        server = _servers.setdefault(key, server)
+    return server
 
 
 def get_current_platform(request):
-    ua = ua_parse(request.META["HTTP_USER_AGENT"])
-    if "Safari" in ua.browser.family:
-        return "Apple"
-    elif "Chrome" in ua.browser.family and ua.os.family == "Mac OS X":
-        return "Chrome on Apple"
-    elif "Android" in ua.os.family:
-        return "Google"
-    elif "Windows" in ua.os.family:
-        return "Microsoft"
-    else:
-        return "Key"
+    """Returns the platform name of the request, see PASSKEYS_PLATFORM_DETECTOR"""
+    return get_platform_detector().detect(request)
 
 
-def reg_begin(request):
-    """Starts registering a new FIDO Device, called from API"""
-    enable_json_mapping()
-    server = get_server(request)
-    auth_attachment = getattr(settings, "KEY_ATTACHMENT", None)
+def _user_entity(user):
     # if the user has a uuid pk use that
-    if isinstance(request.user.pk, uuid.UUID):
-        user_id = str(request.user.pk)
+    if isinstance(user.pk, uuid.UUID):
+        user_id = str(user.pk)
     else:
-        if hasattr(request.user, "uuid") and isinstance(request.user.uuid, uuid.UUID):
-            user_id = str(request.user.uuid)
+        if hasattr(user, "uuid") and isinstance(user.uuid, uuid.UUID):
+            user_id = str(user.uuid)
         else:
-            user_id = request.user.get_username()
+            user_id = user.get_username()
+    return {
+        "id": urlsafe_b64encode(user_id.encode("utf8")),
+        "name": user_id,
+        "displayName": user.get_username(),
+    }
+
+
+def get_user_handle(user):
+    """The base64url WebAuthn user.id of user, as stored in UserPasskey.user_handle"""
+    # parsed the way register_begin parses it
+    return websafe_encode(PublicKeyCredentialUserEntity.from_dict(_user_entity(user)).id)
+
+
+def _posted_user_handles(data):
+    """The user handles the userHandle of an assertion may stand for.
+
+    Authenticators return it for discoverable credentials. It is base64url, older
+    versions of script.js posted the handle's bytes as text.
+    """
+    value = data.get("response", {}).get("userHandle")
+    if not value:
+        return ()
+    handles = {websafe_encode(value.encode("utf8"))}
+    try:
+        handles.add(websafe_encode(websafe_decode(value)))
+    except (ValueError, binascii.Error):
+        pass
+    return handles
+
+
+def _is_discoverable(request):
+    """auth_begin?mode=discoverable lets the authenticator offer any of its passkeys"""
+    return request.GET.get("mode") == "discoverable"
+
+
+def _begin_registration(request, user, credentials):
+    server = get_server(request)
+    auth_attachment = getattr(settings, "KEY_ATTACHMENT", None)
     registration_data, state = server.register_begin(
-        {
-            "id": urlsafe_b64encode(user_id.encode("utf8")),
-            "name": user_id,
-            "displayName": request.user.get_username(),
-        },
-        get_user_credentials(request.user),
+        _user_entity(user),
+        credentials,
         authenticator_attachment=auth_attachment,
         resident_key_requirement=fido2.webauthn.ResidentKeyRequirement.PREFERRED,
     )
-    registration_data = dict(registration_data)
+    return dict(registration_data), state
+
+
+def _complete_registration(request, user, data, state):
+    """Verifies the attestation in data and returns the new, unsaved UserPasskey"""
+    name = data.pop("key_name", "")
+    server = get_server(request)
+    auth_data = server.register_complete(state, response=data)
+    return _new_passkey(request, user, data, name, auth_data)
+
+
+def _new_passkey(request, user, data, name, auth_data):
+    platform = get_current_platform(request)
+    if name == "":
+        name = platform
+    uk = UserPasskey(
+        user=user,
+        name=name,
+        platform=platform,
+        user_handle=get_user_handle(user),
+        transports=_parse_transports(data),
+        backup_eligible=auth_data.is_backup_eligible(),
+        backup_state=auth_data.is_backed_up(),
+    )
+    uk.set_credential(data.get("id") or "", auth_data.credential_data)
+    return uk
+
+
+def _usage(data):
+    """The fields record_usage() updates after a login, the backup state can change"""
+    fields = {"last_used": timezone.now()}
+    try:
+        auth_data = AuthenticatorData(websafe_decode(data["response"]["authenticatorData"]))
+    except (KeyError, TypeError, ValueError, binascii.Error):
+        return fields
+    fields["backup_state"] = auth_data.is_backed_up()
+    return fields
+
+
+def _begin_authentication(request, credentials):
+    server = get_server(request)
+    auth_data, state = server.authenticate_begin(credentials)
+    res = dict(auth_data)
+    res["publicKey"]["userVerification"] = "preferred"
+    res["publicKey"]["timeout"] = 12000
+    return res, state
+
+
+def authentication_options(request, credentials=()):
+    """Returns single use options for navigator.credentials.get(), the state is saved.
+
+    This is what auth_begin answers, views can render it into the page instead
+    (see login_options). Without credentials the login is discoverable.
+    """
+    res, state = _begin_authentication(request, list(credentials))
+    handle = get_challenge_store().save(request, state)
+    if handle is not None:
+        res["fido2_state"] = handle
+    return res
+
+
+async def aauthentication_options(request, credentials=()):
+    """Async variant of authentication_options"""
+    res, state = _begin_authentication(request, list(credentials))
+    handle = await get_challenge_store().asave(request, state)
+    if handle is not None:
+        res["fido2_state"] = handle
+    return res
+
+
+def _complete_authentication(request, key, data, state):
+    server = get_server(request)
+    server.authenticate_complete(state, credentials=[key.credential], response=data)
+    return _passkey_session(request, key)
 
-    request.session["fido2_state"] = state
+
+def _passkey_session(request, key):
+    return {
+        "passkey": True,
+        "name": key.name,
+        "id": key.id,
+        "platform": key.platform,
+        "cross_platform": get_current_platform(request) != key.platform,
+    }
+
+
+_missing_state = {
+    "status": "ERR",
+    "message": "FIDO Status can't be found, please try again",
+}
+_server_error = {"status": "ERR", "message": "Error on server, please try again later"}
+_server_busy = {"status": "ERR", "message": "Server is busy, please try again later"}
+
+
+@query_budget(3)
+def reg_begin(request):
+    """Starts registering a new FIDO Device, called from API"""
+    registration_data, state = _begin_registration(
+        request, request.user, get_credential_descriptors(user_id=request.user.pk)
+    )
+    handle = get_challenge_store().save(request, state)
+    if handle is not None:
+        registration_data["fido2_state"] = handle
     return JsonResponse(registration_data)
 
 
+@query_budget(3)
 @csrf_exempt
 def reg_complete(request):
     """Completes the registeration, called by API"""
     try:
-        if not "fido2_state" in request.session:
-            return JsonResponse(
-                {
-                    "status": "ERR",
-                    "message": "FIDO Status can't be found, please try again",
-                }
-            )
-        enable_json_mapping()
         data = json.loads(request.body)
-        name = data.pop("key_name", "")
-        server = get_server(request)
-        auth_data = server.register_complete(
-            request.session.pop("fido2_state"), response=data
-        )
-        encoded = websafe_encode(auth_data.credential_data)
-        platform = get_current_platform(request)
-        if name == "":
-            name = platform
-        uk = UserPasskey(user=request.user, token=encoded, name=name, platform=platform)
-        if data.get("id"):
-            uk.credential_id = data.get("id")
-
+        state = get_challenge_store().pop(request, data.pop("fido2_state", None))
+        if state is None:
+            return JsonResponse(_missing_state)
+        uk = _complete_registration(request, request.user, data, state)
         uk.save()
         return JsonResponse({"status": "OK"})
     except Exception as exp:  # pragma: no cover
         print(traceback.format_exc())  # pragma: no cover
-        return JsonResponse(
-            {"status": "ERR", "message": "Error on server, please try again later"}
-        )  # pragma: no cover
+        return JsonResponse(_server_error)  # pragma: no cover
 
 
+@query_budget(3)
+@rate_limit("auth_begin", json=True)
 def auth_begin(request):
-    enable_json_mapping()
-    server = get_server(request)
     credentials = []
-    username = None
-    User = get_user_model()
-    if "base_username" in request.session:
-        username = request.session["base_username"]
-    if request.user.is_authenticated:
-        username = getattr(request.user, User.USERNAME_FIELD)
-    if username:
-        credentials = get_user_credentials(username)
-    auth_data, state = server.authenticate_begin(credentials)
-    request.session["fido2_state"] = state
-    res = dict(auth_data)
-    res["publicKey"]["userVerification"] = "preferred"
-    res["publicKey"]["timeout"] = 12000
-    return JsonResponse(res)
+    if not _is_discoverable(request):
+        if request.user.is_authenticated:
+            credentials = get_credential_descriptors(user_id=request.user.pk)
+        elif "base_user_id" in request.session:
+            credentials = get_credential_descriptors(
+                user_id=request.session["base_user_id"]
+            )
+        elif request.session.get("base_username"):
+            credentials = get_credential_descriptors(
+                username=request.session["base_username"]
+            )
+    return JsonResponse(authentication_options(request, credentials))
 
 
+@query_budget(3)
 @csrf_exempt
 def auth_complete(request):
-    credentials = []
-    server = get_server(request)
     data = json.loads(request.POST["passkeys"])
-    key = None
-    credential_id = data["id"]
+    state = get_challenge_store().pop(request, data.pop("fido2_state", None))
+    key, user = get_credential_with_user(data["id"], _posted_user_handles(data))
+    if state is not None and user is not None:
+        try:
+            passkey = _complete_authentication(request, key, data, state)
+        except ValueError:  # pragma: no cover
+            return None  # pragma: no cover
+        except Exception as excep:  # pragma: no cover
+            raise Exception(excep)  # pragma: no cover
+        record_usage(key.id, **_usage(data))
+        request.session["passkey"] = passkey
+        return user
+    return None  # pragma: no cover
+
 
-    keys = UserPasskey.objects.filter(credential_id=credential_id, enabled=1)
-    if keys.exists():
+def use_async_views():
+    """Whether passkeys.urls routes the ceremonies to the async views.
 
-        credentials = [AttestedCredentialData(websafe_decode(keys[0].token))]
-        key = keys[0]
+    PASSKEYS_ASYNC_VIEWS turns them on or off, when it is unset they are used
+    if ASGI_APPLICATION is set. The async views need Django 4.1+.
+    """
+    enabled = getattr(settings, "PASSKEYS_ASYNC_VIEWS", None)
+    if enabled is None:
+        return bool(getattr(settings, "ASGI_APPLICATION", None)) and django.VERSION >= (4, 1)
+    if enabled and django.VERSION < (4, 1):
+        raise ImproperlyConfigured("PASSKEYS_ASYNC_VIEWS requires Django 4.1 or later")
+    return bool(enabled)
 
+
+async def aget_credential_descriptors(user_id=None, username=None):
+    """Async variant of get_credential_descriptors"""
+    keys = _user_passkeys(user_id, username).values_list(*_DESCRIPTOR_FIELDS)
+    return [_descriptor(*key) async for key in keys]
+
+
+@query_budget(3)
+async def areg_begin(request):
+    """Async variant of reg_begin"""
+    user = await aget_user(request)
+    registration_data, state = _begin_registration(
+        request, user, await aget_credential_descriptors(user_id=user.pk)
+    )
+    handle = await get_challenge_store().asave(request, state)
+    if handle is not None:
+        registration_data["fido2_state"] = handle
+    return JsonResponse(registration_data)
+
+
+@query_budget(3)
+async def areg_complete(request):
+    """Async variant of reg_complete"""
+    try:
+        data = json.loads(request.body)
+        state = await get_challenge_store().apop(
+            request, data.pop("fido2_state", None)
+        )
+        if state is None:
+            return JsonResponse(_missing_state)
+        name = data.pop("key_name", "")
+        auth_data = await get_verification_executor().run(
+            verify_registration, get_rp(request), state, data
+        )
+        uk = _new_passkey(
+            request, await aget_user(request), data, name, AuthenticatorData(auth_data)
+        )
+        await uk.asave()
+        return JsonResponse({"status": "OK"})
+    except VerificationQueueFull:
+        return JsonResponse(_server_busy, status=503)
+    except Exception as exp:  # pragma: no cover
+        print(traceback.format_exc())  # pragma: no cover
+        return JsonResponse(_server_error)  # pragma: no cover
+
+
+areg_complete.csrf_exempt = True
+
+
+@query_budget(3)
+@rate_limit("auth_begin", json=True)
+async def aauth_begin(request):
+    """Async variant of auth_begin"""
+    credentials = []
+    if not _is_discoverable(request):
+        user = await aget_user(request)
+        if user.is_authenticated:
+            credentials = await aget_credential_descriptors(user_id=user.pk)
+        else:
+            user_id = await asession_get(request.session, "base_user_id")
+            username = await asession_get(request.session, "base_username")
+            if user_id is not None:
+                credentials = await aget_credential_descriptors(user_id=user_id)
+            elif username:
+                credentials = await aget_credential_descriptors(username=username)
+    return JsonResponse(await aauthentication_options(request, credentials))
+
+
+@query_budget(3)
+async def aauth_complete(request):
+    """Async variant of auth_complete
+
+    The signature is verified on the verification executor, VerificationQueueFull
+    is raised when too many verifications are pending.
+    """
+    data = json.loads(request.POST["passkeys"])
+    state = await get_challenge_store().apop(request, data.pop("fido2_state", None))
+    key, user = await aget_credential_with_user(data["id"], _posted_user_handles(data))
+    if state is not None and user is not None:
         try:
-            server.authenticate_complete(
-                request.session.pop("fido2_state"),
-                credentials=credentials,
-                response=data,
+            await get_verification_executor().run(
+                verify_authentication,
+                get_rp(request),
+                state,
+                bytes(key.credential),
+                data,
             )
+            passkey = _passkey_session(request, key)
         except ValueError:  # pragma: no cover
             return None  # pragma: no cover
+        except VerificationQueueFull:
+            raise
         except Exception as excep:  # pragma: no cover
             raise Exception(excep)  # pragma: no cover
-        if key:
-            key.last_used = timezone.now()
-            request.session["passkey"] = {
-                "passkey": True,
-                "name": key.name,
-                "id": key.id,
-                "platform": key.platform,
-                "cross_platform": get_current_platform(request) != key.platform,
-            }
-            key.save()
-            return key.user
+        await arecord_usage(key.id, **_usage(data))
+        await asession_set(request.session, "passkey", passkey)
+        return user
     return None  # pragma: no cover
+
+
+aauth_complete.csrf_exempt = True
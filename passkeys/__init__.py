@@ -1 +1,5 @@
+import django
 from fido2.webauthn import AuthenticatorAttachment as Attachment
+
+if django.VERSION < (3, 2):
+    default_app_config = "passkeys.apps.PasskeysConfig"
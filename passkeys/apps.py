@@ -0,0 +1,39 @@
+from django.apps import AppConfig
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+class PasskeysConfig(AppConfig):
+    name = "passkeys"
+    verbose_name = "Passkeys"
+
+    def ready(self):
+        """Resolves the configuration once per process instead of once per request.
+
+        With PASSKEYS_PRELOAD the User-Agent parser and the snapshots of the negative
+        lookup filters are loaded here as well, so that pre-fork servers (e.g.
+        gunicorn --preload) share them between their workers. The snapshots are only
+        read from the cache, the database isn't queried during startup.
+        """
+        from . import bloom, cache, usage  # noqa: F401, connects the signal receivers
+        from .challenge import get_challenge_store
+        from .FIDO2 import enable_json_mapping, use_async_views
+        from .mail import get_otp_dispatcher
+        from .platform import get_platform_detector
+
+        for name in ("FIDO_SERVER_ID", "FIDO_SERVER_NAME"):
+            if not hasattr(settings, name):
+                raise ImproperlyConfigured("passkeys requires the %s setting" % name)
+
+        enable_json_mapping()
+        use_async_views()
+        get_challenge_store()
+        detector = get_platform_detector()
+        usage.get_usage_buffer()
+        get_otp_dispatcher()
+
+        if getattr(settings, "PASSKEYS_PRELOAD", False):
+            preload = getattr(detector, "preload", None)
+            if preload is not None:
+                preload()
+            bloom.warm_filters(rebuild=False)
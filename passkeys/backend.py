@@ -1,4 +1,5 @@
 from django.contrib.auth.backends import ModelBackend
+from .cache import get_cached_user
 from .FIDO2 import auth_complete
 
 
@@ -28,3 +29,8 @@ class PasskeyModelBackend(ModelBackend):
         if passkeys != "":
             return auth_complete(request)
         return None
+
+    def get_user(self, user_id):
+        """Loads the user of a session, from PASSKEYS_USER_CACHE if it is set"""
+        user = get_cached_user(user_id)
+        return user if user is not None and self.user_can_authenticate(user) else None
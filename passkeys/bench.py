@@ -0,0 +1,343 @@
+"""Benchmarks the registration and authentication ceremonies in-process.
+
+Run it from a project that includes passkeys.urls under the 'passkeys' namespace:
+
+    DJANGO_SETTINGS_MODULE=mysite.settings python -m passkeys.bench --users 50 --keys 3
+
+The ceremonies go through the Django test client against a throwaway test database,
+the SoftAuthenticator of passkeys.testing plays the browser, its keys come from the
+pooled keys kept on disk. The report is JSON so that runs of two
+releases can be diffed.
+
+    python -m passkeys.bench --verify 500
+
+only times the signature verification of each algorithm, without Django.
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import sys
+import time
+
+from .soft_webauthn import ALGORITHMS
+from .testing import SoftAuthenticator
+
+USER_AGENT = (
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 13_4) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36"
+)
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list of numbers"""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = max(int(math.ceil(p / 100.0 * len(ordered))), 1)
+    return ordered[rank - 1]
+
+
+def _latency_ms(latencies):
+    count = len(latencies)
+    return {
+        "mean": round(sum(latencies) / count * 1000, 3) if count else None,
+        "p50": round(percentile(latencies, 50) * 1000, 3) if count else None,
+        "p95": round(percentile(latencies, 95) * 1000, 3) if count else None,
+        "p99": round(percentile(latencies, 99) * 1000, 3) if count else None,
+    }
+
+
+def summarize(latencies, queries, elapsed):
+    """Builds the report of one ceremony from its latencies (seconds) and query counts"""
+    count = len(latencies)
+    return {
+        "count": count,
+        "ops_per_sec": round(count / elapsed, 2) if elapsed else None,
+        "latency_ms": _latency_ms(latencies),
+        "queries": {
+            "mean": round(sum(queries) / count, 2) if count else None,
+            "max": max(queries) if count else None,
+        },
+    }
+
+
+class _Measure:
+    """Collects the server time and queries of each ceremony, the work of the
+    soft authenticator between the requests is not counted"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.latencies = []
+        self.queries = []
+        self.elapsed = 0.0
+
+    def ceremony(self):
+        self.latencies.append(0.0)
+        self.queries.append(0)
+
+    def __call__(self, fn, *args, **kwargs):
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(self.connection) as captured:
+            start = time.perf_counter()
+            result = fn(*args, **kwargs)
+            spent = time.perf_counter() - start
+        self.latencies[-1] += spent
+        self.queries[-1] += len(captured)
+        self.elapsed += spent
+        return result
+
+    def report(self):
+        return summarize(self.latencies, self.queries, self.elapsed)
+
+
+class _Unmeasured:
+    def ceremony(self):
+        pass
+
+    def __call__(self, fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+
+def _options(response):
+    options = json.loads(response.content)
+    options["publicKey"]["challenge"] = options["publicKey"]["challenge"].encode("ascii")
+    return options
+
+
+def _register(client, algorithm, measure):
+    from django.urls import reverse
+
+    measure.ceremony()
+    options = _options(measure(client.get, reverse("passkeys:reg_begin")))
+    device = SoftAuthenticator(algorithm)
+    data = device.create(options, "https://" + options["publicKey"]["rp"]["id"])
+    data["fido2_state"] = options.get("fido2_state")
+    data["key_name"] = "bench"
+    response = measure(
+        client.post,
+        reverse("passkeys:reg_complete"),
+        data=json.dumps(data),
+        content_type="application/json",
+        HTTP_USER_AGENT=USER_AGENT,
+    )
+    if json.loads(response.content).get("status") != "OK":
+        raise RuntimeError("Registration failed: %s" % response.content.decode())
+    return device
+
+
+def _authenticate(client, user, device, measure):
+    from django.urls import reverse
+
+    measure.ceremony()
+    session = client.session
+    session["base_user_id"] = user._meta.pk.value_to_string(user)
+    session.save()
+    options = _options(measure(client.get, reverse("passkeys:auth_begin")))
+    data = device.get(options, "https://" + options["publicKey"]["rpId"])
+    data["fido2_state"] = options.get("fido2_state")
+    response = measure(
+        client.post,
+        reverse("passkeys:login.passkey"),
+        {"passkeys": json.dumps(data), "username": "", "password": ""},
+        HTTP_USER_AGENT=USER_AGENT,
+    )
+    if response.status_code != 302:
+        raise RuntimeError("Authentication failed with status %d" % response.status_code)
+    client.logout()
+
+
+def _enroll(name, keys, algorithm, measure):
+    from django.contrib.auth import get_user_model
+    from django.test import Client
+
+    User = get_user_model()
+    user = User(**{User.USERNAME_FIELD: name})
+    user.set_unusable_password()
+    user.save()
+    client = Client()
+    client.force_login(user)
+    devices = [_register(client, algorithm, measure) for _ in range(keys)]
+    client.logout()
+    return user, client, devices
+
+
+def run_benchmark(users=10, keys=1, algorithm="ES256", rounds=1, seed=None, warmup=1):
+    """Registers `keys` passkeys for each of `users` new users, then logs every user
+    in `rounds` times with a random one of their passkeys.
+
+    `warmup` extra users go through both ceremonies first without being measured,
+    so that lazy imports and caches don't end up in the percentiles.
+
+    Expects the database to be disposable, e.g. a test database.
+    """
+    import django
+    import fido2
+    from django.db import connection
+
+    rng = random.Random(seed)
+    registration = _Measure(connection)
+    authentication = _Measure(connection)
+
+    for n in range(warmup):
+        user, client, devices = _enroll(
+            "passkeys-warmup-%d@example.com" % n, keys, algorithm, _Unmeasured()
+        )
+        _authenticate(client, user, devices[0], _Unmeasured())
+
+    enrolled = [
+        _enroll("passkeys-bench-%d@example.com" % n, keys, algorithm, registration)
+        for n in range(users)
+    ]
+
+    for _ in range(rounds):
+        for user, client, devices in enrolled:
+            _authenticate(client, user, rng.choice(devices), authentication)
+
+    return {
+        "config": {
+            "users": users,
+            "keys": keys,
+            "algorithm": algorithm,
+            "rounds": rounds,
+            "seed": seed,
+            "warmup": warmup,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "fido2": fido2.__version__,
+            "database": connection.vendor,
+        },
+        "registration": registration.report(),
+        "authentication": authentication.report(),
+    }
+
+
+def _device_options(options):
+    """The options as the browser receives them, i.e. their JSON"""
+    options = json.loads(json.dumps(dict(options), default=dict))
+    options["publicKey"]["challenge"] = options["publicKey"]["challenge"].encode("ascii")
+    return options
+
+
+def run_verification_benchmark(algorithms=None, rounds=100):
+    """Times the server side verification of `rounds` assertions per algorithm.
+
+    A SoftAuthenticator of each algorithm (all of ALGORITHMS by default) is
+    registered and its assertions are checked with the functions the async views
+    run on their executor, against a server of its own so that neither Django
+    settings nor models are needed. Only the verification is timed, the report
+    also has the size of the stored credential data.
+    """
+    import fido2
+    from fido2.webauthn import AuthenticatorData
+
+    from .executor import (
+        build_server,
+        complete_authentication,
+        complete_registration,
+        enable_json_mapping,
+    )
+
+    enable_json_mapping()
+    origin = "https://localhost"
+    server = build_server(("localhost", "passkeys.bench"))
+    user = {"id": b"passkeys-bench", "name": "bench", "displayName": "bench"}
+    results = {}
+    for algorithm in algorithms or sorted(ALGORITHMS):
+        device = SoftAuthenticator(algorithm)
+        options, state = server.register_begin(user)
+        data = device.create(_device_options(options), origin)
+        credential_data = bytes(
+            AuthenticatorData(complete_registration(server, state, data)).credential_data
+        )
+        latencies = []
+        for _ in range(rounds):
+            options, state = server.authenticate_begin()
+            data = device.get(_device_options(options), origin)
+            start = time.perf_counter()
+            complete_authentication(server, state, credential_data, data)
+            latencies.append(time.perf_counter() - start)
+        elapsed = sum(latencies)
+        results[algorithm] = {
+            "count": rounds,
+            "ops_per_sec": round(rounds / elapsed, 2) if elapsed else None,
+            "latency_ms": _latency_ms(latencies),
+            "credential_bytes": len(credential_data),
+        }
+    return {
+        "config": {"algorithms": sorted(results), "rounds": rounds},
+        "environment": {"python": platform.python_version(), "fido2": fido2.__version__},
+        "verification": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m passkeys.bench", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument("--settings", help="Django settings module, defaults to DJANGO_SETTINGS_MODULE")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--keys", type=int, default=1, help="passkeys per user")
+    parser.add_argument("--algorithm", default="ES256", choices=sorted(ALGORITHMS))
+    parser.add_argument("--rounds", type=int, default=1, help="logins per user")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--warmup", type=int, default=1, help="unmeasured users run first")
+    parser.add_argument(
+        "--verify",
+        type=int,
+        metavar="ROUNDS",
+        help="only time ROUNDS signature verifications of each algorithm, no database needed",
+    )
+    parser.add_argument("--output", default="-", help="file to write the JSON report to")
+    args = parser.parse_args(argv)
+
+    if args.verify:
+        _write_report(run_verification_benchmark(rounds=args.verify), args.output)
+        return
+
+    if args.settings:
+        os.environ["DJANGO_SETTINGS_MODULE"] = args.settings
+
+    import django
+    from django.test.utils import (
+        setup_databases,
+        setup_test_environment,
+        teardown_databases,
+        teardown_test_environment,
+    )
+
+    django.setup()
+    setup_test_environment()
+    databases = setup_databases(verbosity=0, interactive=False)
+    try:
+        report = run_benchmark(
+            users=args.users,
+            keys=args.keys,
+            algorithm=args.algorithm,
+            rounds=args.rounds,
+            seed=args.seed,
+            warmup=args.warmup,
+        )
+    finally:
+        teardown_databases(databases, verbosity=0)
+        teardown_test_environment()
+    _write_report(report, args.output)
+
+
+def _write_report(report, path):
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if path == "-":
+        sys.stdout.write(output + "\n")
+    else:
+        with open(path, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
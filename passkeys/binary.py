@@ -0,0 +1,78 @@
+import binascii
+import hashlib
+import time
+
+from django.db import transaction
+from fido2.utils import websafe_decode, websafe_encode
+
+
+def credential_key(credential_id):
+    """Returns the raw bytes of a base64url credential id, as stored in raw_credential_id.
+
+    Padding is optional. Ids that aren't canonical base64url are kept as their UTF-8
+    bytes, so that two different ids never share a key.
+    """
+    if isinstance(credential_id, (bytes, memoryview)):
+        return bytes(credential_id)
+    try:
+        raw = websafe_decode(credential_id)
+        if websafe_encode(raw) == credential_id.rstrip("="):
+            return raw
+    except (ValueError, binascii.Error):
+        pass
+    return credential_id.encode("utf8")
+
+
+def credential_hash(raw):
+    """Signed 64 bit hash of a raw credential id, indexed as credential_id_hash"""
+    return int.from_bytes(hashlib.blake2b(raw, digest_size=8).digest(), "big", signed=True)
+
+
+def binary_fields(credential_id, token):
+    """Returns the binary columns of a passkey stored with the legacy string columns"""
+    raw = credential_key(credential_id)
+    try:
+        credential_data = websafe_decode(token) if token else None
+    except (ValueError, binascii.Error):
+        credential_data = None
+    return {
+        "credential_id_hash": credential_hash(raw),
+        "raw_credential_id": raw,
+        "credential_data": credential_data,
+    }
+
+
+def backfill(model, batch_size=1000, pause=0, log=None):
+    """Fills the binary columns of the rows of `model` (UserPasskey or its historical
+    version) that only have the string columns.
+
+    Rows are converted in primary key order, `batch_size` at a time with one short
+    transaction per batch and `pause` seconds between batches. It only touches rows
+    whose credential_id_hash is NULL, so it can be interrupted and run again.
+    Returns the number of converted rows.
+    """
+    done = 0
+    last_pk = None
+    while True:
+        pending = model._default_manager.filter(credential_id_hash__isnull=True)
+        if last_pk is not None:
+            pending = pending.filter(pk__gt=last_pk)
+        rows = list(
+            pending.order_by("pk").values_list("pk", "credential_id", "token")[:batch_size]
+        )
+        if not rows:
+            return done
+        with transaction.atomic(using=model._default_manager.db):
+            passkeys = [
+                model(pk=pk, **binary_fields(credential_id, token))
+                for pk, credential_id, token in rows
+            ]
+            model._default_manager.bulk_update(
+                passkeys, ["credential_id_hash", "raw_credential_id", "credential_data"]
+            )
+        done += len(rows)
+        last_pk = rows[-1][0]
+        if log is not None:
+            log("Converted %d passkeys" % done)
+        if pause:
+            time.sleep(pause)
@@ -0,0 +1,310 @@
+import hashlib
+import math
+import secrets
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .models import UserPasskey
+from .utils import sync_to_async
+
+
+class BloomFilter:
+    """A Bloom filter of strings sized for `capacity` items at `error_rate` false positives"""
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(int(capacity), 1)
+        self.size = max(int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode("utf8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        positions = self._positions(item)
+        with self._lock:
+            for position in positions:
+                self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(
+            bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item)
+        )
+
+    def dumps(self):
+        return self.size, self.hashes, bytes(self.bits)
+
+    @classmethod
+    def loads(cls, data):
+        bloom = cls.__new__(cls)
+        bloom.size, bloom.hashes, bits = data
+        bloom.bits = bytearray(bits)
+        bloom._lock = threading.Lock()
+        return bloom
+
+
+class NegativeLookupFilter:
+    """Answers "might this value exist?" for one column without touching the database.
+
+    The filter is built on first use from a snapshot in the cache or, if there is no
+    current one, from the database. A token and a version in the cache name the
+    current state of the column. Saving a new value adds it to the snapshot in place
+    and increments the version under a cache lock, other processes then reload the
+    snapshot without reading the database. A save that finds the lock taken doesn't
+    wait for it but calls invalidate(), whose new token makes every process rebuild
+    from the database instead. A process whose filter is older than the
+    stamp treats misses as "maybe" and reloads at most every `rebuild_interval`
+    seconds, so a miss is only definite for an up-to-date filter.
+    """
+
+    lock_timeout = 5
+
+    def __init__(self, name, values, alias="default", capacity=100000,
+                 error_rate=0.001, rebuild_interval=5):
+        self.name = name
+        self.values = values
+        self.alias = alias
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.rebuild_interval = rebuild_interval
+        # (bloom, stamp, loaded_at), replaced as a whole so readers never mix states
+        self._state = (None, None, None)
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @property
+    def token_key(self):
+        return "passkeys:bloom:%s:token" % self.name
+
+    @property
+    def version_key(self):
+        return "passkeys:bloom:%s:version" % self.name
+
+    @property
+    def lock_key(self):
+        return "passkeys:bloom:%s:lock" % self.name
+
+    @property
+    def snapshot_key(self):
+        return "passkeys:bloom:%s:snapshot" % self.name
+
+    @staticmethod
+    def normalize(value):
+        # Case-insensitive collations must not turn into false negatives.
+        return str(value).casefold()
+
+    def _stamp(self, values):
+        """The (token, version) pair of get_many(), None if either is missing"""
+        token, version = values.get(self.token_key), values.get(self.version_key)
+        return None if token is None or version is None else (token, version)
+
+    def read_stamp(self):
+        """The current (token, version) in the cache, None if there is none"""
+        return self._stamp(self.cache.get_many([self.token_key, self.version_key]))
+
+    def _current_stamp(self):
+        stamp = self.read_stamp()
+        if stamp is None:
+            # An evicted version must not restart below an old snapshot, so start afresh.
+            stamp = (secrets.token_hex(8), 0)
+            self.cache.set_many({self.token_key: stamp[0], self.version_key: stamp[1]}, None)
+        return stamp
+
+    def load(self, rebuild=True):
+        """Loads the snapshot of the current stamp or rebuilds it from the database.
+
+        Without rebuild only the snapshot is loaded, None is returned if there is no
+        current one.
+        """
+        with self._lock:
+            stamp = self._current_stamp()
+            snapshot = self.cache.get(self.snapshot_key)
+            if snapshot is not None and tuple(snapshot[:2]) == stamp:
+                bloom = BloomFilter.loads(snapshot[2])
+            elif not rebuild:
+                return None
+            else:
+                values = [self.normalize(value) for value in self.values()]
+                bloom = BloomFilter(max(self.capacity, 2 * len(values)), self.error_rate)
+                for value in values:
+                    bloom.add(value)
+                self.cache.set(self.snapshot_key, stamp + (bloom.dumps(),), None)
+            self._state = (bloom, stamp, time.monotonic())
+        return bloom
+
+    def _check(self, value, state, stamp):
+        """True/False if the state answers for value, None if it has to be reloaded"""
+        bloom, loaded_stamp, loaded_at = state
+        if bloom is not None and value in bloom:
+            return True
+        if bloom is not None and stamp == loaded_stamp:
+            return False
+        if bloom is None or time.monotonic() - loaded_at >= self.rebuild_interval:
+            return None
+        return True  # stale and rebuilt recently, let the database answer
+
+    def might_contain(self, value):
+        value = self.normalize(value)
+        state = self._state
+        if state[0] is not None and value in state[0]:
+            return True
+        found = self._check(value, state, self.read_stamp())
+        if found is None:
+            return value in self.load()
+        return found
+
+    async def amight_contain(self, value):
+        """Async variant of might_contain"""
+        value = self.normalize(value)
+        state = self._state
+        if state[0] is not None and value in state[0]:
+            return True
+        stamp = self._stamp(await self.cache.aget_many([self.token_key, self.version_key]))
+        found = self._check(value, state, stamp)
+        if found is None:
+            return value in await sync_to_async(self.load)()
+        return found
+
+    def invalidate(self):
+        """Makes every process rebuild from the database before trusting a miss again"""
+        # A snapshot an added() in flight writes afterwards has the old token, it's ignored.
+        self.cache.set(self.token_key, secrets.token_hex(8), None)
+
+    def added(self, value):
+        """Adds a saved value to this process's filter and to the shared snapshot"""
+        value = self.normalize(value)
+        bloom = self._state[0]
+        if bloom is not None:
+            bloom.add(value)
+        # runs after the commit of a request's transaction, never wait for the lock
+        if not self.cache.add(self.lock_key, True, self.lock_timeout):
+            self.invalidate()
+            return
+        try:
+            token, version = self._current_stamp()
+            snapshot = self.cache.get(self.snapshot_key)
+            if snapshot is not None and tuple(snapshot[:2]) == (token, version):
+                shared = BloomFilter.loads(snapshot[2])
+                shared.add(value)
+                self.cache.set(self.snapshot_key, (token, version + 1, shared.dumps()), None)
+            # without a current snapshot the next load rebuilds from the database
+            try:
+                self.cache.incr(self.version_key)
+            except ValueError:
+                self.invalidate()
+        finally:
+            self.cache.delete(self.lock_key)
+
+
+def _usernames():
+    User = get_user_model()
+    return User._default_manager.values_list(User.USERNAME_FIELD, flat=True).iterator()
+
+
+def _credential_ids():
+    return UserPasskey.objects.values_list("credential_id", flat=True).iterator()
+
+
+_filters = {}
+
+
+def get_filter(name):
+    """Returns the 'usernames' or 'credentials' filter, None unless PASSKEYS_NEGATIVE_LOOKUP is set.
+
+    The setting is a dict with the optional keys CACHE (alias, default 'default'),
+    CAPACITY, ERROR_RATE and REBUILD_INTERVAL.
+    """
+    config = getattr(settings, "PASSKEYS_NEGATIVE_LOOKUP", None)
+    if config is None:
+        return None
+    lookup = _filters.get(name)
+    if lookup is None:
+        lookup = _filters.setdefault(
+            name,
+            NegativeLookupFilter(
+                name,
+                {"usernames": _usernames, "credentials": _credential_ids}[name],
+                alias=config.get("CACHE", "default"),
+                capacity=config.get("CAPACITY", 100000),
+                error_rate=config.get("ERROR_RATE", 0.001),
+                rebuild_interval=config.get("REBUILD_INTERVAL", 5),
+            ),
+        )
+    return lookup
+
+
+def might_exist(name, value):
+    """False only if value is certainly not in the column of the filter `name`"""
+    lookup = get_filter(name)
+    return lookup is None or lookup.might_contain(value)
+
+
+async def amight_exist(name, value):
+    """Async variant of might_exist"""
+    lookup = get_filter(name)
+    return lookup is None or await lookup.amight_contain(value)
+
+
+def warm_filters(rebuild=True):
+    """Loads both filters now rather than on the first request that needs them.
+
+    With rebuild a missing snapshot is built from the database (the
+    passkeys_warm_filters command), otherwise only the snapshots already in the
+    cache are loaded (PasskeysConfig.ready() with PASSKEYS_PRELOAD). Returns the
+    names of the filters that are loaded.
+    """
+    loaded = []
+    for name in ("usernames", "credentials"):
+        lookup = get_filter(name)
+        if lookup is not None and lookup.load(rebuild) is not None:
+            loaded.append(name)
+    return loaded
+
+
+def reset_filters():
+    """Call after creating users or passkeys without signals (bulk_create, raw SQL)"""
+    for name in ("usernames", "credentials"):
+        lookup = get_filter(name)
+        if lookup is not None:
+            lookup.invalidate()
+
+
+def _saved(name, field, instance, created, update_fields, using):
+    if created or update_fields is None or field in update_fields:
+        lookup = get_filter(name)
+        if lookup is not None:
+            # Other processes may only rebuild once the row is visible to them.
+            value = getattr(instance, field)
+            transaction.on_commit(lambda: lookup.added(value), using=using)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def _user_saved(sender, instance, created, update_fields=None, using=None, **kwargs):
+    _saved("usernames", sender.USERNAME_FIELD, instance, created, update_fields, using)
+
+
+@receiver(post_save, sender=UserPasskey)
+def _passkey_saved(sender, instance, created, update_fields=None, using=None, **kwargs):
+    _saved("credentials", "credential_id", instance, created, update_fields, using)
+
+
+@receiver(setting_changed)
+def _reset_lookups(setting, **kwargs):
+    if setting == "PASSKEYS_NEGATIVE_LOOKUP":
+        _filters.clear()
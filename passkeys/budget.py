@@ -0,0 +1,116 @@
+import asyncio
+import logging
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import connection
+
+from .utils import sync_to_async
+
+logger = logging.getLogger("passkeys.budget")
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+_TRANSACTION_CONTROL = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE SAVEPOINT")
+
+
+def counted_queries(captured):
+    """The SQL of the captured queries that count against a budget, that is all
+    but the transaction control statements which only some backends log"""
+    return [
+        query["sql"]
+        for query in captured.captured_queries
+        if not query["sql"].upper().startswith(_TRANSACTION_CONTROL)
+    ]
+
+
+def _check(name, max_queries, captured):
+    queries = counted_queries(captured)
+    if len(queries) <= max_queries:
+        return
+    message = "%s ran %d queries, its budget is %d:\n%s" % (
+        name,
+        len(queries),
+        max_queries,
+        "\n".join(queries),
+    )
+    if getattr(settings, "PASSKEYS_QUERY_BUDGETS", None) == "raise":
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
+
+
+def query_budget(max_queries):
+    """Declares the maximum number of queries a view may run, as view.query_budget.
+
+    The budget counts the queries of the default database made by the view itself,
+    including loading the session and request.user but not transaction control
+    statements or the queries of the middlewares that run after it. With
+    PASSKEYS_QUERY_BUDGETS = "warn" or "raise" every call is checked, a view over
+    its budget is logged to 'passkeys.budget' or raises QueryBudgetExceeded.
+    Async views are counted in the thread their ORM calls run in, which concurrent
+    async requests share, so check them where requests don't overlap (tests).
+    """
+
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                if not getattr(settings, "PASSKEYS_QUERY_BUDGETS", None):
+                    return await view(request, *args, **kwargs)
+                from django.test.utils import CaptureQueriesContext
+
+                captured = CaptureQueriesContext(connection)
+                await sync_to_async(captured.__enter__)()
+                try:
+                    response = await view(request, *args, **kwargs)
+                finally:
+                    await sync_to_async(captured.__exit__)(None, None, None)
+                # the captured queries are read from that thread's connection too
+                await sync_to_async(_check)(view.__name__, max_queries, captured)
+                return response
+
+            async_wrapper.query_budget = max_queries
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not getattr(settings, "PASSKEYS_QUERY_BUDGETS", None):
+                return view(request, *args, **kwargs)
+            from django.test.utils import CaptureQueriesContext
+
+            with CaptureQueriesContext(connection) as captured:
+                response = view(request, *args, **kwargs)
+            _check(view.__name__, max_queries, captured)
+            return response
+
+        wrapper.query_budget = max_queries
+        return wrapper
+
+    return decorator
+
+
+class QueryBudgetTestMixin:
+    """TestCase mixin running every view with PASSKEYS_QUERY_BUDGETS = "raise"."""
+
+    def setUp(self):
+        super().setUp()
+        from django.test.utils import override_settings
+
+        budgets = override_settings(PASSKEYS_QUERY_BUDGETS="raise")
+        budgets.enable()
+        self.addCleanup(budgets.disable)
+
+    @contextmanager
+    def assertQueryBudget(self, view):
+        """Fails if the block runs more queries than view's budget"""
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as captured:
+            yield captured
+        queries = counted_queries(captured)
+        self.assertLessEqual(len(queries), view.query_budget, "\n".join(queries))
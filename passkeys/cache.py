@@ -0,0 +1,370 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from fido2.utils import websafe_decode
+from fido2.webauthn import AttestedCredentialData
+
+from .binary import credential_hash, credential_key
+from .bloom import amight_exist, might_exist
+from .models import UserPasskey
+from .utils import sync_to_async
+
+
+class LRUCache:
+    """A small thread-safe LRU mapping with an optional per-entry timeout"""
+
+    def __init__(self, max_size, timeout=None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Store value and return the value now cached under key"""
+        if self.max_size <= 0:
+            return value
+        expires = time.monotonic() + self.timeout if self.timeout else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+        return value
+
+    def setdefault(self, key, value):
+        """Store value unless key is already cached, return the cached value"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and (item[1] is None or item[1] >= time.monotonic()):
+                self._data.move_to_end(key)
+                return item[0]
+        return self.set(key, value)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return item[0] if item is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+CachedCredential = namedtuple(
+    "CachedCredential",
+    ["id", "user_id", "enabled", "name", "platform", "credential", "user_handle"],
+    defaults=(None,),
+)
+
+_credentials = LRUCache(
+    getattr(settings, "PASSKEYS_CREDENTIAL_CACHE_SIZE", 0),
+    getattr(settings, "PASSKEYS_CREDENTIAL_CACHE_TIMEOUT", 60),
+)
+
+
+def _shared_cache():
+    alias = getattr(settings, "PASSKEYS_CREDENTIAL_CACHE", None)
+    return caches[alias] if alias else None
+
+
+def _cache_key(credential_id):
+    return "passkeys:credential:%s" % hashlib.sha256(
+        credential_id.encode("utf8")
+    ).hexdigest()
+
+
+def _passkeys(credential_id, **filters):
+    """The passkey of credential_id, looked up by the narrow credential_id_hash index"""
+    raw = credential_key(credential_id)
+    return UserPasskey.objects.filter(
+        credential_id_hash=credential_hash(raw), raw_credential_id=raw, **filters
+    )
+
+
+def _legacy_passkeys(credential_id, **filters):
+    """The passkey of credential_id if the backfill hasn't converted it yet"""
+    return UserPasskey.objects.filter(
+        credential_id_hash__isnull=True, credential_id=credential_id, **filters
+    )
+
+
+_ROW_FIELDS = (
+    "id", "user_id", "enabled", "name", "platform", "credential_data", "token", "user_handle"
+)
+
+
+def _decode_row(row):
+    data = row[5]
+    return row[:5] + (bytes(data) if data is not None else websafe_decode(row[6]), row[7])
+
+
+def _cache_timeout():
+    return getattr(settings, "PASSKEYS_CREDENTIAL_CACHE_TIMEOUT", 60)
+
+
+def _remember(credential_id, row):
+    # rows shared before user_handle was cached have 6 items
+    entry = CachedCredential(*row[:5], AttestedCredentialData(row[5]), *row[6:7])
+    return _credentials.set(credential_id, entry)
+
+
+def _passkey_row(passkey):
+    return (
+        passkey.id,
+        passkey.user_id,
+        passkey.enabled,
+        passkey.name,
+        passkey.platform,
+        passkey.attested_credential_data,
+        passkey.user_handle,
+    )
+
+
+def _cached_row(credential_id):
+    shared = _shared_cache()
+    return shared.get(_cache_key(credential_id)) if shared is not None else None
+
+
+def _share_row(credential_id, row):
+    shared = _shared_cache()
+    if shared is not None:
+        shared.set(_cache_key(credential_id), row, _cache_timeout())
+
+
+async def _acached_row(credential_id):
+    shared = _shared_cache()
+    return await shared.aget(_cache_key(credential_id)) if shared is not None else None
+
+
+async def _ashare_row(credential_id, row):
+    shared = _shared_cache()
+    if shared is not None:
+        await shared.aset(_cache_key(credential_id), row, _cache_timeout())
+
+
+def get_credential(credential_id):
+    """Returns a CachedCredential for credential_id or None if it is unknown.
+
+    Lookups go through the in-process LRU (PASSKEYS_CREDENTIAL_CACHE_SIZE), then the
+    Django cache named by PASSKEYS_CREDENTIAL_CACHE and finally the database.
+    """
+    entry = _credentials.get(credential_id)
+    if entry is not None:
+        return entry
+
+    row = _cached_row(credential_id)
+    if row is None:
+        if not might_exist("credentials", credential_id):
+            return None
+        row = _passkeys(credential_id).values_list(*_ROW_FIELDS).first()
+        if row is None:
+            row = _legacy_passkeys(credential_id).values_list(*_ROW_FIELDS).first()
+            if row is None:
+                return None
+        row = _decode_row(row)
+        _share_row(credential_id, row)
+    return _remember(credential_id, row)
+
+
+async def aget_credential(credential_id):
+    """Async variant of get_credential"""
+    entry = _credentials.get(credential_id)
+    if entry is not None:
+        return entry
+
+    row = await _acached_row(credential_id)
+    if row is None:
+        if not await amight_exist("credentials", credential_id):
+            return None
+        row = await _passkeys(credential_id).values_list(*_ROW_FIELDS).afirst()
+        if row is None:
+            row = await _legacy_passkeys(credential_id).values_list(*_ROW_FIELDS).afirst()
+            if row is None:
+                return None
+        row = _decode_row(row)
+        await _ashare_row(credential_id, row)
+    return _remember(credential_id, row)
+
+
+def _enabled_passkey(pk):
+    # by primary key, the cached entry only saves parsing the credential
+    return UserPasskey.objects.filter(pk=pk, enabled=True).select_related("user")
+
+
+def _handle_matches(entry, user_handles):
+    """Keys registered with a user handle only log in with that handle"""
+    return not user_handles or entry.user_handle is None or entry.user_handle in user_handles
+
+
+def get_credential_with_user(credential_id, user_handles=()):
+    """Returns (CachedCredential, user) for credential_id, (None, None) if it is unknown.
+
+    When the passkey isn't cached it is read together with its user in a single
+    query on the partial index of enabled passkeys, a disabled one is then
+    reported as unknown. A cached passkey is still checked to exist and be enabled
+    by the query that reads its user, so a key disabled or deleted by another
+    process can't log in.
+    If user_handles, the base64url user handles the authenticator may have sent,
+    is given, a passkey registered with another handle is reported as unknown.
+    """
+    entry = _credentials.get(credential_id)
+    if entry is None:
+        row = _cached_row(credential_id)
+        if row is None:
+            if not might_exist("credentials", credential_id):
+                return None, None
+            passkey = _passkeys(credential_id, enabled=True).select_related("user").first()
+            if passkey is None:
+                legacy = _legacy_passkeys(credential_id, enabled=True)
+                passkey = legacy.select_related("user").first()
+                if passkey is None:
+                    return None, None
+            row = _passkey_row(passkey)
+            _share_row(credential_id, row)
+            entry = _remember(credential_id, row)
+            if not _handle_matches(entry, user_handles):
+                return None, None
+            return entry, passkey.user
+        entry = _remember(credential_id, row)
+    if not _handle_matches(entry, user_handles):
+        return None, None
+    passkey = _enabled_passkey(entry.id).first()
+    if passkey is None:
+        invalidate_credential(credential_id)
+        return None, None
+    return entry, passkey.user
+
+
+async def aget_credential_with_user(credential_id, user_handles=()):
+    """Async variant of get_credential_with_user"""
+    entry = _credentials.get(credential_id)
+    if entry is None:
+        row = await _acached_row(credential_id)
+        if row is None:
+            if not await amight_exist("credentials", credential_id):
+                return None, None
+            passkey = await _passkeys(credential_id, enabled=True).select_related("user").afirst()
+            if passkey is None:
+                legacy = _legacy_passkeys(credential_id, enabled=True)
+                passkey = await legacy.select_related("user").afirst()
+                if passkey is None:
+                    return None, None
+            row = _passkey_row(passkey)
+            await _ashare_row(credential_id, row)
+            entry = _remember(credential_id, row)
+            if not _handle_matches(entry, user_handles):
+                return None, None
+            return entry, passkey.user
+        entry = _remember(credential_id, row)
+    if not _handle_matches(entry, user_handles):
+        return None, None
+    passkey = await _enabled_passkey(entry.id).afirst()
+    if passkey is None:
+        await sync_to_async(invalidate_credential)(credential_id)
+        return None, None
+    return entry, passkey.user
+
+
+def invalidate_credential(credential_id):
+    """Forget any cached copy of credential_id"""
+    _credentials.pop(credential_id)
+    shared = _shared_cache()
+    if shared is not None:
+        shared.delete(_cache_key(credential_id))
+
+
+@receiver(post_save, sender=UserPasskey)
+@receiver(post_delete, sender=UserPasskey)
+def _invalidate_passkey(sender, instance, **kwargs):
+    invalidate_credential(instance.credential_id)
+
+
+def _user_cache():
+    """(cache, timeout, field names) of PASSKEYS_USER_CACHE, None if it isn't set"""
+    config = getattr(settings, "PASSKEYS_USER_CACHE", None)
+    if config is None:
+        return None
+    User = get_user_model()
+    names = config.get("FIELDS")
+    if names is not None:
+        # what login and the session hash check need
+        names = set(names) | {User._meta.pk.name, User.USERNAME_FIELD, "password", "is_active"}
+    fields = [
+        field.attname
+        for field in User._meta.concrete_fields
+        if names is None or field.name in names or field.attname in names
+    ]
+    return caches[config.get("CACHE", "default")], config.get("TIMEOUT", 60), fields
+
+
+def _user_key(user_id):
+    return "passkeys:user:%s" % user_id
+
+
+def get_cached_user(user_id):
+    """Returns the user with pk user_id, or None, from a snapshot in the cache.
+
+    The snapshot holds the FIELDS of PASSKEYS_USER_CACHE (all concrete fields by
+    default), the others are loaded on first access like deferred fields.
+    """
+    User = get_user_model()
+    config = _user_cache()
+    if config is None:
+        return User._default_manager.filter(pk=user_id).first()
+    cache, timeout, fields = config
+    values = cache.get(_user_key(user_id))
+    if values is None or len(values) != len(fields):
+        values = User._default_manager.filter(pk=user_id).values_list(*fields).first()
+        if values is None:
+            return None
+        cache.set(_user_key(user_id), values, timeout)
+    return User.from_db(User._default_manager.db, fields, values)
+
+
+def invalidate_user(user_id):
+    """Forget the cached snapshot of a user"""
+    config = _user_cache()
+    if config is not None:
+        config[0].delete(_user_key(user_id))
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def _invalidate_user(sender, instance, using=None, **kwargs):
+    if getattr(settings, "PASSKEYS_USER_CACHE", None) is not None:
+        user_id = instance.pk
+        invalidate_user(user_id)
+        # again once committed, a concurrent request may have cached the old row
+        transaction.on_commit(lambda: invalidate_user(user_id), using=using)
+
+
+@receiver(setting_changed)
+def _reset_credentials(setting, **kwargs):
+    if setting.startswith("PASSKEYS_CREDENTIAL_CACHE"):
+        _credentials.clear()
+        _credentials.max_size = getattr(settings, "PASSKEYS_CREDENTIAL_CACHE_SIZE", 0)
+        _credentials.timeout = _cache_timeout()
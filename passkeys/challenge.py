@@ -0,0 +1,183 @@
+import base64
+import hashlib
+import json
+import secrets
+
+from cryptography.fernet import Fernet, InvalidToken
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .utils import asession_pop, asession_set, load_backend, sync_to_async
+
+
+class BaseChallengeStore:
+    """Keeps the fido2 state between the begin and the complete step of a ceremony.
+
+    save() returns a handle that is sent to the client with the options, the client
+    posts it back as 'fido2_state' and pop() receives it again.
+    """
+
+    def save(self, request, state):  # pragma: no cover
+        raise NotImplementedError
+
+    def pop(self, request, handle=None):  # pragma: no cover
+        raise NotImplementedError
+
+    async def asave(self, request, state):
+        return await sync_to_async(self.save)(request, state)
+
+    async def apop(self, request, handle=None):
+        return await sync_to_async(self.pop)(request, handle)
+
+
+class SessionChallengeStore(BaseChallengeStore):
+    """Stores the state in the user's session, no handle is given to the client"""
+
+    session_key = "fido2_state"
+
+    def save(self, request, state):
+        request.session[self.session_key] = state
+        return None
+
+    def pop(self, request, handle=None):
+        return request.session.pop(self.session_key, None)
+
+    async def asave(self, request, state):
+        await asession_set(request.session, self.session_key, state)
+        return None
+
+    async def apop(self, request, handle=None):
+        return await asession_pop(request.session, self.session_key)
+
+
+class CacheChallengeStore(BaseChallengeStore):
+    """Stores the state in a Django cache under a random handle for `timeout` seconds"""
+
+    key_prefix = "passkeys:challenge:"
+
+    def __init__(self, alias="default", timeout=120):
+        self.alias = alias
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def save(self, request, state):
+        handle = secrets.token_urlsafe(32)
+        self.cache.set(self.key_prefix + handle, state, self.timeout)
+        return handle
+
+    def _consumed(self, key, deleted):
+        """Whether the request that read key is the one allowed to use it"""
+        if deleted is None:
+            # Before Django 3.1 delete() doesn't say whether it removed the entry,
+            # the first request to add the marker wins instead.
+            return self.cache.add(key + ":used", 1, self.timeout)
+        return deleted
+
+    def pop(self, request, handle=None):
+        if not handle:
+            return None
+        key = self.key_prefix + handle
+        state = self.cache.get(key)
+        # Only the request that manages to delete the entry may use it.
+        if state is None or not self._consumed(key, self.cache.delete(key)):
+            return None
+        return state
+
+    async def asave(self, request, state):
+        handle = secrets.token_urlsafe(32)
+        await self.cache.aset(self.key_prefix + handle, state, self.timeout)
+        return handle
+
+    async def apop(self, request, handle=None):
+        if not handle:
+            return None
+        key = self.key_prefix + handle
+        state = await self.cache.aget(key)
+        if state is None or not await self.cache.adelete(key):
+            return None
+        return state
+
+
+class SignedChallengeStore(BaseChallengeStore):
+    """Stateless store, the state is encrypted and signed (Fernet) and handed to the client.
+
+    Used tokens are remembered in the `replay_cache` alias for `timeout` seconds so
+    that each one is accepted once. With replay_cache=None nothing is written on the
+    server and a token can be replayed until it expires, only opt out if the cache
+    isn't shared between the processes anyway.
+    """
+
+    key_prefix = "passkeys:challenge:used:"
+
+    def __init__(self, timeout=120, replay_cache="default", secret=None):
+        self.timeout = timeout
+        self.replay_cache = replay_cache
+        secret = secret or settings.SECRET_KEY
+        self.fernet = Fernet(
+            base64.urlsafe_b64encode(
+                hashlib.sha256(("passkeys.challenge" + secret).encode("utf8")).digest()
+            )
+        )
+
+    def save(self, request, state):
+        return self.fernet.encrypt(json.dumps(state).encode("utf8")).decode("ascii")
+
+    def _decode(self, handle):
+        try:
+            return json.loads(self.fernet.decrypt(handle.encode("ascii"), ttl=self.timeout))
+        except (InvalidToken, UnicodeEncodeError, ValueError):
+            return None
+
+    def _used_key(self, handle):
+        return self.key_prefix + hashlib.sha256(handle.encode("ascii")).hexdigest()
+
+    def pop(self, request, handle=None):
+        state = self._decode(handle) if handle else None
+        if state is not None and self.replay_cache:
+            if not caches[self.replay_cache].add(self._used_key(handle), 1, self.timeout):
+                return None
+        return state
+
+    async def asave(self, request, state):
+        return self.save(request, state)
+
+    async def apop(self, request, handle=None):
+        state = self._decode(handle) if handle else None
+        if state is not None and self.replay_cache:
+            cache = caches[self.replay_cache]
+            if not await cache.aadd(self._used_key(handle), 1, self.timeout):
+                return None
+        return state
+
+
+_store = None
+
+
+def get_challenge_store():
+    """Returns the store configured by PASSKEYS_CHALLENGE_STORE.
+
+    The setting is either a dotted path or a dict with 'BACKEND' and 'OPTIONS' keys,
+    it defaults to passkeys.challenge.SessionChallengeStore.
+    """
+    global _store
+    if _store is None:
+        _store = load_backend(
+            getattr(
+                settings,
+                "PASSKEYS_CHALLENGE_STORE",
+                "passkeys.challenge.SessionChallengeStore",
+            )
+        )
+    return _store
+
+
+@receiver(setting_changed)
+def _reset_store(setting, **kwargs):
+    global _store
+    if setting in ("PASSKEYS_CHALLENGE_STORE", "SECRET_KEY"):
+        _store = None
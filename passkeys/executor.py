@@ -0,0 +1,199 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import fido2.features
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from fido2.server import Fido2Server
+from fido2.webauthn import (
+    AttestedCredentialData,
+    PublicKeyCredentialParameters,
+    PublicKeyCredentialRpEntity,
+    PublicKeyCredentialType,
+)
+
+
+class VerificationQueueFull(Exception):
+    pass
+
+
+# The verification functions only get picklable arguments so that they can run
+# in a process pool. In this process they use the servers of FIDO2.get_server, the
+# workers of a pool keep their own, set up by _init_worker.
+_worker_servers = None
+
+
+class _WorkerServers:
+    """The Fido2Servers of a pool worker, the `size` most recently used are kept"""
+
+    def __init__(self, algorithms, size):
+        self.algorithms = algorithms
+        self.size = max(size, 1)
+        self.servers = OrderedDict()
+
+    def get(self, rp):
+        server = self.servers.pop(rp, None)
+        if server is None:
+            server = build_server(rp, self.algorithms)
+            while len(self.servers) >= self.size:
+                self.servers.popitem(last=False)
+        self.servers[rp] = server
+        return server
+
+
+def build_server(rp, algorithms=None):
+    """A Fido2Server of an (rp_id, rp_name) pair allowing the COSE `algorithms`
+    (fido2's defaults if None), without Django settings or models"""
+    server = Fido2Server(PublicKeyCredentialRpEntity(id=rp[0], name=rp[1]))
+    if algorithms is not None:
+        server.allowed_algorithms = [
+            PublicKeyCredentialParameters(type=PublicKeyCredentialType.PUBLIC_KEY, alg=alg)
+            for alg in algorithms
+        ]
+    return server
+
+
+def enable_json_mapping():
+    try:
+        fido2.features.webauthn_json_mapping.enabled = True
+    except Exception:
+        pass
+
+
+def _worker_args():
+    """The initargs of the pool workers, from PASSKEYS_ALGORITHMS and FIDO_SERVER_CACHE_SIZE"""
+    from .FIDO2 import get_algorithms
+
+    algorithms = get_algorithms()
+    if algorithms is not None:
+        algorithms = [int(parameters.alg) for parameters in algorithms]
+    return algorithms, getattr(settings, "FIDO_SERVER_CACHE_SIZE", 128)
+
+
+def _init_worker(algorithms, size):
+    global _worker_servers
+    enable_json_mapping()
+    _worker_servers = _WorkerServers(algorithms, size)
+
+
+def _worker_server(rp):
+    if _worker_servers is None:
+        from .FIDO2 import get_rp_server
+
+        return get_rp_server(rp)
+    return _worker_servers.get(rp)
+
+
+def complete_registration(server, state, data):
+    """Verifies a registration response with server, returns the raw authenticator data"""
+    return bytes(server.register_complete(state, response=data))
+
+
+def complete_authentication(server, state, credential_data, data):
+    """Verifies an assertion with server, raises ValueError if it is invalid"""
+    server.authenticate_complete(
+        state, credentials=[AttestedCredentialData(credential_data)], response=data
+    )
+
+
+def verify_registration(rp, state, data):
+    """Verifies a registration response and returns the raw authenticator data"""
+    return complete_registration(_worker_server(rp), state, data)
+
+
+def verify_authentication(rp, state, credential_data, data):
+    """Verifies an assertion, raises ValueError if it is invalid"""
+    complete_authentication(_worker_server(rp), state, credential_data, data)
+
+
+class VerificationExecutor:
+    """Runs the CPU-bound ceremony steps off the event loop.
+
+    At most `max_pending` calls may be queued or running, further calls raise
+    VerificationQueueFull instead of piling up behind a burst.
+    """
+
+    def __init__(self, kind="thread", max_workers=None, max_pending=64):
+        if kind == "thread":
+            self.executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="passkeys-verify"
+            )
+        elif kind == "process":
+            self.executor = ProcessPoolExecutor(
+                max_workers=max_workers, initializer=_init_worker, initargs=_worker_args()
+            )
+        else:
+            raise ImproperlyConfigured(
+                "PASSKEYS_VERIFY_EXECUTOR KIND must be 'thread' or 'process'"
+            )
+        self.kind = kind
+        self.max_pending = max_pending
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def depth(self):
+        """Number of calls queued or running"""
+        return self._pending
+
+    async def run(self, fn, *args):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise VerificationQueueFull(
+                    "%d verifications are already pending" % self._pending
+                )
+            self._pending += 1
+        try:
+            return await asyncio.wrap_future(self.executor.submit(fn, *args))
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_verification_executor():
+    """Returns the executor configured by PASSKEYS_VERIFY_EXECUTOR.
+
+    The setting is a dict with the optional keys KIND ('thread' or 'process'),
+    MAX_WORKERS and MAX_PENDING.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                config = getattr(settings, "PASSKEYS_VERIFY_EXECUTOR", {})
+                _executor = VerificationExecutor(
+                    kind=config.get("KIND", "thread"),
+                    max_workers=config.get("MAX_WORKERS"),
+                    max_pending=config.get("MAX_PENDING", 64),
+                )
+    return _executor
+
+
+def queue_depth():
+    """Number of verifications queued or running in this process"""
+    return _executor.depth if _executor is not None else 0
+
+
+@receiver(setting_changed)
+def _reset_executor(setting, **kwargs):
+    global _executor
+    if _executor is None:
+        return
+    # the workers of a process pool were set up with the server settings
+    if setting == "PASSKEYS_VERIFY_EXECUTOR" or (
+        _executor.kind == "process"
+        and setting in ("PASSKEYS_ALGORITHMS", "FIDO_SERVER_CACHE_SIZE")
+    ):
+        _executor.shutdown()
+        _executor = None
@@ -17,7 +17,12 @@ class LoginOptionsForm(forms.Form):
             attrs={"autofocus": True, "autocomplete": "username webauthn"}
         ),
     )
-    username = forms.CharField(label=_("Your username"), max_length=155, required=True)
+    username = forms.CharField(
+        label=_("Your username"),
+        max_length=155,
+        required=True,
+        widget=forms.TextInput(attrs={"autocomplete": "username webauthn"}),
+    )
     next = forms.CharField(required=False, widget=forms.HiddenInput())
 
     def __init__(self, *args, **kwargs):
@@ -38,25 +43,29 @@ class PasswordLoginForm(LoginOptionsForm):
         widget=forms.PasswordInput(),
     )
 
+    def __init__(self, *args, **kwargs):
+        self.user_cache = None
+        super().__init__(*args, **kwargs)
+
     def clean(self):
         email_or_username, password = (
             self.cleaned_data.get(UserModel.USERNAME_FIELD),
             self.cleaned_data.get("password"),
         )
         kwargs = {UserModel.USERNAME_FIELD: email_or_username}
-        user = authenticate(request=None, password=password, **kwargs)
-        if user is None:
+        # authenticate() records the backend on the user, login_user() reuses it
+        # instead of hashing the password a second time.
+        self.user_cache = authenticate(request=None, password=password, **kwargs)
+        if self.user_cache is None:
             self.add_error("password", _("Wrong email or password."))
 
+    def get_user(self):
+        return self.user_cache
+
     def login_user(self, request):
         assert self.is_bound
-        email_or_username, password = (
-            self.cleaned_data.get(UserModel.USERNAME_FIELD),
-            self.cleaned_data.get("password"),
-        )
-        kwargs = {UserModel.USERNAME_FIELD: email_or_username}
-        user = authenticate(request=request, password=password, **kwargs)
-        if user.is_active:
+        user = self.user_cache
+        if user is not None and user.is_active:
             login(request, user)
             return user
 
@@ -0,0 +1,224 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.template.loader import render_to_string
+from django.utils.html import strip_tags
+from django.utils.module_loading import import_string
+from django.utils.translation import gettext as _
+
+from .utils import load_backend
+
+logger = logging.getLogger("passkeys.mail")
+
+
+def build_otp_message(email, code, connection=None):
+    """The email carrying code, passkeys/email/otp.html is rendered once for both parts"""
+    subject = _("Your one time pass code")
+    html = render_to_string("passkeys/email/otp.html", {"key": code, "subject": subject})
+    message = EmailMultiAlternatives(
+        subject=subject,
+        body=strip_tags(html),
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=(email,),
+        connection=connection,
+    )
+    message.attach_alternative(html, "text/html")
+    return message
+
+
+class BaseOTPDispatcher:
+    """Delivers the one time codes of otp_login"""
+
+    def dispatch(self, email, code):  # pragma: no cover
+        raise NotImplementedError
+
+    def join(self, timeout=None):
+        """Waits until the dispatched codes were handed to the mail backend"""
+        return True
+
+
+class SyncOTPDispatcher(BaseOTPDispatcher):
+    """Sends the email inline, the request waits for the mail server"""
+
+    def dispatch(self, email, code):
+        build_otp_message(email, code).send()
+
+
+class TaskOTPDispatcher(BaseOTPDispatcher):
+    """Hands (email, code) to an external task queue.
+
+    `task` is the dotted path of a callable or of a task with a delay() method
+    (e.g. a Celery task) that sends the code, e.g. with build_otp_message().
+    """
+
+    def __init__(self, task):
+        self.task = import_string(task)
+
+    def dispatch(self, email, code):
+        delay = getattr(self.task, "delay", None)
+        (delay or self.task)(email, code)
+
+
+class ThreadedOTPDispatcher(BaseOTPDispatcher):
+    """Sends the emails from `max_workers` background threads.
+
+    Messages are rendered in the request, so that they use its language, and
+    queued. At most `max_pending` messages wait, further ones are dropped and
+    logged. A worker sends whatever is queued, up to `batch_size` messages, over
+    one connection and retries a failed message `retries` times, waiting
+    `backoff`, 2 * `backoff`, ... seconds in between. The configured dispatcher
+    gets 10 seconds to send its queue when the process exits.
+    """
+
+    def __init__(self, max_workers=2, max_pending=1000, batch_size=50, retries=3, backoff=1.0):
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self._queue = queue.Queue(max_pending)
+        self._pending = 0
+        self._done = threading.Condition()
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            while len(self._workers) < self.max_workers:
+                worker = threading.Thread(
+                    target=self._run,
+                    name="passkeys-mail-%d" % len(self._workers),
+                    daemon=True,
+                )
+                worker.start()
+                self._workers.append(worker)
+
+    def dispatch(self, email, code):
+        message = build_otp_message(email, code)
+        with self._done:
+            self._pending += 1
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            self._finished(1)
+            logger.error("OTP mail queue is full, dropped the code for %s", email)
+            return
+        if len(self._workers) < self.max_workers:
+            self._start()
+
+    def _finished(self, count):
+        with self._done:
+            self._pending -= count
+            self._done.notify_all()
+
+    def _run(self):
+        while True:
+            message = self._queue.get()
+            if message is None:
+                return
+            batch = [message]
+            while len(batch) < self.batch_size:
+                try:
+                    message = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if message is None:
+                    self._queue.put(None)  # for this worker's next turn
+                    break
+                batch.append(message)
+            try:
+                self.send_batch(batch)
+            finally:
+                self._finished(len(batch))
+
+    def send_batch(self, messages):
+        connection = get_connection()
+        try:
+            for message in messages:
+                message.connection = connection
+                for attempt in range(self.retries + 1):
+                    try:
+                        connection.open()  # a no-op while it is open
+                        message.send()
+                        break
+                    except Exception:
+                        # The connection may be broken, the next attempt reopens it.
+                        _close(connection)
+                        if attempt == self.retries:
+                            logger.exception("Failed to send the OTP mail to %s", message.to)
+                        else:
+                            time.sleep(self.backoff * 2**attempt)
+        finally:
+            _close(connection)
+
+    def join(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._done:
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._done.wait(remaining)
+        return True
+
+    def shutdown(self, timeout=10):
+        """Sends the queued messages and stops the workers"""
+        self.join(timeout)
+        with self._lock:
+            for _ in self._workers:
+                self._queue.put(None)
+            self._workers = []
+
+
+def _close(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_otp_dispatcher():
+    """Returns the dispatcher configured by PASSKEYS_OTP_DISPATCHER.
+
+    The setting is either a dotted path or a dict with 'BACKEND' and 'OPTIONS' keys,
+    it defaults to passkeys.mail.ThreadedOTPDispatcher.
+    """
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = load_backend(
+                    getattr(
+                        settings,
+                        "PASSKEYS_OTP_DISPATCHER",
+                        "passkeys.mail.ThreadedOTPDispatcher",
+                    )
+                )
+    return _dispatcher
+
+
+@atexit.register
+def _drain_at_exit():
+    # the dispatchers replaced by _reset_dispatcher were already shut down
+    if _dispatcher is not None:
+        _dispatcher.join(10)
+
+
+@receiver(setting_changed)
+def _reset_dispatcher(setting, **kwargs):
+    global _dispatcher
+    if setting in ("PASSKEYS_OTP_DISPATCHER", "EMAIL_BACKEND"):
+        shutdown = getattr(_dispatcher, "shutdown", None)
+        if shutdown is not None:
+            shutdown()
+        _dispatcher = None
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from passkeys.binary import backfill
+from passkeys.models import UserPasskey
+
+
+class Command(BaseCommand):
+    help = "Fills the binary credential columns of passkeys stored before they existed"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--pause", type=float, default=0, help="Seconds to sleep between batches"
+        )
+
+    def handle(self, *args, **options):
+        done = backfill(
+            UserPasskey,
+            batch_size=options["batch_size"],
+            pause=options["pause"],
+            log=self.stdout.write if options["verbosity"] > 1 else None,
+        )
+        self.stdout.write("Converted %d passkey(s)" % done)
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from passkeys.usage import flush_usage
+
+
+class Command(BaseCommand):
+    help = (
+        "Writes the passkey usage (last_used) updates held by a CacheUsageBuffer, "
+        "a ProcessUsageBuffer only holds the updates of its own process"
+    )
+
+    def handle(self, *args, **options):
+        written = flush_usage()
+        self.stdout.write("Flushed usage of %d passkey(s)" % written)
@@ -0,0 +1,60 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from passkeys.otp import get_otp_backend
+from passkeys.purge import purge
+
+
+class Command(BaseCommand):
+    help = "Deletes expired one time codes and, if asked, disabled or unused passkeys"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--otps",
+            type=int,
+            help="Delete codes older than this many seconds (default: the OTP timeout)",
+        )
+        parser.add_argument(
+            "--disabled",
+            type=int,
+            help="Delete disabled passkeys not used for this many days",
+        )
+        parser.add_argument(
+            "--unused-since",
+            help="Delete passkeys not used since this date (YYYY-MM-DD or ISO 8601)",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--pause", type=float, default=0, help="Seconds to sleep between batches"
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true", help="Only count the rows to delete"
+        )
+
+    def handle(self, *args, **options):
+        otps = options["otps"]
+        if otps is None:
+            otps = getattr(get_otp_backend(), "timeout", 60)
+        disabled = options["disabled"]
+        unused_since = options["unused_since"]
+        if unused_since is not None:
+            parsed = parse_datetime(unused_since) or parse_datetime(unused_since + "T00:00")
+            if parsed is None:
+                raise CommandError("Invalid --unused-since: %s" % unused_since)
+            if timezone.is_naive(parsed):
+                parsed = timezone.make_aware(parsed)
+            unused_since = parsed
+        counts = purge(
+            otps=datetime.timedelta(seconds=otps),
+            disabled=datetime.timedelta(days=disabled) if disabled is not None else None,
+            unused_since=unused_since,
+            batch_size=options["batch_size"],
+            pause=options["pause"],
+            dry_run=options["dry_run"],
+        )
+        verb = "Would delete" if options["dry_run"] else "Deleted"
+        for name, count in counts.items():
+            self.stdout.write("%s %d %s" % (verb, count, name))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from passkeys.bloom import warm_filters
+
+
+class Command(BaseCommand):
+    help = (
+        "Builds the snapshots of the PASSKEYS_NEGATIVE_LOOKUP filters in the cache, "
+        "so no request has to scan the users or passkeys"
+    )
+
+    def handle(self, *args, **options):
+        loaded = warm_filters()
+        self.stdout.write("Loaded %d filter(s)" % len(loaded))
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-18 10:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("passkeys", "0002_otp_userpasskey_uuid"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="userpasskey",
+            name="credential_data",
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name="userpasskey",
+            name="credential_id_hash",
+            field=models.BigIntegerField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="userpasskey",
+            name="raw_credential_id",
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AlterField(
+            model_name="userpasskey",
+            name="token",
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
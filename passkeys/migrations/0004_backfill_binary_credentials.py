@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.db import migrations
+
+
+def backfill(apps, schema_editor):
+    # Large tables can skip this and run `manage.py passkeys_backfill_credentials`
+    # while the new code is serving, it reads both layouts.
+    if getattr(settings, "PASSKEYS_DEFER_BACKFILL", False):
+        return
+    from passkeys.binary import backfill
+
+    backfill(apps.get_model("passkeys", "UserPasskey"))
+
+
+class Migration(migrations.Migration):
+    # One short transaction per batch instead of one for the whole table.
+    atomic = False
+
+    dependencies = [
+        ("passkeys", "0003_binary_credentials"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-18 10:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("passkeys", "0004_backfill_binary_credentials"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="otp",
+            index=models.Index(
+                fields=["email", "created_at"], name="passkeys_otp_email_created_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="userpasskey",
+            index=models.Index(
+                fields=["user", "-last_used"], name="passkeys_user_last_used_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="userpasskey",
+            index=models.Index(
+                condition=models.Q(("enabled", True)),
+                fields=["credential_id_hash"],
+                name="passkeys_enabled_cred_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:02
+
+from django.db import migrations, models
+
+
+def delete_plain_codes(apps, schema_editor):
+    # Codes are stored as digests now, the plain ones couldn't be used anyway.
+    apps.get_model("passkeys", "OTP").objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("passkeys", "0005_indexes"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="otp",
+            name="key",
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.RunPython(delete_plain_codes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 10:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("passkeys", "0006_otp_digest"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="userpasskey",
+            name="user_handle",
+            field=models.CharField(max_length=128, null=True),
+        ),
+    ]
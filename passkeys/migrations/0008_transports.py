@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("passkeys", "0007_user_handle"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="userpasskey",
+            name="backup_eligible",
+            field=models.BooleanField(null=True),
+        ),
+        migrations.AddField(
+            model_name="userpasskey",
+            name="backup_state",
+            field=models.BooleanField(null=True),
+        ),
+        migrations.AddField(
+            model_name="userpasskey",
+            name="transports",
+            field=models.CharField(max_length=64, null=True),
+        ),
+    ]
@@ -2,10 +2,10 @@ import uuid
 from django.contrib.auth import get_user_model
 from django.db import models
 from django.utils.translation import gettext_lazy as _
-from django.template.loader import render_to_string
-from django.utils.html import strip_tags
-from django.core.mail import EmailMultiAlternatives
 from django.conf import settings
+from fido2.utils import websafe_decode, websafe_encode
+
+from .binary import binary_fields, credential_hash, credential_key
 
 
 class UserPasskey(models.Model):
@@ -18,39 +18,85 @@ class UserPasskey(models.Model):
     added_on = models.DateTimeField(auto_now_add=True)
     last_used = models.DateTimeField(null=True, default=None)
     credential_id = models.CharField(max_length=255, unique=True)
-    token = models.CharField(max_length=255, null=False)
+    # Legacy base64url copy of credential_data, empty if it doesn't fit.
+    token = models.CharField(max_length=255, null=False, blank=True)
+    # Not redundant with passkeys_enabled_cred_idx: backends without partial indexes
+    # (MySQL, MariaDB) skip that one, and this is the index auth_complete uses there.
+    credential_id_hash = models.BigIntegerField(null=True, db_index=True)
+    raw_credential_id = models.BinaryField(null=True)
+    credential_data = models.BinaryField(null=True)
+    # base64url of the WebAuthn user.id the key was registered with, NULL for older keys
+    user_handle = models.CharField(max_length=128, null=True)
+    # comma separated AuthenticatorTransport values, NULL if the browser didn't report them
+    transports = models.CharField(max_length=64, null=True)
+    backup_eligible = models.BooleanField(null=True)
+    backup_state = models.BooleanField(null=True)
+
+    binary_fields = ("credential_id_hash", "raw_credential_id", "credential_data")
+
+    class Meta:
+        indexes = [
+            # index: a user's keys by -last_used
+            models.Index(fields=["user", "-last_used"], name="passkeys_user_last_used_idx"),
+            # auth_complete: only enabled passkeys can log in
+            models.Index(
+                fields=["credential_id_hash"],
+                condition=models.Q(enabled=True),
+                name="passkeys_enabled_cred_idx",
+            ),
+        ]
 
     def __str__(self):
         return f"UserPasskey: {self.user} - {self.name}"
 
+    def set_credential(self, credential_id, credential_data):
+        """Stores a credential from its base64url id and its raw attested credential data"""
+        raw = credential_key(credential_id)
+        self.credential_id = credential_id
+        self.credential_id_hash = credential_hash(raw)
+        self.raw_credential_id = raw
+        self.credential_data = bytes(credential_data)
+        token = websafe_encode(self.credential_data)
+        self.token = token if len(token) <= 255 else ""
+
+    def fill_binary_fields(self):
+        """Derives the binary columns from credential_id and token if they are missing"""
+        if self.credential_id_hash is None and self.credential_id:
+            for name, value in binary_fields(self.credential_id, self.token).items():
+                setattr(self, name, value)
+
+    @property
+    def attested_credential_data(self):
+        """The raw attested credential data, whichever column holds it"""
+        if self.credential_data is not None:
+            return bytes(self.credential_data)
+        return websafe_decode(self.token)
+
+    def save(self, *args, **kwargs):
+        self.fill_binary_fields()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and {"credential_id", "token"} & set(update_fields):
+            kwargs["update_fields"] = set(update_fields) | set(self.binary_fields)
+        super().save(*args, **kwargs)
+
 
 class OTP(models.Model):
     email = models.EmailField(_("Email"), max_length=254)
-    key = models.CharField(max_length=6, blank=True, null=True)
+    # Keyed digest of the code, see passkeys.otp.BaseOTPBackend.digest()
+    key = models.CharField(max_length=64, blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
-    def send(self):
-        subject = _("Your one time pass code")
-        if self.email and self.key:
-            html = render_to_string(
-                "passkeys/email/otp.html",
-                {"key": self.key, "subject": subject},
-            )
-            text = strip_tags(
-                render_to_string(
-                    "passkeys/email/otp.html",
-                    {
-                        "key": self.key,
-                        "subject": subject,
-                    },
-                )
-            )
-            email = EmailMultiAlternatives(
-                subject=subject,
-                body=text,
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                to=(self.email,),
-            )
-            email.attach_alternative(html, "text/html")
-            email.send()
+    class Meta:
+        indexes = [
+            # otp_login: the recent codes sent to an email
+            models.Index(fields=["email", "created_at"], name="passkeys_otp_email_created_idx"),
+        ]
+
+    def send(self, code=None):
+        """Mails code (key for rows that hold a plain code) to email"""
+        from .otp import send_otp
+
+        code = code or self.key
+        if self.email and code:
+            send_otp(self.email, code)
@@ -0,0 +1,172 @@
+import datetime
+import hashlib
+import hmac
+import secrets
+from string import digits
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.db.models import Q
+from django.utils.timezone import now as utc_now
+
+from .mail import build_otp_message
+from .utils import load_backend
+
+
+def send_otp(email, code):
+    """Mails code to email right away, see passkeys.mail for the dispatchers"""
+    build_otp_message(email, code).send()
+
+
+class BaseOTPBackend:
+    """Issues the one time codes of the OTP login and consumes them exactly once.
+
+    A code is valid for `timeout` seconds, at most `max_outstanding` codes of an
+    email are kept, requesting another one drops the oldest.
+    """
+
+    length = 6
+
+    def __init__(self, timeout=60, max_outstanding=5):
+        self.timeout = timeout
+        self.max_outstanding = max(int(max_outstanding), 1)
+
+    def generate_code(self):
+        return "".join(secrets.choice(digits) for _ in range(self.length))
+
+    def digest(self, email, code):
+        """Keyed hash of a code, only digests are stored"""
+        # salted_hmac(..., algorithm="sha256") needs Django 3.1, this is the same HMAC
+        key = hashlib.sha256(("passkeys.otp" + settings.SECRET_KEY).encode("utf8")).digest()
+        message = "%s:%s" % (email.casefold(), code)
+        return hmac.new(key, message.encode("utf8"), hashlib.sha256).hexdigest()
+
+    def create(self, email, code=None):
+        """Stores a new code for email and returns it"""
+        code = code or self.generate_code()
+        self.store(email, self.digest(email, code))
+        return code
+
+    def consume(self, email, code):
+        """True if code is a valid code of email, which can't be used again"""
+        if not email or not code:
+            return False
+        return self.consume_digest(email, self.digest(email, code))
+
+    def store(self, email, digest):  # pragma: no cover
+        raise NotImplementedError
+
+    def consume_digest(self, email, digest):  # pragma: no cover
+        raise NotImplementedError
+
+
+class DatabaseOTPBackend(BaseOTPBackend):
+    """Keeps the digests in the OTP model.
+
+    Consuming a code is a single conditional DELETE, creating one removes the
+    expired and surplus codes of the email.
+    """
+
+    def _cutoff(self):
+        return utc_now() - datetime.timedelta(seconds=self.timeout)
+
+    def store(self, email, digest):
+        from .models import OTP
+
+        codes = OTP.objects.filter(email=email)
+        surplus = list(
+            codes.order_by("-created_at", "-pk").values_list("pk", flat=True)[
+                self.max_outstanding - 1 :
+            ]
+        )
+        codes.filter(Q(created_at__lt=self._cutoff()) | Q(pk__in=surplus)).delete()
+        OTP.objects.create(email=email, key=digest)
+
+    def consume_digest(self, email, digest):
+        from .models import OTP
+
+        deleted, _ = OTP.objects.filter(
+            email=email, key=digest, created_at__gte=self._cutoff()
+        ).delete()
+        return deleted > 0
+
+
+class CacheOTPBackend(BaseOTPBackend):
+    """Keeps the digests in a Django cache, they expire with the cache's own timeout.
+
+    Every code of an email gets its own key holding its number in an atomic
+    per-email counter, a code is only valid while fewer than `max_outstanding`
+    codes were issued after it, so concurrent requests never overwrite each other.
+    """
+
+    key_prefix = "passkeys:otp:"
+
+    def __init__(self, alias="default", timeout=60, max_outstanding=5):
+        super().__init__(timeout, max_outstanding)
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _email_key(self, email):
+        return self.key_prefix + hashlib.sha256(email.casefold().encode("utf8")).hexdigest()
+
+    def _next_number(self, email):
+        key = self._email_key(email) + ":seq"
+        for _ in range(3):
+            self.cache.add(key, 0, self.timeout)
+            try:
+                number = self.cache.incr(key)
+            except ValueError:
+                # evicted or expired between add() and incr()
+                continue
+            # keep the counter as long as the code just numbered
+            self.cache.touch(key, self.timeout)
+            return number
+        raise ValueError("The OTP counter of %s keeps disappearing" % email)
+
+    def store(self, email, digest):
+        number = self._next_number(email)
+        self.cache.set("%s:%s" % (self._email_key(email), digest), number, self.timeout)
+
+    def consume_digest(self, email, digest):
+        seq_key = self._email_key(email) + ":seq"
+        key = "%s:%s" % (self._email_key(email), digest)
+        values = self.cache.get_many([key, seq_key])
+        number, last = values.get(key), values.get(seq_key)
+        # a counter restarted after an eviction also invalidates the older codes
+        if number is None or last is None or not 0 <= last - number < self.max_outstanding:
+            return False
+        # Only the request that manages to delete the code may use it.
+        deleted = self.cache.delete(key)
+        if deleted is None:
+            # Before Django 3.1 delete() doesn't say whether it removed the entry.
+            return self.cache.add(key + ":used", 1, self.timeout)
+        return deleted
+
+
+_backend = None
+
+
+def get_otp_backend():
+    """Returns the backend configured by PASSKEYS_OTP_BACKEND.
+
+    The setting is either a dotted path or a dict with 'BACKEND' and 'OPTIONS' keys,
+    it defaults to passkeys.otp.DatabaseOTPBackend.
+    """
+    global _backend
+    if _backend is None:
+        _backend = load_backend(
+            getattr(settings, "PASSKEYS_OTP_BACKEND", "passkeys.otp.DatabaseOTPBackend")
+        )
+    return _backend
+
+
+@receiver(setting_changed)
+def _reset_backend(setting, **kwargs):
+    global _backend
+    if setting in ("PASSKEYS_OTP_BACKEND", "SECRET_KEY"):
+        _backend = None
@@ -0,0 +1,112 @@
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .cache import LRUCache
+from .utils import load_backend
+
+
+class BasePlatformDetector:
+    """Names the platform authenticator a request most likely comes from.
+
+    The returned name is stored with new passkeys and compared on login to report
+    cross platform authentications.
+    """
+
+    def detect(self, request):  # pragma: no cover
+        raise NotImplementedError
+
+    def preload(self):
+        """Loads whatever detect() needs, called at startup if PASSKEYS_PRELOAD is set"""
+
+
+def _hint(value):
+    return value.strip().strip('"')
+
+
+def _brands(value):
+    """Returns the brand names of a Sec-CH-UA header"""
+    return {_hint(item.split(";", 1)[0]) for item in value.split(",")}
+
+
+class UserAgentPlatformDetector(BasePlatformDetector):
+    """Reads the User-Agent Client Hints if the browser sent them and parses the
+    User-Agent header otherwise, parsed User-Agents are kept in an LRU of
+    `cache_size` entries."""
+
+    def __init__(self, cache_size=1024):
+        self._platforms = LRUCache(cache_size)
+
+    def from_client_hints(self, platform, brands):
+        # Only Chromium based browsers send client hints, so never Safari. They all
+        # list the Chromium brand, Brave, Edge, Opera or Vivaldi are named like Chrome.
+        if platform == "macOS":
+            return "Chrome on Apple" if brands & {"Chromium", "Google Chrome"} else "Key"
+        if platform == "Android":
+            return "Google"
+        if platform == "Windows":
+            return "Microsoft"
+        return "Key"
+
+    def from_user_agent(self, user_agent):
+        from user_agents.parsers import parse as ua_parse
+
+        ua = ua_parse(user_agent)
+        # Like the client hints, every Chromium based browser on a Mac (Edge, Opera,
+        # Brave...) is named like Chrome, they all send a Chrome/ token and Safari doesn't.
+        if ua.os.family == "Mac OS X" and "Chrome/" in user_agent:
+            return "Chrome on Apple"
+        elif "Safari" in ua.browser.family:
+            return "Apple"
+        elif "Android" in ua.os.family:
+            return "Google"
+        elif "Windows" in ua.os.family:
+            return "Microsoft"
+        else:
+            return "Key"
+
+    def preload(self):
+        # ua-parser compiles its regexes on first use, do it before workers fork.
+        self.from_user_agent("Mozilla/5.0 (Windows NT 10.0; Win64; x64)")
+
+    def detect(self, request):
+        platform = request.META.get("HTTP_SEC_CH_UA_PLATFORM")
+        brands = request.META.get("HTTP_SEC_CH_UA")
+        if platform and brands:
+            return self.from_client_hints(_hint(platform), _brands(brands))
+
+        user_agent = request.META.get("HTTP_USER_AGENT")
+        if not user_agent:
+            return "Key"
+        name = self._platforms.get(user_agent)
+        if name is None:
+            name = self._platforms.set(user_agent, self.from_user_agent(user_agent))
+        return name
+
+
+_detector = None
+
+
+def get_platform_detector():
+    """Returns the detector configured by PASSKEYS_PLATFORM_DETECTOR.
+
+    The setting is either a dotted path or a dict with 'BACKEND' and 'OPTIONS' keys,
+    it defaults to passkeys.platform.UserAgentPlatformDetector.
+    """
+    global _detector
+    if _detector is None:
+        _detector = load_backend(
+            getattr(
+                settings,
+                "PASSKEYS_PLATFORM_DETECTOR",
+                "passkeys.platform.UserAgentPlatformDetector",
+            )
+        )
+    return _detector
+
+
+@receiver(setting_changed)
+def _reset_detector(setting, **kwargs):
+    global _detector
+    if setting == "PASSKEYS_PLATFORM_DETECTOR":
+        _detector = None
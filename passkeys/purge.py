@@ -0,0 +1,63 @@
+import time
+
+from django.db.models import Q
+from django.utils.timezone import now as utc_now
+
+from .models import OTP, UserPasskey
+
+
+def delete_in_chunks(queryset, batch_size=1000, pause=0, dry_run=False):
+    """Deletes the rows of queryset in primary key order, `batch_size` at a time.
+
+    Each chunk is a short DELETE of known primary keys, `pause` seconds apart, so
+    the table is never locked for long. Signals still fire for models that have
+    receivers. With dry_run the rows are only counted. Returns the number of rows.
+    """
+    if dry_run:
+        return queryset.count()
+    model = queryset.model
+    done = 0
+    last_pk = None
+    while True:
+        chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        pks = list(chunk.order_by("pk").values_list("pk", flat=True)[:batch_size])
+        if not pks:
+            return done
+        model._default_manager.filter(pk__in=pks).delete()
+        done += len(pks)
+        last_pk = pks[-1]
+        if pause:
+            time.sleep(pause)
+
+
+def _last_activity_before(cutoff):
+    # Keys that were never used count from the day they were added.
+    return Q(last_used__lt=cutoff) | Q(last_used__isnull=True, added_on__lt=cutoff)
+
+
+def purge(otps=None, disabled=None, unused_since=None, batch_size=1000, pause=0,
+          dry_run=False):
+    """Deletes old OTP codes and stale passkeys, returns the counts per kind.
+
+    otps: timedelta, OTP rows older than this are deleted.
+    disabled: timedelta, disabled passkeys that weren't used (or added, if never
+        used) within it are deleted.
+    unused_since: datetime, passkeys not used since then are deleted.
+
+    Nothing is deleted for the arguments that are None. Rows are deleted in
+    chunks, see delete_in_chunks().
+    """
+    now = utc_now()
+    querysets = {}
+    if otps is not None:
+        querysets["otps"] = OTP.objects.filter(created_at__lt=now - otps)
+    if disabled is not None:
+        querysets["disabled"] = UserPasskey.objects.filter(
+            _last_activity_before(now - disabled), enabled=False
+        )
+    if unused_since is not None:
+        querysets["unused"] = UserPasskey.objects.filter(_last_activity_before(unused_since))
+    return {
+        name: delete_in_chunks(queryset, batch_size, pause, dry_run)
+        for name, queryset in querysets.items()
+    }
@@ -0,0 +1,228 @@
+import asyncio
+import hashlib
+import math
+import re
+import threading
+import time
+from functools import lru_cache, wraps
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import HttpResponse, JsonResponse
+
+from .utils import load_backend, sync_to_async
+
+_PERIODS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+@lru_cache(maxsize=64)
+def parse_rate(rate):
+    """Parses "<limit>/<period>", e.g. "10/m" or "100/5m", into (limit, seconds)"""
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d*)\s*([smhd])\s*", rate)
+    if match is None:
+        raise ImproperlyConfigured("Invalid passkeys rate limit %r" % rate)
+    return int(match.group(1)), int(match.group(2) or 1) * _PERIODS[match.group(3)]
+
+
+class BaseRateLimiter:
+    """Counts the hits of a key, hit() returns 0 or the seconds until the next allowed hit"""
+
+    def hit(self, key, limit, period):  # pragma: no cover
+        raise NotImplementedError
+
+    async def ahit(self, key, limit, period):
+        return await sync_to_async(self.hit)(key, limit, period)
+
+
+class TokenBucketLimiter(BaseRateLimiter):
+    """In-process token buckets of `limit` tokens refilled over `period` seconds.
+
+    Each process counts on its own, the buckets of the `max_keys` least recently
+    seen keys are kept.
+    """
+
+    def __init__(self, max_keys=10000):
+        from .cache import LRUCache
+
+        self._buckets = LRUCache(max_keys)
+        self._lock = threading.Lock()
+
+    def hit(self, key, limit, period):
+        now = time.monotonic()
+        with self._lock:
+            tokens, at = self._buckets.get(key, (limit, now))
+            tokens = min(limit, tokens + (now - at) * limit / period)
+            if tokens >= 1:
+                retry_after = 0
+                tokens -= 1
+            else:
+                retry_after = (1 - tokens) * period / limit
+            self._buckets.set(key, (tokens, now))
+        return retry_after
+
+    async def ahit(self, key, limit, period):
+        return self.hit(key, limit, period)
+
+
+class CacheRateLimiter(BaseRateLimiter):
+    """Sliding window counters in a Django cache, shared by every process.
+
+    The hits of the previous fixed window are weighted by how much of it still
+    overlaps the sliding window.
+    """
+
+    key_prefix = "passkeys:ratelimit:"
+
+    def __init__(self, alias="default"):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _keys(self, key, period, now):
+        window = int(now // period)
+        key = self.key_prefix + hashlib.sha256(key.encode("utf8")).hexdigest()
+        return "%s:%d" % (key, window), "%s:%d" % (key, window - 1), now - window * period
+
+    @staticmethod
+    def _retry_after(count, previous, elapsed, limit, period):
+        if previous * (period - elapsed) / period + count <= limit:
+            return 0
+        if count > limit or not previous:
+            return period - elapsed
+        # the previous window's weight drops until the hits fit again
+        return max(period - elapsed - (limit - count) * period / previous, 0.001)
+
+    def hit(self, key, limit, period):
+        current, previous, elapsed = self._keys(key, period, time.time())
+        self.cache.add(current, 0, 2 * period)
+        try:
+            count = self.cache.incr(current)
+        except ValueError:  # expired or evicted in between
+            self.cache.set(current, 1, 2 * period)
+            count = 1
+        return self._retry_after(
+            count, self.cache.get(previous, 0), elapsed, limit, period
+        )
+
+    async def ahit(self, key, limit, period):
+        current, previous, elapsed = self._keys(key, period, time.time())
+        await self.cache.aadd(current, 0, 2 * period)
+        try:
+            count = await self.cache.aincr(current)
+        except ValueError:
+            await self.cache.aset(current, 1, 2 * period)
+            count = 1
+        return self._retry_after(
+            count, await self.cache.aget(previous, 0), elapsed, limit, period
+        )
+
+
+_limiter = None
+
+
+def get_rate_limiter():
+    """Returns the limiter configured by PASSKEYS_RATE_LIMITER.
+
+    The setting is either a dotted path or a dict with 'BACKEND' and 'OPTIONS' keys,
+    it defaults to passkeys.ratelimit.TokenBucketLimiter.
+    """
+    global _limiter
+    if _limiter is None:
+        _limiter = load_backend(
+            getattr(settings, "PASSKEYS_RATE_LIMITER", "passkeys.ratelimit.TokenBucketLimiter")
+        )
+    return _limiter
+
+
+def _config(name):
+    """(limit, period, keys) of the endpoint `name` in PASSKEYS_RATE_LIMITS, or None"""
+    config = getattr(settings, "PASSKEYS_RATE_LIMITS", {}).get(name)
+    if not config:
+        return None
+    if isinstance(config, str):
+        config = {"RATE": config}
+    keys = config.get("KEYS", ("ip",))
+    if isinstance(keys, str):
+        keys = (keys,)
+    return parse_rate(config["RATE"]) + (keys,)
+
+
+def _identities(request, keys):
+    for key in keys:
+        if key == "ip":
+            yield "ip:" + request.META.get("REMOTE_ADDR", "")
+        elif key == "user":
+            field = get_user_model().USERNAME_FIELD
+            username = request.POST.get(field) or request.POST.get("email")
+            if username:
+                yield "user:" + username.strip().casefold()
+        else:
+            raise ImproperlyConfigured("Unknown passkeys rate limit key %r" % key)
+
+
+def _too_many(retry_after, json):
+    message = "Too many requests, please try again later"
+    if json:
+        response = JsonResponse({"status": "ERR", "message": message}, status=429)
+    else:
+        response = HttpResponse(message, status=429, content_type="text/plain")
+    response["Retry-After"] = str(max(int(math.ceil(retry_after)), 1))
+    return response
+
+
+def rate_limit(name, json=False):
+    """Limits a view by the PASSKEYS_RATE_LIMITS entry `name`.
+
+    An entry is a rate such as "10/m" or a dict with 'RATE' and 'KEYS', the keys
+    are "ip" (REMOTE_ADDR) and "user" (the posted username or email), each one is
+    limited separately. Requests over the limit get a 429 response with
+    Retry-After before the view runs, as JSON if `json` is set.
+    """
+
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                config = _config(name)
+                if config is not None:
+                    limit, period, keys = config
+                    limiter = get_rate_limiter()
+                    for identity in _identities(request, keys):
+                        retry_after = await limiter.ahit(
+                            "%s:%s" % (name, identity), limit, period
+                        )
+                        if retry_after:
+                            return _too_many(retry_after, json)
+                return await view(request, *args, **kwargs)
+
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            config = _config(name)
+            if config is not None:
+                limit, period, keys = config
+                limiter = get_rate_limiter()
+                for identity in _identities(request, keys):
+                    retry_after = limiter.hit("%s:%s" % (name, identity), limit, period)
+                    if retry_after:
+                        return _too_many(retry_after, json)
+            return view(request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@receiver(setting_changed)
+def _reset_limiter(setting, **kwargs):
+    global _limiter
+    if setting == "PASSKEYS_RATE_LIMITER":
+        _limiter = None
@@ -42,10 +42,6 @@
         return base64String.replace(/\+/g, '-').replace(/\//g, '_').replace(/=/g, '');
     }
 
-    function bufferToUTF8String(value) {
-        return new TextDecoder('utf-8').decode(value);
-    }
-
 
     const base64urlEncode = (array) => {
         let arrayBuf = array
@@ -83,9 +79,11 @@
         }
         return creds;
     };
-    function getServerCredentials() {
+    function getServerCredentials(discoverable) {
+        // Discoverable logins don't name the user, the authenticator offers its passkeys
+        const query = discoverable ? "?mode=discoverable" : "";
         return new Promise((resolve, reject) => {
-            fetch(`${passkeysConfig.baseUrl}auth/begin/`)
+            fetch(`${passkeysConfig.baseUrl}auth/begin/${query}`)
                 .then(response => {
                     if (!response.ok) {
                         throw new Error('Could not get credentials from the server.');
@@ -101,6 +99,19 @@
         });
     }
 
+    function getInlineCredentials(keep) {
+        // Options the login view rendered into the page, they can only be used once.
+        // The autofill prompt keeps them for the modal one, which aborts it first.
+        const element = document.getElementById("passkey-options");
+        if (!element) {
+            return null;
+        }
+        if (!keep) {
+            element.remove();
+        }
+        return JSON.parse(element.textContent);
+    }
+
     function toPublicKeyCredentialDescriptor(descriptor) {
         const { id } = descriptor;
 
@@ -111,7 +122,7 @@
         };
     }
 
-    function startAuthentication(requestOptionsJSON) {
+    function startAuthentication(requestOptionsJSON, fido2State, mediation) {
         // We need to avoid passing empty array to avoid blocking retrieval
         // of public key
         let allowCredentials;
@@ -130,6 +141,10 @@
         const options = {
             publicKey,
         };
+        if (mediation) {
+            options.mediation = mediation;
+            options.signal = window.conditionUIAbortController.signal;
+        }
 
         // Wait for the user to complete assertion
         navigator.credentials.get(options)
@@ -141,7 +156,7 @@
 
                 let userHandle = undefined;
                 if (response.userHandle) {
-                    userHandle = bufferToUTF8String(response.userHandle);
+                    userHandle = bufferToBase64URLString(response.userHandle);
                 }
                 let attachmentOptions = ["platform", "cross-platform"];
                 let attachment = response.authenticatorAttachment;
@@ -157,9 +172,13 @@
                     type,
                     clientExtensionResults: credential.getClientExtensionResults(),
                     authenticatorAttachment: attachment && attachmentOptions.indexOf(attachment) != -1 ? attachment : undefined,
+                    fido2_state: fido2State,
                 })
             })
             .catch(error => {
+                if (mediation && error.name === "AbortError") {
+                    return;
+                }
                 console.error("Error occurred during authentication:", error);
                 Array.from(document.querySelectorAll("input[type='submit']")).forEach(input => {
                     input.disabled = false;
@@ -169,6 +188,7 @@
 
 
     const beginReg = () => {
+        let fido2State;
         fetch(`${passkeysConfig.baseUrl}registration/begin/`, {})
             .then(response => {
                 if (response.ok) {
@@ -177,7 +197,8 @@
                 throw new Error('Error getting registration data!');
             })
             .then(options => {
-                return navigator.credentials.create(options);
+                fido2State = options.fido2_state;
+                return navigator.credentials.create({ publicKey: options.publicKey });
             })
             .then(attestation => {
                 const { id, rawId, response, type } = attestation;
@@ -218,6 +239,7 @@
                     type,
                     clientExtensionResults: attestation.getClientExtensionResults(),
                     authenticatorAttachment: attachment && attachmentOptions.indexOf(attachment) != -1 ? attachment : undefined,
+                    fido2_state: fido2State,
                 }
                 return fetch(`${passkeysConfig.baseUrl}registration/complete/`, {
                     method: 'POST',
@@ -273,13 +295,23 @@
     }
 
 
-    function initialize() {
+    function abortConditionalLogin() {
+        if (window.conditionalUI) {
+            window.conditionUIAbortController.abort();
+            window.conditionalUI = false;
+        }
+    }
+
+    function initialize(options = {}) {
+        // A pending autofill request would block the modal prompt
+        abortConditionalLogin();
         Array.from(document.querySelectorAll("input[type='submit']")).forEach(input => {
             input.disabled = true;
         })
-        getServerCredentials()
+        const inline = getInlineCredentials();
+        (inline ? Promise.resolve(inline) : getServerCredentials(options.discoverable))
             .then(data => {
-                startAuthentication(data.publicKey);
+                startAuthentication(data.publicKey, data.fido2_state);
             })
             .catch(error => {
                 console.error('Error during login:', error);
@@ -291,10 +323,38 @@
 
 
 
+    function conditionalLogin() {
+        // Offers the passkeys in the autofill of fields with autocomplete="username webauthn"
+        if (!window.PublicKeyCredential || !PublicKeyCredential.isConditionalMediationAvailable) {
+            return;
+        }
+        PublicKeyCredential.isConditionalMediationAvailable()
+            .then(available => {
+                if (!available) {
+                    return;
+                }
+                const inline = getInlineCredentials(true);
+                return (inline ? Promise.resolve(inline) : getServerCredentials(true))
+                    .then(data => {
+                        // An aborted controller can't be reused, each prompt gets its own
+                        abortConditionalLogin();
+                        window.conditionUIAbortController = new AbortController();
+                        window.conditionUIAbortSignal = window.conditionUIAbortController.signal;
+                        window.conditionalUI = true;
+                        startAuthentication(data.publicKey, data.fido2_state, "conditional");
+                    });
+            })
+            .catch(error => {
+                console.error('Error during login:', error);
+            });
+    }
+
+
     window.djangoPasskey = {
         deleteKey: deleteKey,
         beginReg: beginReg,
         initialize: initialize,
+        conditionalLogin: conditionalLogin,
         toggleKey: toggleKey
     };
 
@@ -0,0 +1,344 @@
+"""Helpers for testing projects that use passkeys.
+
+SoftAuthenticator plays a browser with a platform authenticator holding any number
+of ES256, EdDSA and RS256 credentials. Its keys come from a KeyPool that is
+generated once and kept on disk, so test runs don't spend their time on key
+generation. register_passkey() and login_with_passkey() run a whole ceremony
+through the Django test client, PasskeyTestMixin wires them into a TestCase:
+
+    class LoginTest(PasskeyTestMixin, TestCase):
+        def test_login(self):
+            user = User.objects.create_user("alice")
+            self.register_passkey(user)
+            response = self.login_with_passkey(discoverable=True)
+
+The pooled keys are shared between credentials and runs, never use them outside
+of tests.
+"""
+
+import json
+import os
+import tempfile
+import threading
+from struct import pack
+
+from cryptography.hazmat.primitives import serialization
+from fido2 import cbor
+from fido2.utils import sha256, websafe_encode
+
+from .budget import QueryBudgetTestMixin
+from .soft_webauthn import ALGORITHMS, SoftWebauthnDevice
+
+__all__ = [
+    "KeyPool",
+    "PasskeyTestMixin",
+    "QueryBudgetTestMixin",
+    "SoftAuthenticator",
+    "SoftCredential",
+    "SoftWebauthnDevice",
+    "get_key_pool",
+    "login_with_passkey",
+    "register_passkey",
+]
+
+
+class KeyPool:
+    """`size` private keys per algorithm, handed out round robin.
+
+    The keys are stored as PEM files in `path` (PASSKEYS_KEY_POOL or a directory
+    in the temp dir by default) and generated only when a file is missing.
+    """
+
+    def __init__(self, path=None, size=16):
+        self.path = path or os.environ.get("PASSKEYS_KEY_POOL") or os.path.join(
+            tempfile.gettempdir(), "passkeys-key-pool"
+        )
+        self.size = size
+        self._keys = {}
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def _file(self, algorithm, n):
+        return os.path.join(self.path, "%s-%d.pem" % (algorithm, n))
+
+    def _load(self, algorithm, n):
+        path = self._file(algorithm, n)
+        try:
+            with open(path, "rb") as f:
+                return serialization.load_pem_private_key(f.read(), password=None)
+        except (OSError, ValueError):
+            pass
+        key = ALGORITHMS[algorithm][1]()
+        pem = key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+        os.makedirs(self.path, exist_ok=True)
+        # parallel test runs may write the same file, whichever replace wins is fine
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(pem)
+        os.replace(tmp, path)
+        return key
+
+    def keys(self, algorithm):
+        """All the keys of algorithm, loading or generating them on first use"""
+        if algorithm not in ALGORITHMS:
+            raise ValueError("Unsupported algorithm %s" % algorithm)
+        keys = self._keys.get(algorithm)
+        if keys is None:
+            with self._lock:
+                keys = self._keys.get(algorithm)
+                if keys is None:
+                    keys = [self._load(algorithm, n) for n in range(self.size)]
+                    self._keys[algorithm] = keys
+        return keys
+
+    def take(self, algorithm):
+        """The next key of algorithm"""
+        keys = self.keys(algorithm)
+        with self._lock:
+            n = self._next.get(algorithm, 0)
+            self._next[algorithm] = (n + 1) % len(keys)
+        return keys[n]
+
+
+_pool = None
+
+
+def get_key_pool():
+    """The KeyPool shared by the SoftAuthenticators that aren't given one"""
+    global _pool
+    if _pool is None:
+        _pool = KeyPool()
+    return _pool
+
+
+class SoftCredential:
+    """A credential held by a SoftAuthenticator"""
+
+    def __init__(self, credential_id, algorithm, private_key, rp_id, user_handle, discoverable):
+        self.credential_id = credential_id
+        self.algorithm = algorithm
+        self.private_key = private_key
+        self.rp_id = rp_id
+        self.user_handle = user_handle
+        self.discoverable = discoverable
+        self.sign_count = 0
+
+    @property
+    def id(self):
+        """The base64url credential id, as the browser posts it"""
+        return websafe_encode(self.credential_id)
+
+    def sign(self, data):
+        return ALGORITHMS[self.algorithm][2](self.private_key, data)
+
+    def cose_key(self):
+        return ALGORITHMS[self.algorithm][0].from_cryptography_key(self.private_key.public_key())
+
+
+def _challenge(options):
+    challenge = options["publicKey"]["challenge"]
+    if isinstance(challenge, bytes):
+        challenge = challenge.decode("ascii")
+    return challenge.rstrip("=")
+
+
+def _client_data(kind, options, origin):
+    return json.dumps(
+        {"type": kind, "challenge": _challenge(options), "origin": origin}
+    ).encode("utf8")
+
+
+class SoftAuthenticator:
+    """Simulates navigator.credentials with an authenticator holding many credentials.
+
+    create() and get() take the JSON options of reg_begin and auth_begin (the
+    challenge may be str or bytes) and return what script.js posts back.
+    `algorithms` are the ones it supports, in order of preference, create() uses
+    the first one the options offer. Credentials are discoverable unless the
+    options discourage resident keys.
+    """
+
+    aaguid = b"\x00" * 16
+
+    def __init__(self, algorithms=("ES256", "EdDSA", "RS256"), pool=None):
+        if isinstance(algorithms, str):
+            algorithms = (algorithms,)
+        for algorithm in algorithms:
+            if algorithm not in ALGORITHMS:
+                raise ValueError("Unsupported algorithm %s" % algorithm)
+        self.algorithms = tuple(algorithms)
+        self.pool = pool or get_key_pool()
+        self.credentials = []
+
+    def _algorithm(self, options, algorithm):
+        offered = [p["alg"] for p in options["publicKey"]["pubKeyCredParams"]]
+        candidates = [algorithm] if algorithm else self.algorithms
+        for name in candidates:
+            if ALGORITHMS[name][0].ALGORITHM in offered:
+                return name
+        raise ValueError("Requested pubKeyCredParams does not contain a supported type")
+
+    def create(self, options, origin, algorithm=None):
+        """Registers a new credential, returns the attestation"""
+        public_key = options["publicKey"]
+        if public_key.get("attestation") not in (None, "none"):
+            raise ValueError("Only none attestation supported")
+        rp_id = public_key["rp"]["id"]
+        excluded = {d["id"].rstrip("=") for d in public_key.get("excludeCredentials") or ()}
+        if any(c.rp_id == rp_id and c.id in excluded for c in self.credentials):
+            raise ValueError("The authenticator already holds an excluded credential")
+        algorithm = self._algorithm(options, algorithm)
+        selection = public_key.get("authenticatorSelection") or {}
+        credential = SoftCredential(
+            os.urandom(32),
+            algorithm,
+            self.pool.take(algorithm),
+            rp_id,
+            public_key["user"]["id"],
+            discoverable=selection.get("residentKey") != "discouraged",
+        )
+        self.credentials.append(credential)
+
+        flags = b"\x41"  # attested_data + user_present
+        auth_data = (
+            sha256(rp_id.encode("utf8"))
+            + flags
+            + pack(">I", credential.sign_count)
+            + self.aaguid
+            + pack(">H", len(credential.credential_id))
+            + credential.credential_id
+            + cbor.encode(credential.cose_key())
+        )
+        attestation_object = {"authData": auth_data, "fmt": "none", "attStmt": {}}
+        return {
+            "id": credential.id,
+            "rawId": credential.id,
+            "response": {
+                "clientDataJSON": websafe_encode(
+                    _client_data("webauthn.create", options, origin)
+                ),
+                "attestationObject": websafe_encode(cbor.encode(attestation_object)),
+                "transports": ["internal"],
+            },
+            "type": "public-key",
+        }
+
+    def find(self, options):
+        """The credential get() would use, None if it holds no matching one"""
+        public_key = options["publicKey"]
+        rp_id = public_key["rpId"]
+        allowed = [d["id"].rstrip("=") for d in public_key.get("allowCredentials") or ()]
+        for credential in reversed(self.credentials):
+            if credential.rp_id != rp_id:
+                continue
+            if (credential.id in allowed) if allowed else credential.discoverable:
+                return credential
+        return None
+
+    def get(self, options, origin, credential=None):
+        """Signs an assertion with credential (by default the newest matching one)"""
+        credential = credential or self.find(options)
+        if credential is None:
+            raise ValueError("No credential for these options")
+        credential.sign_count += 1
+        client_data = _client_data("webauthn.get", options, origin)
+        auth_data = (
+            sha256(credential.rp_id.encode("ascii"))
+            + b"\x01"  # user_present
+            + pack(">I", credential.sign_count)
+        )
+        return {
+            "id": credential.id,
+            "rawId": credential.id,
+            "response": {
+                "authenticatorData": websafe_encode(auth_data),
+                "clientDataJSON": websafe_encode(client_data),
+                "signature": websafe_encode(credential.sign(auth_data + sha256(client_data))),
+                "userHandle": credential.user_handle if credential.discoverable else None,
+            },
+            "type": "public-key",
+        }
+
+
+def _origin(options, rp_id=None):
+    return "https://" + (rp_id or options["publicKey"].get("rpId") or options["publicKey"]["rp"]["id"])
+
+
+def register_passkey(client, authenticator=None, name="", user=None, algorithm=None, **extra):
+    """Registers a passkey through reg_begin and reg_complete, returns the authenticator.
+
+    client must be logged in, or pass user to log it in with force_login().
+    AssertionError is raised if the registration fails.
+    """
+    from django.urls import reverse
+
+    if user is not None:
+        client.force_login(user)
+    extra.setdefault("HTTP_USER_AGENT", "")
+    authenticator = authenticator or SoftAuthenticator()
+    options = json.loads(client.get(reverse("passkeys:reg_begin"), **extra).content)
+    data = authenticator.create(options, _origin(options), algorithm)
+    data["fido2_state"] = options.get("fido2_state")
+    data["key_name"] = name
+    response = client.post(
+        reverse("passkeys:reg_complete"),
+        data=json.dumps(data),
+        content_type="application/json",
+        **extra,
+    )
+    result = json.loads(response.content)
+    if result.get("status") != "OK":
+        raise AssertionError("Registration failed: %s" % result)
+    return authenticator
+
+
+def login_with_passkey(client, authenticator, user=None, discoverable=False, **extra):
+    """Logs client in through auth_begin and login.passkey, returns the last response.
+
+    With discoverable the options don't name the user, otherwise the passkeys of
+    user (or of the logged in user) are allowed.
+    """
+    from django.urls import reverse
+
+    extra.setdefault("HTTP_USER_AGENT", "")
+    if user is not None:
+        session = client.session
+        session["base_user_id"] = user._meta.pk.value_to_string(user)
+        session.save()
+    params = {"mode": "discoverable"} if discoverable else {}
+    options = json.loads(client.get(reverse("passkeys:auth_begin"), params, **extra).content)
+    data = authenticator.get(options, _origin(options))
+    data["fido2_state"] = options.get("fido2_state")
+    return client.post(
+        reverse("passkeys:login.passkey"),
+        {"passkeys": json.dumps(data)},
+        **extra,
+    )
+
+
+class PasskeyTestMixin:
+    """Adds a SoftAuthenticator and ceremony helpers to a TestCase.
+
+    Each test gets a fresh `self.authenticator` drawing from the shared key pool,
+    the helpers use `self.client` unless another client is passed.
+    """
+
+    authenticator_algorithms = ("ES256", "EdDSA", "RS256")
+
+    def setUp(self):
+        super().setUp()
+        self.authenticator = SoftAuthenticator(self.authenticator_algorithms)
+
+    def register_passkey(self, user=None, client=None, **kwargs):
+        return register_passkey(
+            client or self.client, self.authenticator, user=user, **kwargs
+        )
+
+    def login_with_passkey(self, user=None, client=None, discoverable=False, **kwargs):
+        return login_with_passkey(
+            client or self.client, self.authenticator, user, discoverable, **kwargs
+        )
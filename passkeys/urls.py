@@ -2,15 +2,24 @@ from django.urls import path
 from . import FIDO2, views
 from django.conf import settings
 
+if FIDO2.use_async_views():
+    reg_begin, reg_complete = FIDO2.areg_begin, FIDO2.areg_complete
+    auth_begin, passkey_login = FIDO2.aauth_begin, views.apasskey_login
+else:
+    reg_begin, reg_complete = FIDO2.reg_begin, FIDO2.reg_complete
+    auth_begin, passkey_login = FIDO2.auth_begin, views.passkey_login
+
 app_name = "passkeys"
 urlpatterns = [
     path("", views.index, name="home"),
-    path("registration/begin", FIDO2.reg_begin, name="reg_begin"),
-    path("registration/complete", FIDO2.reg_complete, name="reg_complete"),
-    path("auth/begin", FIDO2.auth_begin, name="auth_begin"),
+    path("registration/begin", reg_begin, name="reg_begin"),
+    path("registration/complete", reg_complete, name="reg_complete"),
+    path("auth/begin", auth_begin, name="auth_begin"),
     path("auth/complete", FIDO2.auth_complete, name="auth_complete"),
+    # auth_complete only returns the user, this logs them in
+    path("auth/login", passkey_login, name="auth_login"),
     path("login/", views.login_options, name="login"),
-    path("login/passkey/", views.passkey_login, name="login.passkey"),
+    path("login/passkey/", passkey_login, name="login.passkey"),
     path("login/otp/", views.otp_login, name="login.otp"),
     path("add/", views.add, name="add"),
     path("del/", views.del_key, name="delKey"),
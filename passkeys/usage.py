@@ -0,0 +1,205 @@
+import atexit
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import connections
+from django.dispatch import receiver
+
+from .models import UserPasskey
+from .utils import load_backend, sync_to_async
+
+
+def _write(pending):
+    """Writes {key_id: {field: value}} with one bulk_update per set of fields"""
+    groups = {}
+    for key_id, fields in pending.items():
+        groups.setdefault(tuple(sorted(fields)), []).append(
+            UserPasskey(pk=key_id, **fields)
+        )
+    for names, keys in groups.items():
+        UserPasskey.objects.bulk_update(keys, names, batch_size=500)
+    return len(pending)
+
+
+class ProcessUsageBuffer:
+    """Coalesces the usage updates of this process in memory.
+
+    The buffer is written once it holds `flush_size` passkeys, by a timer thread
+    `flush_interval` seconds after the first update it holds, and when the process
+    exits.
+    """
+
+    def __init__(self, flush_interval=30, flush_size=100):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._pending = {}
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def record(self, key_id, **fields):
+        with self._lock:
+            self._pending.setdefault(key_id, {}).update(fields)
+            due = len(self._pending) >= self.flush_size
+            if not due and self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self._flush_later)
+                self._timer.daemon = True
+                self._timer.start()
+        if due:
+            self.flush()
+
+    def _flush_later(self):
+        try:
+            self.flush()
+        finally:
+            # closes the connections of the timer thread only
+            connections.close_all()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        return _write(pending) if pending else 0
+
+
+class CacheUsageBuffer:
+    """Coalesces the usage updates of every process in a shared Django cache.
+
+    Each update is appended to a numbered log in the cache, the log is written to
+    the database by whichever process notices that it holds `flush_size` entries or
+    that `flush_interval` seconds passed, or by the passkeys_flush_usage command.
+    Entries expire after a few flush intervals so a late one can't linger. An entry
+    missing from a flush is retried by the next one in case its writer was still
+    setting it, after that it is counted as lost. Updates evicted from the cache
+    before a flush are lost, last_used is best effort.
+    """
+
+    prefix = "passkeys:usage:"
+
+    def __init__(self, alias="default", flush_interval=30, flush_size=100):
+        self.alias = alias
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @property
+    def item_timeout(self):
+        return max(3 * self.flush_interval, 60)
+
+    def record(self, key_id, **fields):
+        cache = self.cache
+        try:
+            cache.add(self.prefix + "seq", 0, None)
+            seq = cache.incr(self.prefix + "seq")
+            cache.set(self.prefix + "item:%d" % seq, (key_id, fields), self.item_timeout)
+        except ValueError:
+            # The sequence was evicted between add() and incr(), write directly.
+            UserPasskey.objects.filter(pk=key_id).update(**fields)
+            return
+        state = cache.get_many([self.prefix + "flushed", self.prefix + "flushed_at"])
+        flushed_at = state.get(self.prefix + "flushed_at")
+        if (
+            seq - state.get(self.prefix + "flushed", 0) >= self.flush_size
+            or flushed_at is None
+            or time.time() - flushed_at >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        cache = self.cache
+        if not cache.add(self.prefix + "lock", 1, 60):
+            return 0
+        try:
+            last = seq = cache.get(self.prefix + "seq", 0)
+            state = cache.get_many([self.prefix + "flushed", self.prefix + "seen"])
+            # If the log outgrew the cache, entries older than this are gone anyway.
+            flushed = max(state.get(self.prefix + "flushed", 0), seq - 10 * self.flush_size)
+            seen = state.get(self.prefix + "seen", 0)
+            keys = [self.prefix + "item:%d" % n for n in range(flushed + 1, seq + 1)]
+            items = cache.get_many(keys)
+            pending = {}
+            done = []
+            for n, item in enumerate(keys, flushed + 1):
+                if item in items:
+                    key_id, fields = items[item]
+                    pending.setdefault(key_id, {}).update(fields)
+                    done.append(item)
+                elif n > seen:
+                    # incr() landed but set() may not have yet, stop before it
+                    seq = n - 1
+                    break
+            written = _write(pending) if pending else 0
+            cache.set_many(
+                {
+                    self.prefix + "flushed": seq,
+                    self.prefix + "seen": last,
+                    self.prefix + "flushed_at": time.time(),
+                },
+                None,
+            )
+            cache.delete_many(done)
+            return written
+        finally:
+            cache.delete(self.prefix + "lock")
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_usage_buffer():
+    """Returns the buffer configured by PASSKEYS_USAGE_BUFFER or None to write immediately"""
+    global _buffer
+    config = getattr(settings, "PASSKEYS_USAGE_BUFFER", None)
+    if config is None:
+        return None
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = load_backend(config)
+    return _buffer
+
+
+def record_usage(key_id, **fields):
+    """Updates fields (e.g. last_used) of the passkey key_id, through the buffer if any"""
+    buffer = get_usage_buffer()
+    if buffer is None:
+        UserPasskey.objects.filter(pk=key_id).update(**fields)
+    else:
+        buffer.record(key_id, **fields)
+
+
+async def arecord_usage(key_id, **fields):
+    """Async variant of record_usage"""
+    buffer = get_usage_buffer()
+    if buffer is None:
+        await UserPasskey.objects.filter(pk=key_id).aupdate(**fields)
+    else:
+        await sync_to_async(buffer.record)(key_id, **fields)
+
+
+def flush_usage():
+    """Writes every buffered update, returns the number of passkeys written"""
+    buffer = get_usage_buffer()
+    return buffer.flush() if buffer is not None else 0
+
+
+@atexit.register
+def _flush_at_exit():
+    if isinstance(_buffer, ProcessUsageBuffer):
+        _buffer.flush()
+
+
+@receiver(setting_changed)
+def _reset_buffer(setting, **kwargs):
+    global _buffer
+    if setting == "PASSKEYS_USAGE_BUFFER" and _buffer is not None:
+        _buffer.flush()
+        _buffer = None
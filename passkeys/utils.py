@@ -0,0 +1,79 @@
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+
+def load_backend(config):
+    """Instantiates a backend configured as a dotted path or as a dict with
+    'BACKEND' and 'OPTIONS' keys"""
+    if isinstance(config, str):
+        config = {"BACKEND": config}
+    return import_string(config["BACKEND"])(**config.get("OPTIONS", {}))
+
+
+_backend_paths = {}
+
+
+def get_backend_path(name):
+    """Returns the first entry of AUTHENTICATION_BACKENDS containing name"""
+    path = _backend_paths.get(name)
+    if path is None:
+        path = _backend_paths[name] = next(
+            be for be in settings.AUTHENTICATION_BACKENDS if name in be
+        )
+    return path
+
+
+@receiver(setting_changed)
+def _reset_backend_paths(setting, **kwargs):
+    if setting == "AUTHENTICATION_BACKENDS":
+        _backend_paths.clear()
+
+
+def sync_to_async(func):
+    """asgiref's sync_to_async, imported on first use as Django 2.x doesn't install asgiref"""
+    from asgiref.sync import sync_to_async
+
+    return sync_to_async(func)
+
+
+async def asession_get(session, key, default=None):
+    if hasattr(session, "aget"):
+        return await session.aget(key, default)
+    return await sync_to_async(session.get)(key, default)
+
+
+async def asession_set(session, key, value):
+    if hasattr(session, "aset"):
+        return await session.aset(key, value)
+    return await sync_to_async(session.__setitem__)(key, value)
+
+
+async def asession_pop(session, key, default=None):
+    if hasattr(session, "apop"):
+        return await session.apop(key, default)
+    return await sync_to_async(session.pop)(key, default)
+
+
+def _load_user(request):
+    request.user.is_authenticated  # evaluates the lazy user
+    return request.user
+
+
+async def alogin(request, user, backend=None):
+    """django.contrib.auth.alogin, which Django 5.0 added, or login in a thread"""
+    try:
+        from django.contrib.auth import alogin
+    except ImportError:
+        from django.contrib.auth import login
+
+        return await sync_to_async(login)(request, user, backend=backend)
+    return await alogin(request, user, backend=backend)
+
+
+async def aget_user(request):
+    """Returns request.user without touching the database from the event loop"""
+    if hasattr(request, "auser"):
+        return await request.auser()
+    return await sync_to_async(_load_user)(request)
@@ -1,28 +1,35 @@
 import json
-import datetime
 from django.contrib.auth.decorators import login_required
 from django.http import HttpResponse
 from django.shortcuts import render
-from django.utils.timezone import now as utc_now
 from django.http import JsonResponse
 
-from .models import UserPasskey, OTP
+from .models import UserPasskey
 from django.utils.translation import gettext_lazy as _
-from string import digits
-import random
 from django.conf import settings
 from django.contrib.auth import get_user_model, login
 from django.utils.translation import gettext_lazy as _
 from passkeys.backend import PasskeyBackendException
 from passkeys.FIDO2 import (
+    aauth_complete,
     auth_complete,
+    authentication_options,
+    get_credential_descriptors,
 )
+from passkeys.bloom import might_exist
+from passkeys.budget import query_budget
+from passkeys.executor import VerificationQueueFull
+from passkeys.mail import get_otp_dispatcher
+from passkeys.otp import get_otp_backend
+from passkeys.ratelimit import rate_limit
+from passkeys.utils import alogin, get_backend_path, sync_to_async
 from django.views.decorators.http import require_POST
 from django import forms
 from passkeys.models import UserPasskey
 
 from django.conf import settings
 from django.contrib.auth import get_user_model, login
+from django.db import transaction
 from django.core.exceptions import ValidationError
 from django.http import HttpResponseRedirect
 from django.shortcuts import render
@@ -33,12 +40,16 @@ from .forms import LoginOptionsForm, PasswordLoginForm, OTPLoginForm
 UserModel = get_user_model()
 
 
+@query_budget(5)
+@rate_limit("login_options")
 def login_options(request):
     next_ = request.GET.get("next", request.POST.get("next", "/"))
     button_text = _("Next")
     form = LoginOptionsForm(initial={"next": next_})
     use_email = UserModel.USERNAME_FIELD == "email"
     options = []
+    passkey_options = None
+    conditional_ui = getattr(settings, "PASSKEYS_CONDITIONAL_UI", False)
 
     if request.method == "POST":
         form = PasswordLoginForm(
@@ -49,8 +60,10 @@ def login_options(request):
         )
         username = request.POST.get(UserModel.USERNAME_FIELD)
         filter_args = {UserModel.USERNAME_FIELD: username}
-        user = UserModel.objects.filter(**filter_args)
-        if user.exists():
+        user = None
+        if might_exist("usernames", username):
+            user = UserModel.objects.filter(**filter_args).first()
+        if user is not None:
             if request.POST.get("password"):
                 try:
                     form = PasswordLoginForm(request.POST)
@@ -69,10 +82,13 @@ def login_options(request):
                         ),
                     )
 
-            passkeys = UserPasskey.objects.filter(user=user.first())
-            if passkeys.exists():
+            credentials = get_credential_descriptors(user_id=user.pk)
+            if credentials:
                 request.session["base_username"] = username
+                request.session["base_user_id"] = user._meta.pk.value_to_string(user)
                 options.append({"value": "passkey", "text": "Login with passkey"})
+                # rendered into the page, the browser doesn't have to call auth_begin
+                passkey_options = authentication_options(request, credentials)
             if hasattr(settings, "USE_OTP_LOGIN") and use_email:
                 options.append({"value": "otp", "text": _("Receive email code")})
         elif request.POST.get("password"):
@@ -90,6 +106,9 @@ def login_options(request):
                         mark_safe("Email adresse or password wrong. No account yet?")
                     ),
                 )
+    elif conditional_ui:
+        # discoverable options for the autofill prompt
+        passkey_options = authentication_options(request)
 
     return render(
         request,
@@ -100,29 +119,49 @@ def login_options(request):
             "button_text": button_text,
             "current_page": "auth.login",
             "login_options": options,
+            "passkey_options": passkey_options,
+            "conditional_ui": conditional_ui,
         },
     )
 
 
+@query_budget(8)
+@rate_limit("passkey_login")
 def passkey_login(request):
     next_ = request.GET.get("next", request.POST.get("next", "/"))
-    if request.method == "POST":
-        if request.POST.get("passkeys"):
-            user = auth_complete(request)
-            if user:
-                login(
-                    request,
-                    user,
-                    backend=[
-                        be
-                        for be in settings.AUTHENTICATION_BACKENDS
-                        if "PasskeyModelBackend" in be
-                    ][0],
-                )
-                return HttpResponseRedirect(next_)
-        else:
-            return render(request, "passkeys/login.html")
+    if request.method == "POST" and request.POST.get("passkeys"):
+        user = auth_complete(request)
+        if user:
+            login(
+                request,
+                user,
+                backend=get_backend_path("PasskeyModelBackend"),
+            )
+            return HttpResponseRedirect(next_)
+    return render(request, "passkeys/login.html")
+
+
+@query_budget(8)
+@rate_limit("passkey_login")
+async def apasskey_login(request):
+    """Async variant of passkey_login, verifies the assertion with aauth_complete"""
+    next_ = request.GET.get("next", request.POST.get("next", "/"))
+    if request.method == "POST" and request.POST.get("passkeys"):
+        try:
+            user = await aauth_complete(request)
+        except VerificationQueueFull:
+            return HttpResponse(
+                "Server is busy, please try again later", status=503, content_type="text/plain"
+            )
+        if user:
+            await alogin(request, user, backend=get_backend_path("PasskeyModelBackend"))
+            return HttpResponseRedirect(next_)
+    # the templates may load request.user
+    return await sync_to_async(render)(request, "passkeys/login.html")
 
+
+@query_budget(8)
+@rate_limit("otp_login")
 @require_POST
 def otp_login(request):
     next_ = request.POST.get("next", "/")
@@ -134,22 +173,13 @@ def otp_login(request):
     if request.POST.get("otp"):
         form = OTPLoginForm(request.POST)
         if form.is_valid():
-            otp = OTP.objects.filter(
-                key=form.cleaned_data.get("otp"),
-                email=form.cleaned_data.get("email"),
-                created_at__gte=utc_now() - datetime.timedelta(seconds=60),
-            )
-            if otp.exists():
-                otp = otp.first()
-                user = UserModel.objects.get(email=request.POST.get("email"))
+            email = form.cleaned_data.get("email")
+            if get_otp_backend().consume(email, form.cleaned_data.get("otp")):
+                user = UserModel.objects.get(email=email)
                 login(
                     request,
                     user,
-                    backend=[
-                        be
-                        for be in settings.AUTHENTICATION_BACKENDS
-                        if "EmailBackend" in be
-                    ][0],
+                    backend=get_backend_path("EmailBackend"),
                 )
                 return HttpResponseRedirect(form.cleaned_data.get("next", "/"))
             else:
@@ -164,11 +194,11 @@ def otp_login(request):
 
     else:
         form = OTPLoginForm(request.POST)
-        new_otp = OTP.objects.create(
-            key="".join(random.choice(digits) for i in range(6)),
-            email=request.POST.get("email"),
-        )
-        new_otp.send()
+        email = request.POST.get("email")
+        if email:
+            code = get_otp_backend().create(email)
+            # Don't mail a code that a rolled back transaction didn't store.
+            transaction.on_commit(lambda: get_otp_dispatcher().dispatch(email, code))
         button_text = _("Verify")
     return render(
         request,
@@ -183,45 +213,41 @@ def otp_login(request):
     )
 
 
+@query_budget(3)
 @login_required
 def index(request):  # noqa
     keys = UserPasskey.objects.filter(user=request.user).order_by("-last_used")  # pragma: no cover
     return render(request, "passkeys/passkeys.html", {"keys": keys})  # pragma: no cover
 
 
+@query_budget(4)
 @login_required
 def del_key(request):
     data = json.loads(request.body)
-    key = UserPasskey.objects.filter(id=data.get("id"))
-    if key.exists():
-        key = key.first()
-    else:
+    key = UserPasskey.objects.filter(id=data.get("id"), user_id=request.user.pk).first()
+    if key is None:
         return HttpResponse(
             "Error: You don't own this token so you can't delete it", status=403
         )
-
-    if key.user.pk == request.user.pk:
-        key.delete()
-        return HttpResponse("Deleted Successfully")
-    return HttpResponse(
-        "Error: You don't own this token so you can't delete it", status=403
-    )
+    key.delete()
+    return HttpResponse("Deleted Successfully")
 
 
+@query_budget(4)
 @login_required
 def toggle_key(request):
     data = json.loads(request.body)
-    key = UserPasskey.objects.filter(id=data.get("id"))
-    if key.exists() and key.first().user.pk == request.user.pk:
-        key = key.first()
-        key.enabled = not key.enabled
-        key.save()
-        return HttpResponse("OK")
-    return HttpResponse(
-        "Error: You don't own this token so you can't toggle it", status=403
-    )
+    key = UserPasskey.objects.filter(id=data.get("id"), user_id=request.user.pk).first()
+    if key is None:
+        return HttpResponse(
+            "Error: You don't own this token so you can't toggle it", status=403
+        )
+    key.enabled = not key.enabled
+    key.save(update_fields=["enabled"])
+    return HttpResponse("OK")
 
 
+@query_budget(2)
 @login_required
 def add(request):
     return render(request, "passkeys/add.html")